@@ -4,29 +4,564 @@
 
 This is just a simple wrapper for appstats with result formatting. See
 https://developers.google.com/appengine/docs/python/tools/appstats for more.
+
+RPCs are also checked for N+1 patterns: loops that make the same kind of RPC,
+one after another, from the same place in the code. Each such run is reported
+as batchable, with an estimate of the time a batched call (such as get_multi)
+or an asynchronous fan-out would save.
+
+The RPCs' start and end times are analyzed as intervals, overall and per
+service: how much of the request's wall time had an RPC in flight, how many
+RPCs were in flight at once, and the critical path, the longest chain of RPCs
+that ran one after another and so set a lower bound on the request's time.
+
+Only appstats' raw request and response summaries are kept with a profile.
+Parsing them into something readable is comparatively slow, so it's left to
+prettify(), which is only called when someone looks at a profile's RPCs.
+The exception is datastore RPCs, whose operations are counted as they're made,
+or from their summaries, to tally what the request paid for (see
+datastore_ledger()). Each request's counts are also added to running totals
+for its route, kept in memcache, so a request can be compared with the ones
+before it.
 """
 
+import bisect
 import logging
+import re
 from pprint import pformat
 
+from google.appengine.api import memcache
 from google.appengine.ext.appstats import recording
 
 import cleanup
 import unformatter
 import util
 
+# (request summary, response summary, service call name) -> prettify() results, so that RPCs that
+# are repeated, within a request or across requests, are only parsed once.
+_prettified = {}
+
+# Clear _prettified once it reaches this many entries to bound its memory.
+_MAX_PRETTIFIED = 1000
+
+def prettify(request, response, service_call_name=None):
+    """Return readable versions of an RPC's appstats summaries, given its
+    "service.Call" name.
+
+    Returns a dict with the short ("request_short", "response_short") and
+    pretty-printed ("request", "response") versions of the request and
+    response, "miss", which is 1 if the RPC was a memcache miss, "counts",
+    the RPC's entity, key, hit and miss counts from cleanup.cleanup(), and
+    "counts_desc", a description of them. "memcache_prefixes" is
+    {key prefix: [hits, misses]} for memcache gets.
+    """
+    key = (request, response, service_call_name)
+    # Another thread may clear _prettified at any point, so only read it
+    # once.
+    prettified = _prettified.get(key)
+    if prettified is None:
+        prettified = _prettify(request, response, service_call_name)
+        if len(_prettified) >= _MAX_PRETTIFIED:
+            _prettified.clear()
+        _prettified[key] = prettified
+    return prettified
+
+def _prettify(request, response, service_call_name):
+    request_short = request_pretty = None
+    response_short = response_pretty = None
+    miss = 0
+    counts = {}
+    try:
+        request_object = unformatter.unformat(request)
+        # Failed RPCs have no response.
+        response_object = unformatter.unformat(response) if response else None
+
+        request_short, response_short, miss, counts = cleanup.cleanup(
+            request_object, response_object, service_call_name)
+
+        request_pretty = pformat(request_object)
+        response_pretty = pformat(response_object) if response else None
+    except Exception, e:
+        pass
+        # enable this if you want to improve prettification
+        # logging.warning("Prettifying RPC calls failed.\n%s\nRequest: %s\nResponse: %s",
+        #     e, request, response, exc_info=True)
+
+    return {
+        "request": request_pretty or request,
+        "response": response_pretty or response,
+        "request_short": request_short or cleanup.truncate(request),
+        "response_short": response_short or cleanup.truncate(response),
+        "miss": miss,
+        "counts": dict((name, count) for name, count in counts.iteritems()
+                       if name != "memcache_prefixes"),
+        "counts_desc": cleanup.counts_desc(counts),
+        "memcache_prefixes": counts.get("memcache_prefixes", {}),
+    }
+
+# Runs of at least this many serial RPCs with the same shape, made from the
+# same call stack, are reported as batchable.
+MIN_BATCHABLE_CALLS = 3
+
+# How to batch the RPCs of each kind of call, for the batchable RPC report.
+_BATCH_SUGGESTIONS = {
+    "datastore_v3.Get": "get_multi",
+    "datastore_v3.Put": "put_multi",
+    "datastore_v3.Delete": "delete_multi",
+    "datastore_v3.RunQuery": "async queries",
+    "memcache.Get": "memcache.get_multi",
+    "memcache.Set": "memcache.set_multi",
+    "memcache.Delete": "memcache.delete_multi",
+    "memcache.Increment": "memcache.offset_multi",
+}
+
+# String and number literals in appstats' request summaries.
+_REQUEST_LITERAL = re.compile(r"""'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*"|\b\d+L?\b""")
+
+def request_shape(request):
+    """Return an RPC's request summary with its string and number literals
+    replaced by "?", so that requests for different keys have the same
+    shape."""
+    return _REQUEST_LITERAL.sub("?", request)
+
+def batchable_runs(rpcs):
+    """Find runs of RPCs that could have been batched.
+
+    rpcs is a list of (service call name, request shape, call stack, start
+    offset ms, duration ms) tuples, one per RPC. RPCs with the same service
+    call name, request shape and call stack are grouped, and each group is
+    split into runs of calls that didn't overlap, i.e. that were made one after
+    another. Runs of at least MIN_BATCHABLE_CALLS calls are returned as lists
+    of indexes into rpcs, most expensive first.
+
+    A batched or asynchronous version of a run should take about as long as
+    its slowest call, so the time it would save is estimated as the run's total
+    time less its slowest call (see estimated_savings).
+    """
+    groups = {}
+    for index, (service, shape, stack, _, _) in enumerate(rpcs):
+        groups.setdefault((service, shape, stack), []).append(index)
+
+    runs = []
+    for indexes in groups.itervalues():
+        run = []
+        run_end = None
+        for index in sorted(indexes, key=lambda index: rpcs[index][3]):
+            start, duration = rpcs[index][3:5]
+            if run and start < run_end:
+                # This call overlapped the previous one, so the caller already
+                # made them asynchronously.
+                if len(run) >= MIN_BATCHABLE_CALLS:
+                    runs.append(run)
+                run = []
+            run.append(index)
+            run_end = max(run_end, start + duration)
+        if len(run) >= MIN_BATCHABLE_CALLS:
+            runs.append(run)
+
+    return sorted(runs, reverse=True,
+                  key=lambda run: estimated_savings(rpcs, run))
+
+def estimated_savings(rpcs, run):
+    """Return the ms that batching the RPCs of run would save."""
+    durations = [rpcs[index][4] for index in run]
+    return sum(durations) - max(durations)
+
+def interval_union(intervals):
+    """Return the total length of the union of (start, end) intervals."""
+    union = 0
+    union_end = None
+    for start, end in sorted(intervals):
+        if union_end is None or start >= union_end:
+            union += end - start
+            union_end = end
+        elif end > union_end:
+            union += end - union_end
+            union_end = end
+    return union
+
+def max_concurrency(intervals):
+    """Return the most (start, end) intervals that overlap at any time.
+
+    Intervals that only touch, with one ending when the next starts, don't
+    overlap.
+    """
+    # Sorting (time, +1 or -1) pairs puts ends before starts at the same time.
+    events = sorted([(start, 1) for start, _ in intervals] +
+                    [(end, -1) for _, end in intervals])
+    in_flight = most_in_flight = 0
+    for _, change in events:
+        in_flight += change
+        most_in_flight = max(most_in_flight, in_flight)
+    return most_in_flight
+
+def critical_path(intervals):
+    """Return the indexes of the chain of (start, end) intervals, each starting
+    after the one before it ended, with the greatest total length.
+
+    With intervals the times RPCs were in flight, these are the RPCs that were
+    made one after another and took the longest altogether, i.e. the ones to
+    make asynchronous or faster to shorten the request.
+    """
+    order = sorted(xrange(len(intervals)), key=lambda i: intervals[i][1])
+    ends = [intervals[i][1] for i in order]
+
+    # best[n] is the length of the longest chain ending with one of the first
+    # n intervals by end time, and best_last[n] is its last interval.
+    best = [0]
+    best_last = [None]
+    previous = {}
+    for n, i in enumerate(order):
+        start, end = intervals[i]
+        before = bisect.bisect_right(ends, start, 0, n)
+        previous[i] = best_last[before]
+        length = best[before] + end - start
+        if length > best[n]:
+            best.append(length)
+            best_last.append(i)
+        else:
+            best.append(best[n])
+            best_last.append(best_last[n])
+
+    path = []
+    i = best_last[-1]
+    while i is not None:
+        path.append(i)
+        i = previous[i]
+    path.reverse()
+    return path
+
+def interval_stats(intervals):
+    """Return the union time and max and average concurrency of (start, end)
+    intervals.
+
+    Average concurrency is the mean number of intervals in flight while any
+    was.
+    """
+    union = interval_union(intervals)
+    return {
+        "union_time": union,
+        "max_concurrency": max_concurrency(intervals),
+        "average_concurrency": (sum(end - start for start, end in intervals) /
+                                float(union) if union else 0),
+    }
+
+# How many call sites to list in the table of the bytes RPCs moved.
+MAX_BYTES_CALL_SITES = 20
+
+def byte_size(message):
+    """Return the size of an RPC's request or response in bytes, or None if
+    it can't be worked out."""
+    try:
+        return message.ByteSize()
+    except Exception:
+        return None
+
+def rpc_sizes(trace, sized_trace=None):
+    """Return the byte sizes of an RPC's request and response.
+
+    Appstats doesn't record them, so for appstats traces they're taken from
+    sized_trace, the rpc_hook_profiler trace of the same RPC, if any (see
+    Profile.sized_traces()).
+    """
+    if not hasattr(trace, "request_size_bytes"):
+        trace = sized_trace
+        if trace is None:
+            return None, None
+    return trace.request_size_bytes(), trace.response_size_bytes()
+
+def message_datastore_operations(call, request, response):
+    """Count a datastore_v3 RPC's operations from its request and response
+    protocol buffers, like cleanup.datastore_operations() does from their
+    summaries. The response is None if the RPC failed.
+
+    Returns None if they can't be counted.
+    """
+    operations = {}
+    try:
+        if call == "Get":
+            operations["keys_fetched"] = request.key_size()
+            if response is not None:
+                operations["entities_fetched"] = len(
+                    [entity for entity in response.entity_list()
+                     if entity.has_entity()])
+        elif call in ("RunQuery", "Next"):
+            keys_only = False
+            if call == "RunQuery":
+                keys_only = request.keys_only()
+                operations["keys_only_queries" if keys_only else "queries"] = 1
+            if response is not None:
+                if response.has_keys_only():
+                    keys_only = response.keys_only()
+                operations["query_keys" if keys_only else "query_entities"] = (
+                    response.result_size())
+        elif call == "Put":
+            operations["entities_written"] = request.entity_size()
+            index_writes = _message_index_writes(response)
+            if index_writes is None:
+                index_writes = sum(
+                    cleanup.estimated_index_writes(entity.property_size())
+                    for entity in request.entity_list())
+            operations["index_writes"] = index_writes
+        elif call == "Delete":
+            operations["keys_deleted"] = request.key_size()
+            index_writes = _message_index_writes(response)
+            if index_writes is not None:
+                operations["index_writes"] = index_writes
+    except Exception:
+        return None
+    return operations
+
+def _message_index_writes(response):
+    """Return the index writes a put or delete response says it cost, or
+    None if it doesn't say."""
+    if (response is not None and response.has_cost() and
+            response.cost().has_index_writes()):
+        return response.cost().index_writes()
+    return None
+
+# (call, request summary, response summary) -> datastore_operations()
+# results, bounded like _prettified
+_datastore_operations = {}
+
+_NOT_CACHED = object()
+
+def datastore_operations(trace):
+    """Return the datastore operations a datastore_v3 RPC adds to its
+    request's ledger, as a dict of cleanup.DATASTORE_LEDGER_FIELDS to counts,
+    or None if its summaries couldn't be read.
+
+    rpc_hook_profiler's traces count them from the RPC's protocol buffers.
+    Appstats traces only have the summaries to go on, unless an
+    rpc_hook_profiler trace of the same RPC counted them (see
+    datastore_ledger()), so the counts are lower bounds if
+    summaries_truncated().
+    """
+    if hasattr(trace, "datastore_operations"):
+        return trace.datastore_operations()
+
+    call = trace.service_call_name().partition(".")[2]
+    key = (call, trace.request_data_summary(), trace.response_data_summary())
+    # As in prettify(), only read _datastore_operations once.
+    operations = _datastore_operations.get(key, _NOT_CACHED)
+    if operations is _NOT_CACHED:
+        try:
+            response = (unformatter.unformat(key[2])
+                        if key[2] else None)
+            operations = cleanup.datastore_operations(
+                call, unformatter.unformat(key[1]), response)
+        except Exception:
+            operations = None
+        if len(_datastore_operations) >= _MAX_PRETTIFIED:
+            _datastore_operations.clear()
+        _datastore_operations[key] = operations
+    return operations
+
+def summaries_truncated(trace):
+    """Return whether appstats cut an RPC's request or response summary
+    short, leaving out some of its repeated fields."""
+    return ("..." in trace.request_data_summary() or
+            "..." in trace.response_data_summary())
+
+def datastore_ledger(traces, sized_traces=None):
+    """Count the datastore operations of a request's RPCs.
+
+    sized_traces maps the indexes in traces of appstats RPCs to the
+    rpc_hook_profiler traces of the same RPCs, whose operations were counted
+    from their protocol buffers and are used instead of their summaries.
+
+    Returns a dict with the number of datastore_v3 RPCs ("call_count"),
+    how many of them couldn't be read ("unread_call_count"), how many were
+    only counted from summaries that were cut short, so that their counts
+    are lower bounds ("truncated_call_count"), how many milliseconds they
+    took ("time"), and the total of each of cleanup.DATASTORE_LEDGER_FIELDS
+    ("operations").
+    """
+    sized_traces = sized_traces or {}
+    ledger = {
+        "call_count": 0,
+        "unread_call_count": 0,
+        "truncated_call_count": 0,
+        "time": 0,
+        "operations": dict.fromkeys(cleanup.DATASTORE_LEDGER_FIELDS, 0),
+    }
+    for index, trace in enumerate(traces):
+        if service_prefix(trace.service_call_name()) != "datastore_v3":
+            continue
+        ledger["call_count"] += 1
+        ledger["time"] += trace.duration_milliseconds()
+        operations = None
+        if index in sized_traces:
+            operations = sized_traces[index].datastore_operations()
+        if operations is None:
+            operations = datastore_operations(trace)
+            if operations is None:
+                ledger["unread_call_count"] += 1
+                continue
+            if (not hasattr(trace, "datastore_operations") and
+                    summaries_truncated(trace)):
+                ledger["truncated_call_count"] += 1
+        for name, count in operations.iteritems():
+            ledger["operations"][name] += count
+    return ledger
+
+_ROUTE_LEDGER_MEMCACHE_KEY_FORMAT = "__gae_mini_profiler_datastore_ledger_%s"
+
+# How long a path's running totals are kept after a request last added to
+# them.
+_ROUTE_LEDGER_SECONDS = 24 * 60 * 60
+
+_ROUTE_LEDGER_CAS_RETRIES = 3
+
+def add_to_route_ledger(path, ledger, request_time):
+    """Add a request's datastore ledger and its time in milliseconds to the
+    running totals of the requests to path's util.route().
+
+    The totals are kept in memcache, so that requests served by any instance
+    add to them, which means they can be lost to eviction.
+
+    Returns the totals of the earlier requests to the route, to compare this
+    one with, or None if there aren't any. They're a dict with the number of
+    requests ("request_count"), their total time ("request_time") and their
+    ledgers' totals ("call_count", "time" and "operations").
+    """
+    key = _ROUTE_LEDGER_MEMCACHE_KEY_FORMAT % util.route(path)
+    client = memcache.Client()
+    earlier = None
+    for _ in xrange(_ROUTE_LEDGER_CAS_RETRIES):
+        earlier = client.gets(key)
+        totals = {
+            "request_count": 1,
+            "request_time": request_time,
+            "call_count": ledger["call_count"],
+            "time": ledger["time"],
+            "operations": dict(ledger["operations"]),
+        }
+        if earlier is None:
+            if client.add(key, totals, time=_ROUTE_LEDGER_SECONDS):
+                return None
+            continue
+
+        for name in ("request_count", "request_time", "call_count", "time"):
+            totals[name] += earlier[name]
+        for name, count in earlier["operations"].iteritems():
+            totals["operations"][name] = totals["operations"].get(name, 0) + count
+        if client.cas(key, totals, time=_ROUTE_LEDGER_SECONDS):
+            return earlier
+
+    # Another request kept winning the race, so this one goes uncounted.
+    return earlier
+
+def datastore_ledger_rows(ledger, request_time, route_totals):
+    """Return rows for the template comparing a request's datastore ledger
+    with the average of the earlier requests to its path, if any."""
+    route_totals = route_totals or {}
+    route_operations = route_totals.get("operations", {})
+
+    def row(label, count, route_total):
+        route_average = None
+        if route_totals:
+            route_average = util.decimal_fmt(
+                float(route_total) / route_totals["request_count"], 1)
+        return {"label": label, "count": count, "route_average": route_average}
+
+    rows = [
+        row("request ms", util.milliseconds_fmt(request_time),
+            route_totals.get("request_time")),
+        row("datastore ms", util.milliseconds_fmt(ledger["time"]),
+            route_totals.get("time")),
+        row("datastore RPCs", ledger["call_count"],
+            route_totals.get("call_count")),
+    ]
+    for name in cleanup.DATASTORE_LEDGER_FIELDS:
+        rows.append(row(name.replace("_", " "), ledger["operations"][name],
+                        route_operations.get(name, 0)))
+    return rows
+
+def _kilobytes_fmt(byte_count):
+    return util.kilobytes_fmt(byte_count) if byte_count is not None else None
+
+def service_prefix(service_call_name):
+    """Return the service of an RPC's "service.Call" name."""
+    return service_call_name.split(".", 1)[0]
+
+def is_skipped_frame(filename, skipped_frame_paths):
+    """Return whether a frame in filename is left out of RPC call stacks,
+    i.e. whether its path contains one of skipped_frame_paths."""
+    filename = filename.replace("\\", "/")
+    for path in skipped_frame_paths:
+        if path in filename:
+            return True
+    return False
+
 class Profile(object):
-    """Profiler that wraps appstats for programmatic access and reporting."""
-    def __init__(self):
-        # Configure AppStats output, keeping a high level of request
-        # content so we can detect dupe RPCs more accurately
-        recording.config.MAX_REPR = 750
+    """Profiler that wraps appstats for programmatic access and reporting.
+
+    The arguments are the options from config.rpc_capture_options():
+    stack_depth and skipped_frame_paths limit the call stack kept for each
+    RPC, repr_limit is the most characters of each request and response
+    summary kept, and only the first detailed_calls_per_site RPCs made from
+    each call stack are kept in full; the rest are only counted.
+    """
+    def __init__(self, stack_depth=None, skipped_frame_paths=(),
+                 repr_limit=750, detailed_calls_per_site=None):
+        self.stack_depth = stack_depth
+        self.skipped_frame_paths = tuple(skipped_frame_paths)
+        self.repr_limit = repr_limit
+        self.detailed_calls_per_site = detailed_calls_per_site
 
         # Each request has its own internal appstats recorder
         self.recorder = None
 
-    def results(self):
-        """Return appstats results in a dictionary for template context."""
+        # rpc_hook_profiler.Profile that sizes the RPCs appstats records and
+        # counts their datastore operations, which appstats doesn't
+        self.sizes_profile = None
+
+    def call_site(self, trace):
+        """Return descriptions of the frames of the call stack kept for an
+        RPC, innermost first."""
+        stack_frames_desc = []
+        for frame in trace.call_stack_list():
+            if self.stack_depth is not None and len(stack_frames_desc) >= self.stack_depth:
+                break
+            filename = frame.class_or_file_name()
+            if filename and is_skipped_frame(filename, self.skipped_frame_paths):
+                continue
+            stack_frames_desc.append("%s:%s %s" %
+                    (util.short_rpc_file_fmt(filename),
+                        frame.line_number(),
+                        frame.function_name()))
+        return tuple(stack_frames_desc)
+
+    def sized_traces(self):
+        """Return a dict of the indexes of the recorder's traces to the
+        traces sizes_profile recorded for the same RPCs.
+
+        Both see the request's RPCs in the order they were made, but appstats
+        also records those made by the request's other threads, so the traces
+        are paired in order by their service call names."""
+        recorder = self.sizes_profile and self.sizes_profile.recorder
+        if not recorder:
+            return {}
+
+        sized_traces = {}
+        sized = recorder.traces
+        next_sized = 0
+        for index, trace in enumerate(self.recorder.traces):
+            service_call_name = trace.service_call_name()
+            for i in xrange(next_sized, len(sized)):
+                if sized[i].service_call_name() == service_call_name:
+                    sized_traces[index] = sized[i]
+                    next_sized = i + 1
+                    break
+        return sized_traces
+
+    def results(self, wall_time_ms=None):
+        """Return appstats results in a dictionary for template context.
+
+        wall_time_ms is how long the request took, if known, to work out how
+        much of it no RPC was in flight for.
+        """
         if not self.recorder:
             # If appstats fails to initialize for any reason, return an empty
             # set of results.
@@ -34,53 +569,95 @@ class Profile(object):
             return {
                 "calls": [],
                 "total_time": 0,
+                "batchable": [],
+                "summarized_call_sites": [],
+                "call_site_bytes": [],
+                "datastore_ledger": None,
             }
 
         total_call_count = 0
-        total_time = 0
         calls = []
         service_totals_dict = {}
         likely_dupes = False
-        end_offset_last = 0
+
+        # (start ms, end ms) of each RPC, overall and by service prefix
+        intervals = []
+        service_intervals = {}
 
         requests_set = set()
 
-        appstats_key = long(self.recorder.start_timestamp * 1000)
+        # (service call name, request shape, call stack, start ms, ms) for
+        # finding batchable RPCs
+        rpcs = []
 
-        for trace in self.recorder.traces:
-            total_call_count += 1
+        # Index in calls of each RPC in rpcs, or None if it was only counted
+        call_indexes = []
+
+        # (service call name, call stack) -> number of RPCs, and the request
+        # shape of the first one, which RPCs that are only counted are
+        # assumed to share
+        site_call_counts = {}
+        site_shapes = {}
 
-            total_time += trace.duration_milliseconds()
+        # (service call name, call stack) -> [request bytes, response bytes,
+        # largest response bytes], for the RPCs whose sizes are known
+        site_bytes = {}
 
-            # Don't accumulate total RPC time for traces that overlap asynchronously
-            if trace.start_offset_milliseconds() < end_offset_last:
-                total_time -= (end_offset_last - trace.start_offset_milliseconds())
-            end_offset_last = trace.start_offset_milliseconds() + trace.duration_milliseconds()
+        appstats_key = long(self.recorder.start_timestamp * 1000)
+
+        sized_traces = self.sized_traces()
 
-            service_prefix = trace.service_call_name()
+        for index, trace in enumerate(self.recorder.traces):
+            total_call_count += 1
 
-            if "." in service_prefix:
-                service_prefix = service_prefix[:service_prefix.find(".")]
+            prefix = service_prefix(trace.service_call_name())
 
-            if service_prefix not in service_totals_dict:
-                service_totals_dict[service_prefix] = {
+            interval = (trace.start_offset_milliseconds(),
+                        trace.start_offset_milliseconds() + trace.duration_milliseconds())
+            intervals.append(interval)
+            service_intervals.setdefault(prefix, []).append(interval)
+
+            if prefix not in service_totals_dict:
+                service_totals_dict[prefix] = {
                     "total_call_count": 0,
                     "total_time": 0,
-                    "total_misses": 0,
+                    "total_request_bytes": None,
+                    "total_response_bytes": None,
                 }
 
-            service_totals_dict[service_prefix]["total_call_count"] += 1
-            service_totals_dict[service_prefix]["total_time"] += trace.duration_milliseconds()
+            service_totals_dict[prefix]["total_call_count"] += 1
+            service_totals_dict[prefix]["total_time"] += trace.duration_milliseconds()
+
+            stack_frames_desc = self.call_site(trace)
+            site = (trace.service_call_name(), stack_frames_desc)
+            site_call_counts[site] = site_call_counts.get(site, 0) + 1
+
+            request_bytes, response_bytes = rpc_sizes(
+                trace, sized_traces.get(index))
+            if request_bytes is not None or response_bytes is not None:
+                service_total = service_totals_dict[prefix]
+                sizes = site_bytes.setdefault(site, [0, 0, 0])
+                if request_bytes is not None:
+                    service_total["total_request_bytes"] = (
+                        (service_total["total_request_bytes"] or 0) + request_bytes)
+                    sizes[0] += request_bytes
+                if response_bytes is not None:
+                    service_total["total_response_bytes"] = (
+                        (service_total["total_response_bytes"] or 0) + response_bytes)
+                    sizes[1] += response_bytes
+                    sizes[2] = max(sizes[2], response_bytes)
 
-            stack_frames_desc = []
-            for frame in trace.call_stack_list():
-                stack_frames_desc.append("%s:%s %s" %
-                        (util.short_rpc_file_fmt(frame.class_or_file_name()),
-                            frame.line_number(),
-                            frame.function_name()))
+            if (self.detailed_calls_per_site is not None and
+                    site_call_counts[site] > self.detailed_calls_per_site):
+                # Past this call site's quota, just count the RPC.
+                rpcs.append((site[0], site_shapes.get(site, ""), stack_frames_desc,
+                             trace.start_offset_milliseconds(),
+                             trace.duration_milliseconds()))
+                call_indexes.append(None)
+                continue
 
-            request = trace.request_data_summary()
-            response = trace.response_data_summary()
+            request = trace.request_data_summary()[:self.repr_limit]
+            response = trace.response_data_summary()[:self.repr_limit]
 
             # GetSystemStatsRequest is time-dependent, so repeated calls are
             # likely intentional for profiling purposes.  In particular, the
@@ -90,53 +667,135 @@ class Profile(object):
             likely_dupes = likely_dupes or likely_dupe
             requests_set.add(request)
 
-            request_short = request_pretty = None
-            response_short = response_pretty = None
-            miss = 0
-            try:
-                request_object = unformatter.unformat(request)
-                response_object = unformatter.unformat(response)
-
-                request_short, response_short, miss = cleanup.cleanup(request_object, response_object)
-
-                request_pretty = pformat(request_object)
-                response_pretty = pformat(response_object)
-            except Exception, e:
-                pass
-                # enable this if you want to improve prettification
-                # logging.warning("Prettifying RPC calls failed.\n%s\nRequest: %s\nResponse: %s",
-                #     e, request, response, exc_info=True)
-
-            service_totals_dict[service_prefix]["total_misses"] += miss
+            shape = request_shape(request)
+            site_shapes.setdefault(site, shape)
+            rpcs.append((trace.service_call_name(), shape, stack_frames_desc,
+                         trace.start_offset_milliseconds(),
+                         trace.duration_milliseconds()))
+            call_indexes.append(len(calls))
 
+            # The readable versions of request and response are filled in by
+            # prettify() when the RPCs are looked at.
             calls.append({
                 "service": trace.service_call_name(),
                 "start_offset": util.milliseconds_fmt(trace.start_offset_milliseconds()),
                 "total_time": util.milliseconds_fmt(trace.duration_milliseconds()),
-                "request": request_pretty or request,
-                "response": response_pretty or response,
-                "request_short": request_short or cleanup.truncate(request),
-                "response_short": response_short or cleanup.truncate(response),
-                "stack_frames_desc": stack_frames_desc,
+                "request": request,
+                "response": response,
+                "request_short": cleanup.truncate(request),
+                "response_short": cleanup.truncate(response),
+                "stack_frames_desc": list(stack_frames_desc),
+                "request_kb": _kilobytes_fmt(request_bytes),
+                "response_kb": _kilobytes_fmt(response_bytes),
                 "likely_dupe": likely_dupe,
+                "batchable_index": None,
+                "on_critical_path": False,
+            })
+
+        # Asynchronous RPCs overlap, so the time spent in RPCs is the union of
+        # the times they were in flight.
+        stats = interval_stats(intervals)
+
+        # Time on the critical path, overall and by service prefix
+        critical_path_time = 0
+        service_critical_path_time = {}
+        for index in critical_path(intervals):
+            if call_indexes[index] is not None:
+                calls[call_indexes[index]]["on_critical_path"] = True
+            start, end = intervals[index]
+            prefix = service_prefix(rpcs[index][0])
+            critical_path_time += end - start
+            service_critical_path_time[prefix] = (
+                service_critical_path_time.get(prefix, 0) + end - start)
+
+        batchable = []
+        batchable_savings = 0
+        for batchable_index, run in enumerate(batchable_runs(rpcs)):
+            service, shape, stack_frames_desc = rpcs[run[0]][:3]
+            savings = estimated_savings(rpcs, run)
+            batchable_savings += savings
+            for index in run:
+                if call_indexes[index] is not None:
+                    calls[call_indexes[index]]["batchable_index"] = batchable_index
+            batchable.append({
+                "service": service,
+                "suggestion": _BATCH_SUGGESTIONS.get(service, "async RPCs"),
+                "request_shape": cleanup.truncate(shape),
+                "call_count": len(run),
+                "total_time": util.milliseconds_fmt(
+                    sum(rpcs[index][4] for index in run)),
+                "estimated_savings": util.milliseconds_fmt(savings),
+                "stack_frames_desc": list(stack_frames_desc),
+            })
+
+        # The call sites with RPCs that were only counted
+        summarized_call_sites = []
+        if self.detailed_calls_per_site is not None:
+            site_times = {}
+            for service, _, stack_frames_desc, _, duration in rpcs:
+                site = (service, stack_frames_desc)
+                site_times[site] = site_times.get(site, 0) + duration
+            for site, call_count in site_call_counts.iteritems():
+                if call_count > self.detailed_calls_per_site:
+                    summarized_call_sites.append({
+                        "service": site[0],
+                        "stack_frames_desc": list(site[1]),
+                        "call_count": call_count,
+                        "summarized_call_count": call_count - self.detailed_calls_per_site,
+                        "total_time": util.milliseconds_fmt(site_times[site]),
+                    })
+            summarized_call_sites.sort(reverse=True,
+                                       key=lambda site: site["call_count"])
+
+        # The call sites whose RPCs moved the most bytes
+        call_site_bytes = []
+        for site in sorted(site_bytes, reverse=True,
+                           key=lambda site: site_bytes[site][0] + site_bytes[site][1]
+                           )[:MAX_BYTES_CALL_SITES]:
+            request_bytes, response_bytes, max_response_bytes = site_bytes[site]
+            call_site_bytes.append({
+                "service": site[0],
+                "stack_frames_desc": list(site[1]),
+                "call_count": site_call_counts[site],
+                "request_kb": util.kilobytes_fmt(request_bytes),
+                "response_kb": util.kilobytes_fmt(response_bytes),
+                "max_response_kb": util.kilobytes_fmt(max_response_bytes),
             })
 
         service_totals = []
-        for service_prefix in service_totals_dict:
+        for prefix in service_totals_dict:
+            service_stats = interval_stats(service_intervals[prefix])
             service_totals.append({
-                "service_prefix": service_prefix,
-                "total_call_count": service_totals_dict[service_prefix]["total_call_count"],
-                "total_misses": service_totals_dict[service_prefix]["total_misses"],
-                "total_time": util.milliseconds_fmt(service_totals_dict[service_prefix]["total_time"]),
+                "service_prefix": prefix,
+                "total_call_count": service_totals_dict[prefix]["total_call_count"],
+                "total_time": util.milliseconds_fmt(service_totals_dict[prefix]["total_time"]),
+                "total_request_kb": _kilobytes_fmt(service_totals_dict[prefix]["total_request_bytes"]),
+                "total_response_kb": _kilobytes_fmt(service_totals_dict[prefix]["total_response_bytes"]),
+                "union_time": util.milliseconds_fmt(service_stats["union_time"]),
+                "max_concurrency": service_stats["max_concurrency"],
+                "average_concurrency": util.decimal_fmt(service_stats["average_concurrency"], 1),
+                "critical_path_time": util.milliseconds_fmt(
+                    service_critical_path_time.get(prefix, 0)),
             })
         service_totals = sorted(service_totals, reverse=True, key=lambda service_total: float(service_total["total_time"]))
 
         return  {
                     "total_call_count": total_call_count,
-                    "total_time": util.milliseconds_fmt(total_time),
+                    "total_time": util.milliseconds_fmt(stats["union_time"]),
+                    "max_concurrency": stats["max_concurrency"],
+                    "average_concurrency": util.decimal_fmt(stats["average_concurrency"], 1),
+                    "critical_path_time": util.milliseconds_fmt(critical_path_time),
+                    "uncovered_time": (util.milliseconds_fmt(max(0, wall_time_ms - stats["union_time"]))
+                                       if wall_time_ms is not None else None),
                     "calls": calls,
                     "service_totals": service_totals,
                     "likely_dupes": likely_dupes,
+                    "batchable": batchable,
+                    "batchable_savings": util.milliseconds_fmt(batchable_savings),
+                    "summarized_call_sites": summarized_call_sites,
+                    "call_site_bytes": call_site_bytes,
+                    "datastore_ledger": datastore_ledger(self.recorder.traces,
+                                                         sized_traces),
                     "appstats_key": appstats_key,
                 }
 
@@ -149,10 +808,25 @@ class Profile(object):
             new WSGI application that will run the original app with appstats
                 enabled.
         """
+        # Imported here because rpc_hook_profiler imports this module.
+        import rpc_hook_profiler
+
+        # Appstats' limits are settings for the whole process, so they're
+        # only ever raised to what a request asks for. This request's own
+        # limits are applied in results().
+        if recording.config.MAX_REPR < self.repr_limit:
+            recording.config.MAX_REPR = self.repr_limit
+
+        # Keeping no stack and no RPC in full, this only times and sizes each
+        # RPC and counts datastore operations.
+        self.sizes_profile = rpc_hook_profiler.Profile(
+            stack_depth=0, detailed_calls_per_site=0)
+        sized_app = self.sizes_profile.wrap(app)
+
         def wrapped_appstats_app(environ, start_response):
             # Use this wrapper to grab the app stats recorder for RequestStats.save()
             if recording.recorder_proxy.has_recorder_for_current_request():
                 self.recorder = recording.recorder_proxy.get_for_current_request()
-            return app(environ, start_response)
+            return sized_app(environ, start_response)
 
         return recording.appstats_wsgi_middleware(wrapped_appstats_app)
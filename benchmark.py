@@ -0,0 +1,337 @@
+# TODO(colin): fix these lint errors (http://pep8.readthedocs.io/en/release-1.7.x/intro.html#error-codes)
+# pep8-disable:E302,E501
+"""Measures the profiler's overhead.
+
+Run it with the App Engine SDK on the path, from the directory that contains
+gae_mini_profiler:
+    python -m gae_mini_profiler.benchmark [benchmark] [arguments]
+
+The benchmarks are:
+    middleware [requests per measurement]
+        For requests that aren't profiled and for each profiler mode, serves
+        responses of 1 and CHUNKS chunks through ProfilerWSGIMiddleware and
+        straight from the app, and reports the difference per request and per
+        extra chunk. This is the default.
+    linebyline
+        Times formatting the line-by-line results of many functions in a
+        large module, with and without their source blocks cached.
+    rpc [RPCs per request]
+        Times a request that makes many memcache RPCs to a stub that does
+        nothing with no RPC profiler, with rpc_hook_profiler and with
+        appstats_profiler, and how long each takes to report its results.
+    appstats_lock [threads] [requests per thread]
+        A stress test rather than a benchmark: checks that AppstatsLock only
+        lets threads serving profiled requests skip appstats' lock while many
+        threads start and end requests at once.
+    unformatter [repetitions]
+        Times unformatting the example RPC summaries and a large synthetic
+        one.
+"""
+
+import os
+import sys
+import time
+import timeit
+
+import config
+import profiler
+
+CHUNKS = 100
+REQUESTS = 200
+
+def app(environ, start_response):
+    """A WSGI app that streams int(environ["CHUNKS"]) small chunks."""
+    start_response("200 OK", [("Content-Type", "text/plain")])
+    for _ in xrange(int(environ["CHUNKS"])):
+        yield "x" * 64
+
+def start_response(status, headers, exc_info=None):
+    pass
+
+def seconds_per_request(wsgi_app, mode, chunks, requests):
+    """Return the mean time wsgi_app takes to serve a response in chunks."""
+    environ = {
+        "PATH_INFO": "/benchmark",
+        "QUERY_STRING": "",
+        "REQUEST_METHOD": "GET",
+        "CHUNKS": str(chunks),
+    }
+    if mode:
+        environ["HTTP_G_M_P_MODE"] = mode
+
+    start = time.time()
+    for _ in xrange(requests):
+        result = wsgi_app(dict(environ), start_response)
+        for _ in result:
+            pass
+        if hasattr(result, "close"):
+            result.close()
+    return (time.time() - start) / requests
+
+def overhead(mode, requests):
+    """Return the middleware's (seconds per request, seconds per chunk)."""
+    middleware = profiler.ProfilerWSGIMiddleware(app)
+    one, many = [
+        seconds_per_request(middleware, mode, chunks, requests) -
+        seconds_per_request(app, mode, chunks, requests)
+        for chunks in (1, CHUNKS)]
+    return one, (many - one) / (CHUNKS - 1)
+
+def middleware(requests=REQUESTS):
+    """Print the middleware's overhead in each mode."""
+    from google.appengine.ext import testbed
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.init_memcache_stub()
+    bed.init_datastore_v3_stub()
+
+    modes = sorted(value for name, value in vars(profiler.Mode).items()
+                   if name.isupper())
+
+    should_profile = config.should_profile
+    try:
+        print "%-26s %12s %12s" % ("mode", "us/request", "us/chunk")
+        config.should_profile = lambda: False
+        for mode in [None] + modes:
+            if mode:
+                config.should_profile = lambda: True
+            per_request, per_chunk = overhead(mode, requests)
+            print "%-26s %12.1f %12.2f" % (
+                mode or "(not profiled)",
+                per_request * 1000000, per_chunk * 1000000)
+    finally:
+        config.should_profile = should_profile
+        bed.deactivate()
+
+def linebyline(function_count=2000, marked_every=5, number=5):
+    """Time formatting the line-by-line results of every marked_every'th
+    function of a generated module with function_count functions."""
+    import linecache
+    import shutil
+    import tempfile
+
+    import linebyline_profiler
+
+    directory = tempfile.mkdtemp()
+    filename = os.path.join(directory, "large_module.py")
+    lines = []
+    timings = {}
+    for i in xrange(function_count):
+        start_lineno = len(lines) + 1
+        lines.append("def f%d(x):\n" % i)
+        lines.extend("    x += %d\n" % j for j in xrange(12))
+        lines.append("    return x\n\n")
+        if i % marked_every == 0:
+            timings[(filename, start_lineno, "f%d" % i)] = [
+                (start_lineno + j, 3, 10 * j) for j in xrange(1, 14, 2)]
+    f = open(filename, "w")
+    f.writelines(lines)
+    f.close()
+
+    line_stats = linebyline_profiler.LineStats(timings=timings, unit=1e-6)
+    process_line_stats = linebyline_profiler._process_line_stats
+    try:
+        times = []
+        for _ in xrange(number):
+            linebyline_profiler._source_blocks.clear()
+            linecache.clearcache()
+            start = timeit.default_timer()
+            process_line_stats(line_stats)
+            times.append(timeit.default_timer() - start)
+        print "%d of %d functions (%d lines), uncached: %.1f ms" % (
+            len(timings), function_count, len(lines), min(times) * 1000)
+
+        seconds = min(timeit.repeat(
+            lambda: process_line_stats(line_stats),
+            number=number, repeat=3)) / number
+        print "%d of %d functions (%d lines), cached: %.1f ms" % (
+            len(timings), function_count, len(lines), seconds * 1000)
+    finally:
+        shutil.rmtree(directory)
+
+def unformatter(number=20):
+    """Time unformat on the examples and on a large synthetic payload."""
+    import unformatter
+
+    f = open(os.path.join(os.path.dirname(unformatter.__file__),
+                          "examples.txt"), "r")
+    examples = [line.strip() for line in f]
+    f.close()
+
+    entity = ("EntityProto<key_=Reference<app_='s~example', path_=Path<"
+              "element_=[Path_Element<type_='Model', id_=%dL>]>>, "
+              "property_=[Property<name_='value', multiple_=False, "
+              "value_=PropertyValue<stringvalue_='%s'>>]>")
+    large = "GetResponse<entity_=[%s]>" % ", ".join(
+        "GetResponse_Entity<entity_=%s>" % (entity % (i, "x" * 20))
+        for i in xrange(500))
+
+    for name, texts in (("examples", examples), ("large", [large])):
+        seconds = min(timeit.repeat(
+            lambda: [unformatter.unformat(text) for text in texts],
+            number=number, repeat=3)) / number
+        print "%s (%d chars): %.2f ms" % (
+            name, sum(len(text) for text in texts), seconds * 1000)
+
+def rpc(rpc_count=1000, number=5):
+    """Time rpc_count memcache RPCs to a do-nothing stub with no RPC profiler,
+    with rpc_hook_profiler, and with appstats_profiler, capturing what
+    config.rpc_capture_options() says to."""
+    from google.appengine.api import apiproxy_stub_map
+    from google.appengine.api.memcache import memcache_service_pb
+    from google.appengine.ext import testbed
+
+    import appstats_profiler
+    import rpc_hook_profiler
+
+    class NoopStub(object):
+        def MakeSyncCall(self, service, call, request, response):
+            pass
+
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.init_memcache_stub()
+    apiproxy_stub_map.apiproxy.RegisterStub("gmp_benchmark", NoopStub())
+    # The testbed's API proxy doesn't have the hooks appstats added to the
+    # one it replaced when appstats was imported.
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+        "appstats", appstats_profiler.recording.pre_call_hook)
+    apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+        "appstats", appstats_profiler.recording.post_call_hook)
+
+    # Appstats keeps one recorder per REQUEST_ID_HASH, and only records a
+    # request if it can take its lock, which the profiler's middleware
+    # lets it skip.
+    os.environ.setdefault("REQUEST_ID_HASH", "gmp_benchmark")
+    profiler.AppstatsLock.install()
+    profiler.AppstatsLock.set_skipped(True)
+
+    def app(environ, start_response):
+        for i in xrange(rpc_count):
+            request = memcache_service_pb.MemcacheGetRequest()
+            request.add_key("key%d" % i)
+            apiproxy_stub_map.MakeSyncCall(
+                "gmp_benchmark", "Get", request,
+                memcache_service_pb.MemcacheGetResponse())
+        start_response("200 OK", [])
+        return ["ok"]
+
+    def run(wrap):
+        """Return the shortest times taken to serve a request with the app
+        wrapped by wrap, and to get the results of its profile."""
+        environ = {"REQUEST_METHOD": "GET", "PATH_INFO": "/",
+                   "QUERY_STRING": "", "SERVER_NAME": "localhost",
+                   "SERVER_PORT": "80", "wsgi.url_scheme": "http"}
+        times = []
+        results_times = []
+        for _ in xrange(number):
+            profile, wrapped_app = wrap()
+            start = time.time()
+            list(wrapped_app(environ, lambda status, headers, exc_info=None: None))
+            times.append(time.time() - start)
+            if profile:
+                start = time.time()
+                results = profile.results()
+                results_times.append(time.time() - start)
+                assert results["total_call_count"] == rpc_count
+        return min(times), min(results_times or [0])
+
+    def profiled(profile_class):
+        def wrap():
+            profile = profile_class(**config.rpc_capture_options())
+            return profile, profile.wrap(app)
+        return wrap
+
+    try:
+        baseline, _ = run(lambda: (None, app))
+        print "no RPC profiler: %.1f ms" % (baseline * 1000)
+        for name, profile_class in (
+                ("rpc_hook_profiler", rpc_hook_profiler.Profile),
+                ("appstats_profiler", appstats_profiler.Profile)):
+            seconds, results_seconds = run(profiled(profile_class))
+            print "%s: %.1f ms (%.1f us per RPC), results(): %.1f ms" % (
+                name, seconds * 1000,
+                (seconds - baseline) * 1000000 / rpc_count,
+                results_seconds * 1000)
+    finally:
+        profiler.AppstatsLock.set_skipped(False)
+        bed.deactivate()
+
+def appstats_lock(thread_count=32, iterations=2000):
+    """Check that AppstatsLock only ever skips the appstats lock on threads
+    serving profiled requests, while thread_count threads start and end
+    profiled and unprofiled requests at once.
+
+    Exits with status 1 if it doesn't."""
+    import threading
+
+    from google.appengine.api import memcache
+    from google.appengine.ext import testbed
+    from google.appengine.ext.appstats import recording
+
+    AppstatsLock = profiler.AppstatsLock
+
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.init_memcache_stub()
+    memcache_add = memcache.add
+    errors = []
+
+    def serve(profiled):
+        for _ in xrange(iterations):
+            AppstatsLock.install()
+            AppstatsLock.set_skipped(profiled)
+            # Every profiled request gets the lock, even while another
+            # request holds it; unprofiled ones have to wait for it as usual.
+            got_lock = recording.memcache.add(recording.lock_key(), 0)
+            if got_lock != profiled:
+                errors.append("%s request %s the lock" % (
+                    "profiled" if profiled else "unprofiled",
+                    "got" if got_lock else "didn't get"))
+            if got_lock:
+                recording.memcache.delete(recording.lock_key())
+            if AppstatsLock.is_skipped() != profiled:
+                errors.append("request saw another thread's lock setting")
+            AppstatsLock.set_skipped(False)
+
+    # One unprofiled request holds the real lock throughout.
+    memcache.add(recording.lock_key(), 0)
+    threads = [threading.Thread(target=serve, args=(i % 2 == 0,))
+               for i in xrange(thread_count)]
+    start = time.time()
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        bed.deactivate()
+
+    if memcache.add is not memcache_add:
+        errors.append("memcache.add was patched")
+    if AppstatsLock._skipped_threads:
+        errors.append("threads left skipping the lock: %s" %
+                      AppstatsLock._skipped_threads)
+
+    print "%d threads x %d requests in %.1f s: %s" % (
+        thread_count, iterations, time.time() - start,
+        "%d errors, e.g. %s" % (len(errors), errors[0]) if errors else "ok")
+    if errors:
+        sys.exit(1)
+
+BENCHMARKS = {
+    "middleware": middleware,
+    "linebyline": linebyline,
+    "unformatter": unformatter,
+    "rpc": rpc,
+    "appstats_lock": appstats_lock,
+}
+
+def main(args):
+    name = "middleware"
+    if args and args[0] in BENCHMARKS:
+        name, args = args[0], args[1:]
+    BENCHMARKS[name](*[int(arg) for arg in args])
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
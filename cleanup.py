@@ -1,37 +1,228 @@
 # TODO(colin): fix these lint errors (http://pep8.readthedocs.io/en/release-1.7.x/intro.html#error-codes)
 # pep8-disable:E265,E302,E501
+import re
 import StringIO
 
-def cleanup(request, response):
+def cleanup(request, response, service_call_name=None):
     '''
     Convert request and response dicts to a human readable format where
-    possible.
+    possible. service_call_name is the RPC's "service.Call" name, which
+    tells apart RPCs whose requests look the same, like datastore commits
+    and rollbacks.
+
+    Returns the tuple (request_short, response_short, miss, counts), where
+    "miss" is 1 if the RPC was a memcache.get() that found nothing and
+    "counts" is a dict with whichever of these the RPC has:
+      entities - the number of entities read or written
+      keys - the number of keys looked up, written, deleted or allocated
+      hits, misses - how many of the memcache or datastore keys looked up
+        were and weren't found
+      tasks - the number of tasks added
+      memcache_prefixes - {key prefix: [hits, misses]} for memcache.get()s,
+        see memcache_key_prefix()
     '''
     request_short = None
     response_short = None
     miss = 0
+    counts = {}
+    if not isinstance(response, dict):
+        response = {}
 
     if "MemcacheGetRequest" in request:
         request = request["MemcacheGetRequest"]
-        response = response["MemcacheGetResponse"]
+        if "MemcacheGetResponse" in response:
+            response = response["MemcacheGetResponse"]
+            counts = memcache_get_counts(request, response)
+        else:
+            # Without the response we can't tell which keys were found.
+            response = None
+            counts = {"keys": len(repeated(request, 'key'))}
         if request:
             request_short = memcache_get(request)
         if response:
             response_short, miss = memcache_get_response(response)
     elif "MemcacheSetRequest" in request and request["MemcacheSetRequest"]:
         request_short = memcache_set(request["MemcacheSetRequest"])
+        counts = {"keys": len(repeated(request["MemcacheSetRequest"], "item"))}
+    elif "MemcacheDeleteRequest" in request and request["MemcacheDeleteRequest"]:
+        request_short = memcache_delete(request["MemcacheDeleteRequest"])
+        response_short, counts = memcache_delete_response(
+            request["MemcacheDeleteRequest"],
+            response.get("MemcacheDeleteResponse"))
+    elif "MemcacheIncrementRequest" in request and request["MemcacheIncrementRequest"]:
+        request_short = memcache_increment(request["MemcacheIncrementRequest"])
+        if "MemcacheIncrementResponse" in response:
+            response_short, counts = memcache_increment_response(
+                [response["MemcacheIncrementResponse"]])
+    elif ("MemcacheBatchIncrementRequest" in request and
+            request["MemcacheBatchIncrementRequest"]):
+        increments = [item_fields(item) for item in repeated(
+            request["MemcacheBatchIncrementRequest"], "item")]
+        request_short = "\n".join(memcache_increment(i) for i in increments)
+        response_short, counts = memcache_increment_response(
+            [item_fields(item) for item in repeated(
+                response.get("MemcacheBatchIncrementResponse"), "item")])
     elif "Query" in request and request["Query"]:
         request_short = datastore_query(request["Query"])
+        counts = {"entities": len(repeated(response.get("QueryResult"),
+                                           "result"))}
     elif "GetRequest" in request and request["GetRequest"]:
+        counts = datastore_get_counts(request["GetRequest"],
+                                      response.get("GetResponse"))
         request_short = datastore_get(request["GetRequest"])
     elif "PutRequest" in request and request["PutRequest"]:
         request_short = datastore_put(request["PutRequest"])
-    # todo:
-    # TaskQueueBulkAddRequest
-    # BeginTransaction
-    # Transaction
+        counts = {
+            "entities": len(repeated(request["PutRequest"], "entity")),
+            "keys": len(repeated(response.get("PutResponse"), "key")),
+        }
+    elif "DeleteRequest" in request and request["DeleteRequest"]:
+        counts = {"keys": len(repeated(request["DeleteRequest"], "key"))}
+        request_short = datastore_get(request["DeleteRequest"])
+    elif "BeginTransactionRequest" in request:
+        request_short, response_short = datastore_begin_transaction(
+            request["BeginTransactionRequest"], response.get("Transaction"))
+    elif service_call_name in _END_TRANSACTION_STATEMENTS:
+        request_short = datastore_end_transaction(
+            request.get("Transaction") if isinstance(request, dict) else None,
+            _END_TRANSACTION_STATEMENTS[service_call_name])
+    elif "AllocateIdsRequest" in request and request["AllocateIdsRequest"]:
+        request_short, response_short, counts = datastore_allocate_ids(
+            request["AllocateIdsRequest"], response.get("AllocateIdsResponse"))
+    elif "TaskQueueBulkAddRequest" in request and request["TaskQueueBulkAddRequest"]:
+        request_short, response_short, counts = taskqueue_bulk_add(
+            request["TaskQueueBulkAddRequest"],
+            response.get("TaskQueueBulkAddResponse"))
+    elif "URLFetchRequest" in request and request["URLFetchRequest"]:
+        request_short, response_short = urlfetch(
+            request["URLFetchRequest"], response.get("URLFetchResponse"))
+
+    return request_short, response_short, miss, counts
+
+# Commit and Rollback both take just the transaction, so they're told apart
+# by their method.
+_END_TRANSACTION_STATEMENTS = {
+    "datastore_v3.Commit": "COMMIT",
+    "datastore_v3.Rollback": "ROLLBACK",
+}
+
+def counts_desc(counts):
+    """Describe cleanup()'s counts of an RPC, e.g. "3 keys, 2 hits, 1 miss"."""
+    parts = []
+    for name, singular in (("entities", "entity"), ("keys", "key"),
+                           ("hits", "hit"), ("misses", "miss"),
+                           ("tasks", "task")):
+        if name in counts:
+            parts.append("%d %s" % (counts[name], singular if counts[name] == 1
+                                    else name))
+    return ", ".join(parts)
+
+def repeated(message, field):
+    """Return the values of a message's repeated field.
+
+    Appstats cuts long summaries short, so the message or the field might
+    just be '...', and so might the last of its values. Those are left out,
+    so anything counted from them is a lower bound.
+    """
+    if not isinstance(message, dict):
+        return []
+    values = message.get(field, [])
+    if not isinstance(values, list):
+        values = [values]
+    return [value for value in values if value != '...']
+
+def item_fields(item):
+    """Return the fields of an element of a repeated message field.
+
+    The elements are dicts with just one key, which is the element's message
+    type, e.g. {'MemcacheSetRequest_Item': {'key': ...}} in dev and the
+    'python' production runtime, but {'Item': {'key': ...}} in the
+    'python27' production runtime.
+    """
+    if isinstance(item, dict) and len(item) == 1:
+        fields = item.values()[0]
+        if isinstance(fields, dict):
+            return fields
+    return {}
+
+# The leading part of a memcache key that names what's cached: a name of at
+# least two letters, underscores and hyphens, ended by a separator (which is
+# included), a digit or the end of the key, e.g. "user_settings:" in
+# "user_settings:1234" or "__layer_cache_models." in
+# "__layer_cache_models._get_settings_dict__".
+_MEMCACHE_KEY_PREFIX = re.compile(r"[A-Za-z_][A-Za-z_-]+(?:[.:/|@#]|(?=\d)|$)")
+
+def memcache_key_prefix(key):
+    """Return the prefix that a memcache key is rolled up under, or
+    "(no prefix)" if it doesn't start with a name, e.g. if it's an ID."""
+    match = _MEMCACHE_KEY_PREFIX.match(key)
+    return match.group(0) if match else "(no prefix)"
+
+def memcache_get_counts(request, response):
+    """Count the keys of a memcache.get() that were and weren't found.
 
-    return request_short, response_short, miss
+    A key counts as found if an item came back with the same key.
+    """
+    keys = [key for key in repeated(request, 'key') if isinstance(key, str)]
+    found = set(item_fields(item).get('key')
+                for item in repeated(response, 'item'))
+
+    counts = {"keys": len(keys), "hits": 0, "misses": 0,
+              "memcache_prefixes": {}}
+    for key in keys:
+        hit = key in found
+        counts["hits" if hit else "misses"] += 1
+        prefix_counts = counts["memcache_prefixes"].setdefault(
+            memcache_key_prefix(key), [0, 0])
+        prefix_counts[0 if hit else 1] += 1
+    return counts
+
+def memcache_delete_response(request, response):
+    """Pretty-format a memcache.delete() response and count the keys that
+    were deleted (hits) and that weren't there (misses).
+    """
+    _DeleteStatusCode_DELETED = 1
+    counts = {"keys": len(repeated(request, 'item'))}
+    statuses = repeated(response, 'delete_status')
+    if not statuses:
+        return None, counts
+    counts["hits"] = statuses.count(_DeleteStatusCode_DELETED)
+    counts["misses"] = len(statuses) - counts["hits"]
+    return "%(hits)d deleted, %(misses)d not found" % counts, counts
+
+def memcache_delete(request):
+    """Pretty-format a memcache.delete() request.
+
+    Returns:
+      The keys being deleted as a string. If there are multiple keys, they
+      are separated by newline characters.
+    """
+    return "\n".join(truncate(str(item_fields(item).get('key', '')))
+                     for item in repeated(request, 'item'))
+
+def memcache_increment(request):
+    """Pretty-format a memcache.incr() or decr() request, e.g. "counter +1"."""
+    _Direction_DECREMENT = 2
+    sign = "-" if request.get('direction') == _Direction_DECREMENT else "+"
+    return "%s %s%s" % (truncate(str(request.get('key', 'UnknownKey'))), sign,
+                        request.get('delta', 1))
+
+def memcache_increment_response(responses):
+    """Pretty-format the responses of memcache.incr() or decr() calls.
+
+    A key was found (a hit) if the response has its new value.
+    """
+    values = []
+    hits = 0
+    for response in responses:
+        if isinstance(response, dict) and 'new_value' in response:
+            values.append(str(response['new_value']))
+            hits += 1
+        else:
+            values.append("not found")
+    counts = {"keys": len(responses), "hits": hits,
+              "misses": len(responses) - hits}
+    return "\n".join(values), counts
 
 def memcache_get_response(response):
     """Pretty-format a memcache.get() response.
@@ -267,6 +458,194 @@ def datastore_put(request):
         keys.append(cleanup_key(entity["EntityProto"]["key"]))
     return "\n".join(keys)
 
+def datastore_get_counts(request, response):
+    """Count the entities a datastore get found (hits) and didn't (misses)."""
+    counts = {"entities": 0, "keys": len(repeated(request, 'key')),
+              "hits": 0, "misses": 0}
+    # Entities that weren't found come back without the entity.
+    for entity in repeated(response, 'entity'):
+        if 'entity' in item_fields(entity):
+            counts["entities"] += 1
+            counts["hits"] += 1
+        else:
+            counts["misses"] += 1
+    return counts
+
+# The datastore operations a request pays for, in the order they're listed
+# in its cost ledger:
+#   keys_fetched - keys looked up by gets
+#   entities_fetched - entities those gets found
+#   queries, keys_only_queries - queries run, which are each read once
+#   query_entities - entities returned by queries that aren't keys-only
+#   query_keys - keys returned by keys-only queries, which are small ops
+#   entities_written - entities put
+#   index_writes - index rows those puts and deletes wrote, estimated from
+#       the entities put unless the datastore said what they cost
+#   keys_deleted - entities deleted
+DATASTORE_LEDGER_FIELDS = [
+    "keys_fetched",
+    "entities_fetched",
+    "queries",
+    "keys_only_queries",
+    "query_entities",
+    "query_keys",
+    "entities_written",
+    "index_writes",
+    "keys_deleted",
+]
+
+def datastore_operations(call, request, response):
+    """Count the datastore operations of a datastore_v3 RPC, as a dict of
+    DATASTORE_LEDGER_FIELDS to counts.
+
+    Arguments:
+      call - The RPC's method, e.g. "Put".
+      request, response - The unformatted request and response, e.g.
+        {'PutRequest': {'entity': [...]}}. The response is None if the RPC
+        failed.
+
+    Returns:
+      The counts, which are lower bounds if appstats cut the request or
+      response short, and are empty for RPCs the ledger doesn't count.
+    """
+    if not isinstance(request, dict):
+        request = {}
+    if not isinstance(response, dict):
+        response = {}
+    operations = {}
+    if call == "Get":
+        counts = datastore_get_counts(request.get("GetRequest"),
+                                      response.get("GetResponse"))
+        operations["keys_fetched"] = counts["keys"]
+        operations["entities_fetched"] = counts["entities"]
+    elif call in ("RunQuery", "Next"):
+        keys_only = False
+        if call == "RunQuery":
+            query = request.get("Query")
+            keys_only = isinstance(query, dict) and bool(query.get('keys_only'))
+            operations["keys_only_queries" if keys_only else "queries"] = 1
+        result = response.get("QueryResult")
+        if isinstance(result, dict) and 'keys_only' in result:
+            keys_only = bool(result['keys_only'])
+        operations["query_keys" if keys_only else "query_entities"] = len(
+            repeated(result, 'result'))
+    elif call == "Put":
+        entities = repeated(request.get("PutRequest"), 'entity')
+        operations["entities_written"] = len(entities)
+        index_writes = datastore_index_writes(response.get("PutResponse"))
+        if index_writes is None:
+            index_writes = sum(
+                estimated_index_writes(len(repeated(item_fields(entity), 'property')))
+                for entity in entities)
+        operations["index_writes"] = index_writes
+    elif call == "Delete":
+        operations["keys_deleted"] = len(
+            repeated(request.get("DeleteRequest"), 'key'))
+        index_writes = datastore_index_writes(response.get("DeleteResponse"))
+        if index_writes is not None:
+            operations["index_writes"] = index_writes
+    return operations
+
+def datastore_index_writes(response):
+    """Return the index writes a put or delete response says it cost, or
+    None if it doesn't say."""
+    if isinstance(response, dict):
+        cost = item_fields(response.get('cost'))
+        if 'index_writes' in cost:
+            return int(cost['index_writes'])
+    return None
+
+def estimated_index_writes(indexed_value_count):
+    """Estimate the index rows that putting a new entity writes.
+
+    That's a row in the kind's index and one in each of the ascending and
+    descending indexes of every indexed property value, i.e. each of the
+    entity's properties that aren't raw properties. Composite indexes can't
+    be seen from the entity, so they aren't counted.
+    """
+    return 1 + 2 * indexed_value_count
+
+def datastore_begin_transaction(request, response):
+    if isinstance(request, dict) and request.get('allow_multiple_eg'):
+        request_short = "BEGIN CROSS-GROUP TRANSACTION"
+    else:
+        request_short = "BEGIN TRANSACTION"
+    response_short = None
+    if isinstance(response, dict) and 'handle' in response:
+        response_short = "transaction %s" % response['handle']
+    return request_short, response_short
+
+def datastore_end_transaction(transaction, statement):
+    if isinstance(transaction, dict) and 'handle' in transaction:
+        return "%s transaction %s" % (statement, transaction['handle'])
+    return statement
+
+def datastore_allocate_ids(request, response):
+    # The model key only says which kind (and parent) to allocate ids for.
+    request_short = "UnknownKind"
+    model_key = request.get('model_key')
+    if isinstance(model_key, dict) and 'Reference' in model_key:
+        els = model_key['Reference']['path']['Path']['element']
+        if els:
+            request_short = item_fields(els[-1]).get('type', request_short)
+    if 'size' in request:
+        request_short += " x%s" % request['size']
+    elif 'max' in request:
+        request_short += " up to %s" % request['max']
+
+    response_short = None
+    counts = {}
+    if isinstance(response, dict) and 'start' in response and 'end' in response:
+        response_short = "ids %s-%s" % (response['start'], response['end'])
+        counts["keys"] = max(int(response['end']) - int(response['start']) + 1, 0)
+    return request_short, response_short, counts
+
+def taskqueue_bulk_add(request, response):
+    """Pretty-format a taskqueue add, e.g. "default: POST /worker"."""
+    _RequestMethod_NAMES = {
+        1: "GET",
+        2: "POST",
+        3: "HEAD",
+        4: "PUT",
+        5: "DELETE",
+    }
+    tasks = []
+    for task in repeated(request, 'add_request'):
+        task = item_fields(task)
+        method = _RequestMethod_NAMES.get(task.get('method', 2), "?METHOD")
+        tasks.append("%s: %s %s" % (task.get('queue_name', 'default'), method,
+                                    truncate(str(task.get('url', '')))))
+
+    _ErrorCode_OK = 0
+    results = [item_fields(result).get('result', _ErrorCode_OK)
+               for result in repeated(response, 'taskresult')]
+    response_short = None
+    if results:
+        added = results.count(_ErrorCode_OK)
+        response_short = "%d added, %d failed" % (added, len(results) - added)
+    return "\n".join(tasks), response_short, {"tasks": len(tasks)}
+
+def urlfetch(request, response):
+    """Pretty-format a urlfetch, e.g. "POST http://example.com/" and its
+    response's status code."""
+    _RequestMethod_NAMES = {
+        1: "GET",
+        2: "POST",
+        3: "HEAD",
+        4: "PUT",
+        5: "DELETE",
+        6: "PATCH",
+    }
+    method = _RequestMethod_NAMES.get(request.get('Method', 1), "?METHOD")
+    request_short = "%s %s" % (method, truncate(str(request.get('Url', ''))))
+
+    response_short = None
+    if isinstance(response, dict) and 'StatusCode' in response:
+        response_short = str(response['StatusCode'])
+        if response.get('ContentWasTruncated'):
+            response_short += " (truncated)"
+    return request_short, response_short
+
 def truncate(value, limit=100):
     if len(value) > limit:
         return value[:limit - 3] + "..."
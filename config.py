@@ -1,6 +1,7 @@
 # TODO(colin): fix these lint errors (http://pep8.readthedocs.io/en/release-1.7.x/intro.html#error-codes)
 # pep8-disable:E302
 import os
+import re
 
 from google.appengine.api import lib_config
 
@@ -32,9 +33,137 @@ def _should_profile_development_default():
     Can be overridden in appengine_config.py"""
     return True
 
+# Rules for folding framework frames out of the sampling profiler's stack
+# traces. Each rule is a (matcher, action) pair. The matcher is either a
+# module name prefix or a compiled regex that is matched against the module
+# name of a frame's code. The action is either "drop", which removes matching
+# frames entirely, or "collapse", which replaces each run of consecutive
+# frames matched by the same rule with a single synthetic frame. The first
+# matching rule wins.
+#
+# Example:
+#   ...in appengine_config.py:
+#       def gae_mini_profiler_frame_folding_rules():
+#           import re
+#           return [("webapp2", "collapse"),
+#                   (re.compile(r"^third_party\."), "drop")]
+
+_package = __name__.rpartition(".")[0]
+
+def _frame_folding_rules_default():
+    """Default to collapsing the WSGI/appstats prefix of every request.
+
+    Can be overridden in appengine_config.py"""
+    rules = [
+        ("google.appengine.runtime", "collapse"),
+        ("google.appengine.ext.appstats", "collapse"),
+        ("google.appengine.ext.webapp", "collapse"),
+        ("webapp2", "collapse"),
+        ("webob", "collapse"),
+    ]
+    if _package:
+        # The profiler's own middleware and wrappers sit on every stack.
+        rules.append((re.compile(
+            r"^%s\.(?:profiler|sampling_profiler|rpc_hook_profiler)$" %
+            re.escape(_package)), "drop"))
+    return rules
+
+def _instrumented_module_prefixes_default():
+    """Default to profiling the app's own code in the filtered instrumented
+    mode, i.e. everything in the app's directory except gae_mini_profiler.
+
+    Can be overridden in appengine_config.py to return a list of module name
+    prefixes, e.g. ["main", "models", "api."]"""
+    return None
+
+def _traced_module_prefixes_default():
+    """Default to tracing the app's own code in the tracing mode, i.e.
+    everything in the app's directory except gae_mini_profiler.
+
+    Can be overridden in appengine_config.py to return a list of module name
+    prefixes, e.g. ["main", "models", "api."]"""
+    return None
+
+def _rpc_profiler_default():
+    """Default to recording RPCs with appstats in the RPC modes.
+
+    Can be overridden in appengine_config.py to return "hooks" to record RPCs
+    with rpc_hook_profiler's API proxy hooks instead, which adds much less
+    overhead per RPC but can't link to the appstats page for the request."""
+    return "appstats"
+
+def _rpc_capture_options_default():
+    """Default to keeping the innermost 10 frames of app code that made each
+    RPC, 750 characters of its request and response, and all of that for
+    only the first 50 RPCs from each call stack, just counting the rest.
+
+    Can be overridden in appengine_config.py to return a dict with any of
+    these options, e.g. to capture more detail for some requests:
+        stack_depth: most frames to keep of each RPC's call stack, or None
+            for all of them
+        skipped_frame_paths: frames whose file paths contain any of these
+            are left out of call stacks
+        repr_limit: most characters to keep of each RPC's request and
+            response summaries
+        detailed_calls_per_site: RPCs from the same call stack after this
+            many are only counted, or None to keep them all in full
+
+    The appstats profiler applies these to what appstats recorded when the
+    request's results are read, except that appstats' MAX_REPR is raised to
+    repr_limit. How much appstats itself records for each RPC is set by its
+    own appstats_* settings in appengine_config.py, e.g. appstats_MAX_STACK.
+
+    This is called once for every request that records RPCs."""
+    return {
+        "stack_depth": 10,
+        "skipped_frame_paths": ["google/appengine/"],
+        "repr_limit": 750,
+        "detailed_calls_per_site": 50,
+    }
+
+def _profiling_policy_default():
+    """Default to profiling every request should_profile allows, in the mode
+    picked by the user.
+
+    Can be overridden in appengine_config.py to return a dict with any of
+    these options, to bound the profiler's cost on each instance:
+        routes: list of (path prefix, rule) pairs, of which the first whose
+            prefix the request's path starts with applies. A rule is a dict
+            with sample_one_in, to profile only one in that many of the
+            route's requests at random, and mode, a profiler.Mode to profile
+            them in instead of the user's.
+        max_profiled_per_second: most requests to profile per second on
+            average
+        burst: most requests to profile in a burst after a quiet spell,
+            max_profiled_per_second unless given
+        max_concurrent_share: most share of max_concurrent_requests to
+            profile at the same time
+        max_concurrent_requests: the instance's max_concurrent_requests from
+            app.yaml, 10 unless given
+
+    e.g. to sample 1 in 10 API requests and record just the RPCs of 1 in 100
+    others, no more than 2 per second:
+        def gae_mini_profiler_profiling_policy():
+            return {
+                "routes": [("/api/", {"sample_one_in": 10,
+                                      "mode": "sampling"}),
+                           ("/", {"sample_one_in": 100, "mode": "rpc"})],
+                "max_profiled_per_second": 2,
+                "max_concurrent_share": 0.25,
+            }
+
+    This is called once per instance."""
+    return None
+
 _config = lib_config.register("gae_mini_profiler", {
     "should_profile_production": _should_profile_production_default,
-    "should_profile_development": _should_profile_development_default})
+    "should_profile_development": _should_profile_development_default,
+    "frame_folding_rules": _frame_folding_rules_default,
+    "instrumented_module_prefixes": _instrumented_module_prefixes_default,
+    "traced_module_prefixes": _traced_module_prefixes_default,
+    "rpc_profiler": _rpc_profiler_default,
+    "rpc_capture_options": _rpc_capture_options_default,
+    "profiling_policy": _profiling_policy_default})
 
 def should_profile():
     """Returns true if the current request should be profiles."""
@@ -42,3 +171,33 @@ def should_profile():
         return _config.should_profile_development()
     else:
         return _config.should_profile_production()
+
+def frame_folding_rules():
+    """Returns the rules used to fold frames out of sampled stack traces."""
+    return _config.frame_folding_rules()
+
+def instrumented_module_prefixes():
+    """Returns the module prefixes tracked by filtered instrumented profiling,
+    or None to track the app's own code."""
+    return _config.instrumented_module_prefixes()
+
+def traced_module_prefixes():
+    """Returns the module prefixes whose calls are recorded by the tracing
+    mode, or None to trace the app's own code."""
+    return _config.traced_module_prefixes()
+
+def rpc_profiler():
+    """Returns which RPC profiler the RPC modes use: "appstats" or "hooks"."""
+    return _config.rpc_profiler()
+
+def rpc_capture_options():
+    """Returns how much of each RPC to capture, as keyword arguments for the
+    RPC profilers."""
+    options = _rpc_capture_options_default()
+    options.update(_config.rpc_capture_options())
+    return options
+
+def profiling_policy():
+    """Returns the options for sampling and rate-limiting profiled requests,
+    or None to profile every request should_profile allows."""
+    return _config.profiling_policy()
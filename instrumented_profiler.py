@@ -16,57 +16,465 @@ get an idea for which functions are taking lots of time.
 CON: overhead is added to each function call due to this instrumentation. If
 you're profiling code with deeply nested function calls or tight loops going
 over lots of function calls, this perf overhead will add up.
+
+The filtered variant (FilteredProfiler) is a view of the same profile that
+only reports calls into selected modules, folding everything else into its
+caller and subtracting cProfile's calibrated per-call overhead, which keeps
+the timings of the code you care about closer to reality. Every call is
+still recorded, so it costs about as much as profiling everything.
 """
 
+import collections
 import cProfile
+import heapq
 import pstats
 import StringIO
 import marshal
-import base64
+import timeit
 
 import util
 
+# How many of the most expensive functions, by cumulative time and by own
+# time, to include in the results. Callers and callees aren't included at all;
+# they're looked up from the raw stats with call_graph() when asked for.
+TOP_N = 80
+
+def _func_desc(func_name):
+    func_desc = pstats.func_std_string(func_name)
+    return {"func_desc": func_desc, "func_desc_short": util.short_method_fmt(func_desc)}
+
+def _edge_call_count(edge):
+    return edge[0] if isinstance(edge, tuple) else edge
+
+def _edge_desc(func_name, edge):
+    """Describe one caller->callee edge of the cProfile stats.
+
+    cProfile records (call count, primitive call count, own time, cumulative
+    time) for each edge; the pure-Python profile module only the call count.
+    """
+    desc = _func_desc(func_name)
+    if isinstance(edge, tuple):
+        _, _, total_time, cumulative_time = edge
+        desc.update({
+            "call_count": _edge_call_count(edge),
+            "total_time": util.seconds_fmt(total_time, 2),
+            "cumulative_time": util.seconds_fmt(cumulative_time, 2),
+        })
+    else:
+        desc.update({
+            "call_count": edge,
+            "total_time": "",
+            "cumulative_time": "",
+        })
+    return desc
+
+def call_graph(raw_stats, func_desc):
+    """Return the callers and callees of a single function.
+
+    raw_stats is the marshaled cProfile stats returned by Profile.raw_stats()
+    and func_desc is the function's description as given in the results. If
+    no such function was profiled, returns None.
+    """
+    stats = marshal.loads(raw_stats)
+
+    func = None
+    for func_name in stats:
+        if pstats.func_std_string(func_name) == func_desc:
+            func = func_name
+            break
+    if func is None:
+        return None
+
+    callers = stats[func][4]
+    callees = [(callee, callee_stats[4][func])
+               for callee, callee_stats in stats.iteritems()
+               if func in callee_stats[4]]
+
+    by_call_count = lambda item: _edge_call_count(item[1])
+    return {
+        "func_desc": func_desc,
+        "callers": [_edge_desc(caller, edge) for caller, edge in
+                    sorted(callers.iteritems(), key=by_call_count, reverse=True)],
+        "callees": [_edge_desc(callee, edge) for callee, edge in
+                    sorted(callees, key=by_call_count, reverse=True)],
+    }
+
+def _callees(stats):
+    """Invert the callers in pstats-style stats into caller -> callee edges."""
+    callees = collections.defaultdict(dict)
+    for func_name, func_stats in stats.iteritems():
+        for caller, edge in func_stats[4].iteritems():
+            callees[caller][func_name] = edge
+    return callees
+
+def _microseconds(seconds):
+    return int(round(seconds * 1e6))
+
+def callgrind_results(raw_stats):
+    """Convert raw stats to the callgrind format read by (K|Q)Cachegrind.
+
+    See http://valgrind.org/docs/manual/cl-format.html. Costs are in
+    microseconds, and each call edge records its call count and the time spent
+    in the callee when called from that caller.
+    """
+    stats = marshal.loads(raw_stats)
+    callees = _callees(stats)
+
+    output = StringIO.StringIO()
+    output.write("version: 1\n")
+    output.write("creator: gae_mini_profiler\n")
+    output.write("positions: line\n")
+    output.write("events: Microseconds\n")
+    output.write("summary: %d\n" % _microseconds(
+        sum(func_stats[2] for func_stats in stats.itervalues())))
+
+    for func_name, func_stats in stats.iteritems():
+        filename, lineno, _ = func_name
+        output.write("\nfl=%s\n" % filename)
+        output.write("fn=%s\n" % pstats.func_std_string(func_name))
+        output.write("%d %d\n" % (lineno, _microseconds(func_stats[2])))
+
+        for callee, edge in callees[func_name].iteritems():
+            if isinstance(edge, tuple):
+                cumulative_time = edge[3]
+            else:
+                # Without per-edge timings, all we have is the callee's total.
+                cumulative_time = stats[callee][3]
+            output.write("cfl=%s\n" % callee[0])
+            output.write("cfn=%s\n" % pstats.func_std_string(callee))
+            output.write("calls=%d %d\n" % (_edge_call_count(edge), callee[1]))
+            output.write("%d %d\n" % (lineno, _microseconds(cumulative_time)))
+
+    result = output.getvalue()
+    output.close()
+    return result
+
+def pprof_results(raw_stats):
+    """Convert raw stats to pprof's gzipped profile.proto format.
+
+    cProfile only records caller -> callee edges rather than full stacks, so
+    each edge becomes a two-frame sample (callee, caller) carrying the call
+    count and the callee's own and cumulative time for calls from that
+    caller. Functions without callers become single-frame samples. Use
+    "pprof -sample_index=cumulative" to weight the graph by cumulative time.
+    """
+    # Imported here since it's only needed for exports.
+    import pprof
+
+    stats = marshal.loads(raw_stats)
+    builder = pprof.ProfileBuilder([
+        ("calls", "count"),
+        ("cpu", "microseconds"),
+        ("cumulative", "microseconds"),
+    ], duration_nanos=int(sum(s[2] for s in stats.itervalues()) * 1e9))
+
+    def location_id(func_name):
+        filename, lineno, name = func_name
+        return builder.location(name, filename, lineno)
+
+    for func_name, func_stats in stats.iteritems():
+        _, call_count, total_time, cumulative_time, callers = func_stats
+        if not callers:
+            builder.add_sample([location_id(func_name)], [
+                call_count,
+                _microseconds(total_time),
+                _microseconds(cumulative_time)])
+            continue
+
+        for caller, edge in callers.iteritems():
+            if isinstance(edge, tuple):
+                edge_total_time, edge_cumulative_time = edge[2], edge[3]
+            else:
+                edge_total_time, edge_cumulative_time = 0, 0
+            builder.add_sample([location_id(func_name), location_id(caller)], [
+                _edge_call_count(edge),
+                _microseconds(edge_total_time),
+                _microseconds(edge_cumulative_time)])
+
+    return builder.gzipped()
+
+def _tracked_shares(stats, tracked, func, shares, visiting):
+    """Return {tracked function: share} for the calls of an untracked function.
+
+    Each share is the fraction of func's calls that were made, directly or
+    through other untracked functions, on behalf of that tracked function.
+    Results are memoized in shares; visiting guards against recursion.
+    """
+    if func in shares:
+        return shares[func]
+
+    visiting.add(func)
+    weights = collections.defaultdict(float)
+    callers = stats[func][4] if func in stats else {}
+    total_calls = float(sum(_edge_call_count(edge) for edge in callers.itervalues()))
+    for caller, edge in callers.iteritems():
+        weight = _edge_call_count(edge) / total_calls
+        if caller in tracked:
+            weights[caller] += weight
+        elif caller not in visiting:
+            for ancestor, share in _tracked_shares(
+                    stats, tracked, caller, shares, visiting).iteritems():
+                weights[ancestor] += weight * share
+    visiting.discard(func)
+
+    shares[func] = weights
+    return weights
+
+def _calls_beneath(callees, stats, func, memo, visiting):
+    """Estimate how many calls were made, at any depth, beneath func."""
+    if func in memo:
+        return memo[func]
+
+    visiting.add(func)
+    total = 0.0
+    for callee, edge in callees[func].iteritems():
+        call_count = _edge_call_count(edge)
+        total += call_count
+        if callee not in visiting and stats[callee][1]:
+            total += call_count * (
+                _calls_beneath(callees, stats, callee, memo, visiting) /
+                stats[callee][1])
+    visiting.discard(func)
+
+    memo[func] = total
+    return total
+
+def fold_stats(stats, should_track, call_overhead=0.0):
+    """Fold the calls to untracked functions in pstats-style stats into their
+    tracked callers.
+
+    Returns new stats containing only the functions for which should_track
+    (a function of a pstats function key) is true. The own time of each
+    untracked function is added to the tracked functions it was called on
+    behalf of, and calls between tracked functions through untracked ones
+    become direct caller -> callee edges. Since cProfile only records single
+    caller -> callee edges, calls through chains of untracked functions are
+    apportioned by call counts.
+
+    call_overhead, in seconds, is subtracted for every call made while a
+    function was running: from its own time for calls it (or code folded into
+    it) made, and from its cumulative time for calls made at any depth.
+    """
+    tracked = set(func for func in stats if should_track(func))
+    callees = _callees(stats)
+    shares = {}
+
+    def targets(caller):
+        if caller in tracked:
+            return {caller: 1.0}
+        return _tracked_shares(stats, tracked, caller, shares, set())
+
+    own_time = dict((func, stats[func][2]) for func in tracked)
+    calls_made = collections.defaultdict(float)
+    tracked_callers = dict((func, collections.defaultdict(
+        lambda: [0.0, 0.0, 0.0, 0.0])) for func in tracked)
+
+    for func, (_, call_count, total_time, _, callers) in stats.iteritems():
+        for caller, edge in callers.iteritems():
+            edge_call_count = _edge_call_count(edge)
+            for target, share in targets(caller).iteritems():
+                calls_made[target] += edge_call_count * share
+                if func in tracked:
+                    folded_edge = tracked_callers[func][target]
+                    if isinstance(edge, tuple):
+                        for i in xrange(4):
+                            folded_edge[i] += edge[i] * share
+                    else:
+                        folded_edge[0] += edge_call_count * share
+                        folded_edge[1] += edge_call_count * share
+                else:
+                    if isinstance(edge, tuple):
+                        edge_total_time = edge[2]
+                    else:
+                        edge_total_time = total_time * edge_call_count / call_count
+                    own_time[target] += edge_total_time * share
+
+    calls_beneath = {}
+    folded = {}
+    for func in tracked:
+        primitive_call_count, call_count, _, cumulative_time, _ = stats[func]
+        own = max(0.0, own_time[func] - calls_made[func] * call_overhead)
+        cumulative = max(own, cumulative_time - call_overhead *
+                         _calls_beneath(callees, stats, func, calls_beneath, set()))
+
+        callers = {}
+        for caller, (edge_call_count, edge_primitive_call_count,
+                     _, edge_cumulative_time) in tracked_callers[func].iteritems():
+            fraction = edge_call_count / call_count if call_count else 0.0
+            callers[caller] = (
+                int(round(edge_call_count)),
+                int(round(edge_primitive_call_count)),
+                own * fraction,
+                max(own * fraction, edge_cumulative_time -
+                    call_overhead * calls_beneath[func] * fraction))
+
+        folded[func] = (primitive_call_count, call_count, own, cumulative, callers)
+
+    return folded
+
+class FilteredProfiler(object):
+    """Instrumenting profiler that only reports calls to selected code.
+
+    This filters what's reported, not what's recorded, so it adds as much
+    overhead to the request as cProfile does on its own.
+
+    cProfile records every call, including those in the standard library,
+    protobuf encoding, and the appstats recorder, and the overhead of all
+    that instrumentation distorts the timings of the code we actually care
+    about. This profiler only reports functions for which should_track (a
+    function of a pstats function key) is true; time spent in any other call
+    is folded into the tracked function it was made on behalf of, as if it
+    were inlined there, and cProfile's calibrated per-call overhead is
+    subtracted from the reported times.
+
+    Python calls are still recorded by cProfile, since any profile hook
+    written in Python costs several times more per call than cProfile's C
+    hook, even if it ignores most calls, and untracked ones are folded away
+    afterwards. Calls to builtins aren't recorded at all: their time simply
+    counts as their caller's own time.
+
+    Like cProfile.Profile, create_stats() leaves pstats-compatible stats in
+    self.stats, so the results can be read with pstats.Stats. The stats are
+    only folded once for each stretch of profiling.
+    """
+
+    def __init__(self, should_track):
+        self.should_track = should_track
+        self.c_profile = cProfile.Profile(builtins=False)
+        self.stats = {}
+        self.folded_stats = None
+
+    def enable(self):
+        self.folded_stats = None
+        self.c_profile.enable()
+
+    def disable(self):
+        self.c_profile.disable()
+
+    def runcall(self, func, *args, **kwargs):
+        self.enable()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.disable()
+
+    def create_stats(self):
+        if self.folded_stats is None:
+            self.c_profile.create_stats()
+            self.folded_stats = fold_stats(
+                self.c_profile.stats, self.should_track, call_overhead())
+        # pstats.Stats empties self.stats once it has read them.
+        self.stats = self.folded_stats
+
+def _calibrate(iterations=10000, repeat=3):
+    """Measure the time cProfile adds to each Python function call, taking
+    the fastest of repeat runs of each loop to cut down on noise."""
+    def empty():
+        pass
+
+    def loop():
+        for _ in xrange(iterations):
+            empty()
+
+    timer = timeit.default_timer
+    plain_times = []
+    profiled_times = []
+    for _ in xrange(repeat):
+        start = timer()
+        loop()
+        plain_times.append(timer() - start)
+
+        c_profile = cProfile.Profile(builtins=False)
+        start = timer()
+        c_profile.runcall(loop)
+        profiled_times.append(timer() - start)
+
+    return max(0.0, (min(profiled_times) - min(plain_times)) / iterations)
+
+# Seconds of cProfile overhead per call, once call_overhead() has measured it
+_call_overhead = None
+
+def call_overhead():
+    """Return the seconds cProfile adds to each call, measuring them the first
+    time this is called.
+
+    That's when the first filtered profile is folded, which only happens once
+    its request is done, so no profiled request's timings include it."""
+    global _call_overhead
+    if _call_overhead is None:
+        _call_overhead = _calibrate()
+    return _call_overhead
+
+
 class Profile(object):
-    """Profiler that wraps cProfile for programmatic access and reporting."""
-    def __init__(self):
-        self.c_profile = cProfile.Profile()
+    """Profiler that wraps cProfile for programmatic access and reporting.
+
+    If should_track is given, a FilteredProfiler that only tracks the code it
+    accepts is used instead of cProfile."""
+    def __init__(self, should_track=None):
+        if should_track is None:
+            self.c_profile = cProfile.Profile()
+        else:
+            self.c_profile = FilteredProfiler(should_track)
+
+    def raw_stats(self):
+        """Return the cProfile stats marshaled in the format pstats reads."""
+        self.c_profile.create_stats()
+        return marshal.dumps(self.c_profile.stats)
 
     def results(self):
-        """Return cProfile results in a dictionary for template context."""
+        """Return cProfile results in a dictionary for template context.
+
+        Only the TOP_N most expensive functions by cumulative time and by own
+        time are included."""
+        # pstats won't load an empty profile, which is what the filtered mode
+        # records when none of the request's own code ran.
+        self.c_profile.create_stats()
+        if not self.c_profile.stats:
+            return {
+                "total_call_count": 0,
+                "total_time": util.seconds_fmt(0),
+                "total_function_count": 0,
+                "calls": []
+            }
+
         # Make sure nothing is printed to stdout
         output = StringIO.StringIO()
         stats = pstats.Stats(self.c_profile, stream=output)
-        stats.sort_stats("cumulative")
-        self.c_profile.create_stats()
 
         results = {
-            "raw_stats": base64.b64encode(marshal.dumps(self.c_profile.stats)),
             "total_call_count": stats.total_calls,
             "total_time": util.seconds_fmt(stats.total_tt),
+            "total_function_count": len(stats.stats),
             "calls": []
         }
 
-        width, list_func_names = stats.get_print_list([80])
-        for func_name in list_func_names:
-            primitive_call_count, total_call_count, total_time, cumulative_time, callers = stats.stats[func_name]
+        top_cumulative = heapq.nlargest(TOP_N, stats.stats,
+                key=lambda func_name: stats.stats[func_name][3])
+        top_own = heapq.nlargest(TOP_N, stats.stats,
+                key=lambda func_name: stats.stats[func_name][2])
+        callee_counts = collections.defaultdict(int)
+        for func_stats in stats.stats.itervalues():
+            for caller in func_stats[4]:
+                callee_counts[caller] += 1
 
-            func_desc = pstats.func_std_string(func_name)
+        list_func_names = sorted(set(top_cumulative) | set(top_own),
+                key=lambda func_name: stats.stats[func_name][3], reverse=True)
 
-            callers_names = map(lambda func_name: pstats.func_std_string(func_name), callers.keys())
-            callers_desc = map(
-                    lambda name: {"func_desc": name, "func_desc_short": util.short_method_fmt(name)},
-                    callers_names)
+        for func_name in list_func_names:
+            primitive_call_count, total_call_count, total_time, cumulative_time, callers = stats.stats[func_name]
 
-            results["calls"].append({
+            call = _func_desc(func_name)
+            call.update({
                 "primitive_call_count": primitive_call_count,
                 "total_call_count": total_call_count,
                 "cumulative_time": util.seconds_fmt(cumulative_time, 2),
                 "total_time": util.seconds_fmt(total_time, 2),
                 "per_call_cumulative": util.seconds_fmt(cumulative_time / primitive_call_count, 2) if primitive_call_count else "",
-                "func_desc": func_desc,
-                "func_desc_short": util.short_method_fmt(func_desc),
-                "callers_desc": callers_desc,
+                "caller_count": len(callers),
+                "callee_count": callee_counts[func_name],
             })
+            results["calls"].append(call)
 
         output.close()
 
@@ -4,14 +4,34 @@
 
 This works by storing a list of functions to profile, then telling
 the third party line_profiler module to profile those functions.
+
+Functions can be marked for every request with line_profile(), or named for a
+single request as "module.path:Class.method" targets (see resolve_target).
+The sampling profiler also adds up the time spent in each app function for
+every route it profiles (see nominate_hotspots), and the hottest of them are
+then profiled line-by-line on later requests to that route.
+
+line_profiler needs a C extension, which can only be loaded on the dev server.
+Everywhere else, the functions are profiled by PythonLineProfiler, a slower
+stand-in written in Python with the same interface.
+
+A single request rarely runs a function enough times for stable per-line
+numbers, so the timings of many requests can be accumulated in a Session.
 """
 
+import base64
 import collections
+import heapq
 import inspect
 import linecache
 import os
 import re
 import sys
+import time
+import timeit
+import types
+
+from google.appengine.api import memcache
 
 import util
 
@@ -44,6 +64,10 @@ else:
 
 _FUNCTION_MARKER = "__gae_linebyline_profile"
 
+# Stand-in for line_profiler.LineStats, for line timings that weren't gathered
+# by line_profiler itself (e.g. those aggregated from sampled stacks).
+LineStats = collections.namedtuple("LineStats", ["timings", "unit"])
+
 _functions_to_profile = []
 
 
@@ -59,6 +83,309 @@ def line_profile(f):
     return f
 
 
+# Target name -> the function it names, or (the ResolveError explaining why it
+# couldn't be found, when that was found). Lives as long as the instance, so
+# each target is only imported and looked up once, except that targets that
+# couldn't be found are looked up again after _RESOLVE_ERROR_SECONDS.
+_resolved_targets = {}
+
+# Clear _resolved_targets once it reaches this many entries to bound its
+# memory, since targets come from request headers and cookies.
+_MAX_RESOLVED_TARGETS = 1000
+
+_RESOLVE_ERROR_SECONDS = 60
+
+
+class ResolveError(Exception):
+    pass
+
+
+def resolve_target(target):
+    """Return the function named by a "module.path:Class.method" target.
+
+    The module is imported if it hasn't been already. Raises ResolveError if
+    the target doesn't name a function.
+    """
+    resolved = _resolved_targets.get(target)
+    if (resolved is None or (isinstance(resolved, tuple) and
+            time.time() - resolved[1] >= _RESOLVE_ERROR_SECONDS)):
+        try:
+            resolved = _resolve_target(target)
+        except ResolveError, e:
+            resolved = (e, time.time())
+        if len(_resolved_targets) >= _MAX_RESOLVED_TARGETS:
+            _resolved_targets.clear()
+        _resolved_targets[target] = resolved
+
+    if isinstance(resolved, tuple):
+        raise resolved[0]
+    return resolved
+
+
+def _resolve_target(target):
+    module_name, _, attr_path = target.partition(":")
+    if not module_name or not attr_path:
+        raise ResolveError(
+            "%s: expected a target like module.path:Class.method" % target)
+
+    try:
+        __import__(module_name)
+    except Exception, e:
+        raise ResolveError("%s: couldn't import %s (%s)" %
+                           (target, module_name, e))
+
+    obj = sys.modules[module_name]
+    for attr in attr_path.split("."):
+        try:
+            obj = getattr(obj, attr)
+        except AttributeError:
+            raise ResolveError("%s: %r has no attribute %s" %
+                               (target, obj, attr))
+
+    # Unbound and bound methods wrap the function we want.
+    obj = getattr(obj, "im_func", obj)
+    if not hasattr(obj, "func_code"):
+        raise ResolveError("%s: %r isn't a function" % (target, obj))
+    return obj
+
+
+# code object -> the target naming its function, or None if it can't be named
+_code_targets = {}
+
+
+def target_for_code(code):
+    """Return a "module.path:Class.method" target naming the function or
+    method whose code is code, or None if it isn't a module-level function or
+    a method of a module-level class."""
+    if code in _code_targets:
+        return _code_targets[code]
+
+    target = None
+    module_name = util.module_name(code.co_filename)
+    module = sys.modules.get(module_name)
+    if module is not None:
+        for name, obj in vars(module).items():
+            if isinstance(obj, (type, types.ClassType)):
+                candidates = [("%s.%s" % (name, attr), value)
+                              for attr, value in vars(obj).items()]
+            else:
+                candidates = [(name, obj)]
+
+            for attr_path, value in candidates:
+                # Unwrap staticmethods and classmethods.
+                func = getattr(value, "__func__", value)
+                if getattr(func, "func_code", None) is code:
+                    target = "%s:%s" % (module_name, attr_path)
+                    break
+            if target:
+                break
+
+    _code_targets[code] = target
+    return target
+
+
+_HOTSPOTS_MEMCACHE_KEY_FORMAT = "__gae_mini_profiler_linebyline_hotspot_ms_%s"
+
+# How long a route's hotspot totals are kept after they were last added to.
+_HOTSPOTS_SECONDS = 24 * 60 * 60
+
+_HOTSPOTS_CAS_RETRIES = 3
+
+# How many of a route's hottest functions are profiled line-by-line.
+HOTSPOTS_PER_ROUTE = 5
+
+# How many functions' totals are kept for each route, so that a function that
+# only gets hot over many requests can still overtake the current hotspots.
+_MAX_HOTSPOT_CANDIDATES = 50
+
+# How often, in seconds, each instance adds the time it sampled for a route to
+# the route's totals in memcache, so they aren't written on every request.
+_HOTSPOTS_FLUSH_SECONDS = 60
+
+# route -> [{target: ms sampled since the last flush}, time of the last flush]
+_pending_hotspots = {}
+
+# Clear _pending_hotspots once it reaches this many entries to bound its
+# memory.
+_MAX_PENDING_HOTSPOTS = 1000
+
+
+def _hottest(target_ms):
+    """Return target_ms, a dict of targets to ms, with only the
+    _MAX_HOTSPOT_CANDIDATES targets with the most time."""
+    if len(target_ms) <= _MAX_HOTSPOT_CANDIDATES:
+        return target_ms
+    return dict((target, target_ms[target]) for target in heapq.nlargest(
+        _MAX_HOTSPOT_CANDIDATES, target_ms, key=target_ms.get))
+
+
+def nominate_hotspots(path, code_times):
+    """Add the time a request to path spent in each app function, as sampled,
+    to the running totals of the requests to path's util.route(). Later
+    line-by-line profiles of requests to the route also profile the functions
+    with the most time in total (see hotspot_targets).
+
+    code_times is a dict of code objects to ms, as returned by the sampling
+    profiler's tracked_times(). Functions that can't be named as targets are
+    left out.
+
+    The totals are kept in memcache, so that requests served by any instance
+    add to them, which means they can be lost to eviction. Each instance adds
+    its times for a route the first time it profiles it, then at most every
+    _HOTSPOTS_FLUSH_SECONDS.
+    """
+    route = util.route(path)
+    pending = _pending_hotspots.get(route)
+    if pending is None:
+        if len(_pending_hotspots) >= _MAX_PENDING_HOTSPOTS:
+            _pending_hotspots.clear()
+        pending = _pending_hotspots[route] = [{}, 0]
+
+    target_ms = pending[0]
+    for code in heapq.nlargest(_MAX_HOTSPOT_CANDIDATES, code_times,
+                               key=code_times.get):
+        target = target_for_code(code)
+        if target:
+            target_ms[target] = target_ms.get(target, 0.0) + code_times[code]
+    pending[0] = target_ms = _hottest(target_ms)
+
+    now = time.time()
+    if not target_ms or now - pending[1] < _HOTSPOTS_FLUSH_SECONDS:
+        return
+
+    key = _HOTSPOTS_MEMCACHE_KEY_FORMAT % route
+    client = memcache.Client()
+    for _ in xrange(_HOTSPOTS_CAS_RETRIES):
+        totals = client.gets(key)
+        if totals is None:
+            if client.add(key, target_ms, time=_HOTSPOTS_SECONDS):
+                break
+            continue
+
+        for target, ms in target_ms.iteritems():
+            totals[target] = totals.get(target, 0.0) + ms
+        if client.cas(key, _hottest(totals), time=_HOTSPOTS_SECONDS):
+            break
+    else:
+        # Another instance kept winning the race, so try again next time.
+        return
+
+    pending[:] = [{}, now]
+
+
+def hotspot_targets(path, max_functions=HOTSPOTS_PER_ROUTE):
+    """Return the (at most max_functions) targets that the most time was
+    sampled in for requests to path's util.route(), hottest first."""
+    totals = memcache.get(_HOTSPOTS_MEMCACHE_KEY_FORMAT % util.route(path))
+    if not totals:
+        return []
+    return heapq.nlargest(max_functions, totals, key=totals.get)
+
+
+class PythonLineProfiler(object):
+    """Line profiler built on sys.settrace, for when line_profiler's C
+    extension isn't available.
+
+    Only the code of functions passed to add_function() gets line events.
+    The trace function returns early for every other frame, so calls to
+    unmarked code only pay for a single Python function call.
+    """
+    def __init__(self):
+        # code object -> {line number: [hits, time]}
+        self.code_timings = {}
+        # frame -> (line number being run, time it started)
+        self.current_lines = {}
+        self.enable_count = 0
+
+    def add_function(self, func):
+        # Unbound and bound methods wrap the function we want.
+        func = getattr(func, "im_func", func)
+        self.code_timings.setdefault(func.func_code, {})
+
+    def enable_by_count(self):
+        if not self.enable_count:
+            sys.settrace(self.trace_calls)
+        self.enable_count += 1
+
+    def disable_by_count(self):
+        self.enable_count -= 1
+        if not self.enable_count:
+            sys.settrace(None)
+
+    def runcall(self, func, *args, **kwargs):
+        self.enable_by_count()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.disable_by_count()
+
+    def trace_calls(self, frame, event, arg):
+        if frame.f_code in self.code_timings:
+            return self.trace_lines
+        return None
+
+    def trace_lines(self, frame, event, arg):
+        now = timeit.default_timer()
+
+        current_line = self.current_lines.get(frame)
+        if current_line and (event == "line" or event == "return"):
+            lineno, start = current_line
+            line_timings = self.code_timings[frame.f_code]
+            if lineno in line_timings:
+                timing = line_timings[lineno]
+                timing[0] += 1
+                timing[1] += now - start
+            else:
+                line_timings[lineno] = [1, now - start]
+
+        if event == "line":
+            # Read the clock again so the time spent in here isn't charged to
+            # the next line.
+            self.current_lines[frame] = (frame.f_lineno,
+                                         timeit.default_timer())
+        elif event == "return":
+            self.current_lines.pop(frame, None)
+
+        return self.trace_lines
+
+    def get_stats(self):
+        """Return the timings in the shape of line_profiler's LineStats."""
+        timings = {}
+        for code, line_timings in self.code_timings.iteritems():
+            key = (code.co_filename, code.co_firstlineno, code.co_name)
+            timings[key] = [(lineno, nhits, time)
+                            for lineno, (nhits, time)
+                            in sorted(line_timings.iteritems())]
+        return LineStats(timings=timings, unit=1.0)
+
+
+# (filename, first line number) -> (file's mtime, source lines of the block
+# starting there). Finding where a block ends means tokenizing it, so this is
+# done once per function, until its file changes, rather than every request.
+_source_blocks = {}
+
+
+def _source_block(filename, start_lineno):
+    """Return the source lines of the function starting at start_lineno."""
+    try:
+        mtime = os.path.getmtime(filename)
+    except OSError:
+        mtime = None
+
+    key = (filename, start_lineno)
+    cached = _source_blocks.get(key)
+    if cached and cached[0] == mtime:
+        return cached[1]
+
+    if cached:
+        linecache.checkcache(filename)
+    all_lines = linecache.getlines(filename)
+    sublines = inspect.getblock(all_lines[start_lineno - 1:])
+
+    _source_blocks[key] = (mtime, sublines)
+    return sublines
+
+
 def _process_line_stats(line_stats):
     """Convert line_profiler.LineStats instance into a dict.
 
@@ -96,41 +423,38 @@ def _process_line_stats(line_stats):
 
         filename, start_lineno, func_name = key
 
-        all_lines = linecache.getlines(filename)
-        sublines = inspect.getblock(all_lines[start_lineno - 1:])
+        sublines = _source_block(filename, start_lineno)
         end_lineno = start_lineno + len(sublines)
 
-        line_to_timing = collections.defaultdict(lambda: (-1, 0))
-
+        line_to_timing = {}
+        total_time = 0
         for (lineno, nhits, time) in timings:
-            line_to_timing[lineno] = (nhits, time)
-
-        padded_timings = []
-
-        for lineno in range(start_lineno, end_lineno):
-            nhits, time = line_to_timing[lineno]
-            padded_timings.append((lineno, nhits, time))
-
-        timings = []
+            if start_lineno <= lineno < end_lineno:
+                line_to_timing[lineno] = (nhits, time)
+                total_time += time
 
         result = {
             'filename': filename,
             'start_lineno': start_lineno,
             'func_name': func_name,
-            'total_time_ms': (sum([time for _, _, time in padded_timings]) *
-                    multiplier),
+            'total_time_ms': total_time * multiplier,
             'timings': []
         }
 
         result['total_time_ms_s'] = '%.0f' % result['total_time_ms']
 
-        for (lineno, nhits, time) in padded_timings:
+        # Pad the timings out to every line of the function's source.
+        for lineno, line in enumerate(sublines, start_lineno):
+            nhits, time = line_to_timing.get(lineno, (-1, 0))
             time_ms = time * multiplier
-            perc_time = (100.0 * time_ms) / result['total_time_ms']
+            if result['total_time_ms']:
+                perc_time = (100.0 * time_ms) / result['total_time_ms']
+            else:
+                perc_time = 0.0
 
             result['timings'].append({
                 'lineno': lineno,
-                'line': all_lines[lineno - 1],
+                'line': line,
                 'perc_time': perc_time,
                 'perc_time_s': '%.1f' % perc_time,
                 'time_ms': time_ms,
@@ -143,35 +467,187 @@ def _process_line_stats(line_stats):
     return profile_results
 
 
+_SESSION_MEMCACHE_KEY = "__gae_mini_profiler_linebyline_session"
+
+# How many times to retry adding a request's timings to a session that other
+# requests are adding to at the same time.
+_SESSION_CAS_RETRIES = 5
+
+# How long a session's results are kept after it ends.
+_SESSION_RESULTS_SECONDS = 24 * 60 * 60
+
+
+class Session(object):
+    """Line timings accumulated across many requests.
+
+    While a session is active, the line timings of every request profiled
+    line-by-line whose path starts with path_prefix are merged into it, until
+    max_requests have been added or it expires. Only one session exists at a
+    time. It's kept in memcache so that requests served by any instance add
+    to it, which means it can be lost to eviction.
+    """
+    def __init__(self, path_prefix="/", max_requests=100,
+                 duration_seconds=60 * 60, targets=()):
+        self.session_id = base64.urlsafe_b64encode(os.urandom(5))
+        self.path_prefix = path_prefix
+        self.max_requests = max_requests
+        self.start = time.time()
+        self.expires = self.start + duration_seconds
+        self.targets = list(targets)
+        self.request_count = 0
+        self.stopped = False
+
+        # (filename, first line number, function name) ->
+        #     {line number: [hits, seconds]}
+        self.timings = {}
+
+    def is_active(self):
+        return (not self.stopped and
+                self.request_count < self.max_requests and
+                time.time() < self.expires)
+
+    def matches(self, path):
+        return self.is_active() and path.startswith(self.path_prefix)
+
+    def add_line_stats(self, line_stats):
+        """Merge one request's line_profiler.LineStats into the session."""
+        for key, timings in line_stats.timings.iteritems():
+            line_timings = self.timings.setdefault(key, {})
+            for lineno, nhits, line_time in timings:
+                timing = line_timings.setdefault(lineno, [0, 0.0])
+                timing[0] += nhits
+                timing[1] += line_time * line_stats.unit
+        self.request_count += 1
+
+    def line_stats(self):
+        """Return the merged timings in the shape of line_profiler's
+        LineStats."""
+        timings = {}
+        for key, line_timings in self.timings.iteritems():
+            timings[key] = [(lineno, nhits, line_time)
+                            for lineno, (nhits, line_time)
+                            in sorted(line_timings.iteritems())]
+        return LineStats(timings=timings, unit=1.0)
+
+    def summary(self):
+        return {
+            "session_id": self.session_id,
+            "path_prefix": self.path_prefix,
+            "targets": self.targets,
+            "request_count": self.request_count,
+            "max_requests": self.max_requests,
+            "active": self.is_active(),
+        }
+
+    def results(self):
+        """Return the session's status and aggregated line report, in the
+        same format as Profile.results()' calls."""
+        res = self.summary()
+        res["calls"] = _process_line_stats(self.line_stats())
+        return res
+
+    def store(self):
+        time_left = max(0, self.expires - time.time())
+        return memcache.set(_SESSION_MEMCACHE_KEY, self,
+                            time=int(time_left) + _SESSION_RESULTS_SECONDS)
+
+    @staticmethod
+    def get():
+        """Return the current (or most recent) session, if any."""
+        return memcache.get(_SESSION_MEMCACHE_KEY)
+
+    @staticmethod
+    def add_request(session_id, line_stats):
+        """Add a request's line timings to the session with session_id, if
+        it's still active.
+
+        Returns the updated session, or None if the timings weren't added.
+        """
+        client = memcache.Client()
+        for _ in xrange(_SESSION_CAS_RETRIES):
+            session = client.gets(_SESSION_MEMCACHE_KEY)
+            if (not session or session.session_id != session_id or
+                    not session.is_active()):
+                return None
+
+            session.add_line_stats(line_stats)
+            time_left = max(0, session.expires - time.time())
+            if client.cas(_SESSION_MEMCACHE_KEY, session,
+                          time=int(time_left) + _SESSION_RESULTS_SECONDS):
+                return session
+
+        return None
+
+
 class Profile(object):
-    """Profiler wrapping line_profiler."""
-    def __init__(self):
-        self.num_functions_marked = len(_functions_to_profile)
+    """Profiler wrapping line_profiler, or PythonLineProfiler if line_profiler
+    can't be loaded.
+
+    Besides the functions marked with line_profile(), the functions named by
+    targets (see resolve_target) are profiled. They're only added to this
+    profiler, so they aren't traced during any other request.
+
+    If path is given, the hotspots of its route are profiled too. If it
+    matches the active Session, so are the session's targets, and
+    add_to_session() adds this request's timings to it.
+    """
+    def __init__(self, targets=(), path=None):
+        self.session = None
+        self.hotspot_targets = []
+        if path is not None:
+            self.hotspot_targets = hotspot_targets(path)
+            targets = list(targets) + self.hotspot_targets
+
+            session = Session.get()
+            if session and session.matches(path):
+                self.session = session
+                targets = targets + session.targets
+
+        functions = list(_functions_to_profile)
+
+        self.target_errors = []
+        for target in targets:
+            try:
+                f = resolve_target(target)
+            except ResolveError, e:
+                self.target_errors.append(str(e))
+                continue
+            if f not in functions:
+                functions.append(f)
+
+        self.num_functions_marked = len(functions)
 
         if line_profiler is None:
-            self.line_prof = None
+            self.line_prof = PythonLineProfiler()
         else:
             self.line_prof = line_profiler.LineProfiler()
 
-            for f in _functions_to_profile:
-                self.line_prof.add_function(f)
+        for f in functions:
+            self.line_prof.add_function(f)
 
     def results(self):
-        err_msg = ""
-
-        if not util.dev_server:
-            err_msg = "The line-by-line profiler can only be used in dev."
-        elif line_profiler is None:
-            err_msg = (
-                "Could not load the line_profiler module.<br><br>"
-                "Try installing the C extension like so:<br>"
-                "&nbsp;&nbsp;sudo pip install line_profiler==1.0b3<br>"
-                "&nbsp;&nbsp;(cd / && cp `python -c 'import _line_profiler; print _line_profiler.__file__'` %s)" % os.path.dirname(__file__)
-            )
+        warning = ""
+
+        if line_profiler is None:
+            warning = (
+                "Lines were timed with a slower, pure-Python tracer, which "
+                "adds noticeable overhead to every line of the profiled "
+                "functions.")
+            if util.dev_server:
+                warning += (
+                    "<br><br>"
+                    "Could not load the line_profiler module. "
+                    "Try installing the C extension like so:<br>"
+                    "&nbsp;&nbsp;sudo pip install line_profiler==1.0b3<br>"
+                    "&nbsp;&nbsp;(cd / && cp `python -c 'import _line_profiler; print _line_profiler.__file__'` %s)" % os.path.dirname(__file__)
+                )
 
         res = {
-            "err_msg": err_msg,
+            "warning": warning,
+            "target_errors": self.target_errors,
+            "hotspot_targets": self.hotspot_targets,
             "num_functions_marked": self.num_functions_marked,
+            "session": self.session and self.session.summary(),
             "calls": []
         }
 
@@ -180,8 +656,12 @@ class Profile(object):
 
         return res
 
+    def add_to_session(self):
+        """Add this request's timings to the session it matched, if any."""
+        if self.session:
+            self.session = (Session.add_request(self.session.session_id,
+                                                self.line_prof.get_stats())
+                            or self.session)
+
     def run(self, fxn):
-        if self.line_prof is None:
-            return fxn()
-        else:
-            return self.line_prof.runcall(fxn)
+        return self.line_prof.runcall(fxn)
@@ -9,6 +9,12 @@ application = webapp.WSGIApplication([
     ("/gae_mini_profiler/request/log", profiler.RequestLogHandler),
     ("/gae_mini_profiler/request", profiler.RequestStatsHandler),
     ("/gae_mini_profiler/shared/raw", profiler.RawSharedStatsHandler),
+    ("/gae_mini_profiler/shared/callgraph", profiler.CallGraphHandler),
+    ("/gae_mini_profiler/shared/rpc", profiler.RpcDetailsHandler),
+    ("/gae_mini_profiler/shared/callgrind", profiler.CallgrindStatsHandler),
+    ("/gae_mini_profiler/shared/pprof", profiler.PprofStatsHandler),
+    ("/gae_mini_profiler/shared/trace", profiler.TraceEventsHandler),
+    ("/gae_mini_profiler/linebyline/session", profiler.LineProfileSessionHandler),
     ("/gae_mini_profiler/shared", profiler.SharedStatsHandler),
     ("/gae_mini_profiler/shared/cpuprofile", profiler.CpuProfileStatsHandler),
 ])
@@ -0,0 +1,120 @@
+# TODO(colin): fix these lint errors (http://pep8.readthedocs.io/en/release-1.7.x/intro.html#error-codes)
+# pep8-disable:E302,E501
+"""Decides which of the requests config.should_profile() allows are profiled.
+
+By default that's all of them, in the mode picked by the user. In production
+config.profiling_policy() can instead sample them per route, pick their mode
+per route, and cap how many of them each instance profiles per second and at
+once, so the profiler can stay on for real traffic at a bounded cost.
+
+All of this is kept per instance and decided without any RPCs.
+"""
+
+import random
+import threading
+import time
+
+import config
+
+# Most requests app.yaml lets an instance serve at once, unless it says
+# otherwise.
+MAX_CONCURRENT_REQUESTS = 10
+
+
+class Admission(object):
+    """A request that's being profiled, in mode, or in the mode its user
+    picked if mode is None. release() must be called once it's done."""
+    __slots__ = ["policy", "mode"]
+
+    def __init__(self, policy, mode):
+        self.policy = policy
+        self.mode = mode
+
+    def release(self):
+        self.policy.release()
+
+
+class Policy(object):
+    """Samples and rate-limits the requests to profile.
+
+    The arguments are the options config.profiling_policy() returns, as
+    described in config.py. None means no limit.
+    """
+
+    def __init__(self, routes=(), max_profiled_per_second=None, burst=None,
+                 max_concurrent_share=None,
+                 max_concurrent_requests=MAX_CONCURRENT_REQUESTS):
+        # (path prefix, sample one in, mode) for each route, in order
+        self.routes = [(prefix, rule.get("sample_one_in", 1), rule.get("mode"))
+                       for prefix, rule in routes]
+
+        self.rate = max_profiled_per_second
+        if burst is None and self.rate is not None:
+            burst = max(1, self.rate)
+        self.burst = burst
+        self.tokens = burst
+        self.last_refill = time.time()
+
+        self.max_concurrent = None
+        if max_concurrent_share is not None:
+            self.max_concurrent = max(
+                1, int(max_concurrent_share * max_concurrent_requests))
+        self.concurrent = 0
+
+        self.lock = threading.Lock()
+
+    def route(self, path):
+        """Return (sample one in, mode) for requests to path."""
+        for prefix, sample_one_in, mode in self.routes:
+            if path.startswith(prefix):
+                return sample_one_in, mode
+        return 1, None
+
+    def admit(self, path):
+        """Return an Admission if a request to path should be profiled, or
+        None if it shouldn't."""
+        sample_one_in, mode = self.route(path)
+        if sample_one_in > 1 and random.random() * sample_one_in >= 1:
+            return None
+
+        if self.rate is None and self.max_concurrent is None:
+            return Admission(self, mode)
+
+        with self.lock:
+            if (self.max_concurrent is not None and
+                    self.concurrent >= self.max_concurrent):
+                return None
+
+            if self.rate is not None:
+                now = time.time()
+                self.tokens = min(
+                    self.burst,
+                    self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+                if self.tokens < 1:
+                    return None
+                self.tokens -= 1
+
+            if self.max_concurrent is not None:
+                self.concurrent += 1
+        return Admission(self, mode)
+
+    def release(self):
+        """Note that a request admitted by admit() is done."""
+        if self.max_concurrent is None:
+            return
+        with self.lock:
+            self.concurrent -= 1
+
+
+_policy = None
+_policy_lock = threading.Lock()
+
+def get():
+    """Return the Policy set by config.profiling_policy()."""
+    global _policy
+    if _policy is None:
+        with _policy_lock:
+            if _policy is None:
+                _policy = Policy(**(config.profiling_policy() or {}))
+    return _policy
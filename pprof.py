@@ -0,0 +1,152 @@
+"""Minimal encoder for pprof's profile.proto format.
+
+pprof reads gzipped protocol buffers described by
+https://github.com/google/pprof/blob/master/proto/profile.proto. We only need
+to write a handful of its messages, so rather than depend on a protobuf
+library we encode the wire format by hand here.
+
+Typical use:
+
+    builder = ProfileBuilder([("calls", "count"), ("cpu", "microseconds")])
+    location_id = builder.location("my_function", "my_file.py", 42)
+    builder.add_sample([location_id], [1, 1500])
+    data = builder.gzipped()
+"""
+
+import gzip
+import StringIO
+
+# Wire types from https://developers.google.com/protocol-buffers/docs/encoding
+_VARINT = 0
+_LENGTH_DELIMITED = 2
+
+
+def _varint(value):
+    """Encode an int as a protobuf varint (negative ints take 10 bytes)."""
+    if value < 0:
+        value += 1 << 64
+    chunks = []
+    while True:
+        bits = value & 0x7f
+        value >>= 7
+        if value:
+            chunks.append(chr(bits | 0x80))
+        else:
+            chunks.append(chr(bits))
+            return "".join(chunks)
+
+
+def _key(field_number, wire_type):
+    return _varint((field_number << 3) | wire_type)
+
+
+def _int_field(field_number, value):
+    # Default values needn't be written at all.
+    if not value:
+        return ""
+    return _key(field_number, _VARINT) + _varint(value)
+
+
+def _bytes_field(field_number, data):
+    return _key(field_number, _LENGTH_DELIMITED) + _varint(len(data)) + data
+
+
+def _packed_field(field_number, values):
+    if not values:
+        return ""
+    return _bytes_field(field_number, "".join(_varint(v) for v in values))
+
+
+class ProfileBuilder(object):
+    """Accumulates samples and encodes them as a profile.proto Profile.
+
+    "sample_types" is a list of (type, unit) pairs, e.g. ("cpu",
+    "microseconds"), describing each value recorded with a sample.
+    """
+    def __init__(self, sample_types, duration_nanos=0):
+        # string_table[0] must always be the empty string.
+        self.strings = [""]
+        self.string_ids = {"": 0}
+
+        self.sample_types = [(self.string_id(type_name), self.string_id(unit))
+                             for type_name, unit in sample_types]
+        self.duration_nanos = duration_nanos
+
+        # Encoded Sample, Location and Function messages
+        self.samples = []
+        self.locations = []
+        self.functions = []
+
+        # (name, filename, start_line) -> function id
+        self.function_ids = {}
+        # (function id, line) -> location id
+        self.location_ids = {}
+
+    def string_id(self, s):
+        if isinstance(s, unicode):
+            s = s.encode("utf-8")
+        if s not in self.string_ids:
+            self.string_ids[s] = len(self.strings)
+            self.strings.append(s)
+        return self.string_ids[s]
+
+    def function(self, name, filename, start_line):
+        """Return the id of the Function message for a function."""
+        key = (name, filename, start_line)
+        if key not in self.function_ids:
+            function_id = len(self.functions) + 1
+            name_id = self.string_id(name)
+            self.functions.append(
+                _int_field(1, function_id) +
+                _int_field(2, name_id) +
+                _int_field(3, name_id) +
+                _int_field(4, self.string_id(filename)) +
+                _int_field(5, start_line))
+            self.function_ids[key] = function_id
+        return self.function_ids[key]
+
+    def location(self, name, filename, start_line):
+        """Return the id of the Location message for a function.
+
+        Instrumented profiles only know which function was running, not which
+        line, so each location is placed at its function's first line."""
+        function_id = self.function(name, filename, start_line)
+        key = (function_id, start_line)
+        if key not in self.location_ids:
+            location_id = len(self.locations) + 1
+            line_message = (_int_field(1, function_id) +
+                            _int_field(2, start_line))
+            self.locations.append(
+                _int_field(1, location_id) +
+                _bytes_field(4, line_message))
+            self.location_ids[key] = location_id
+        return self.location_ids[key]
+
+    def add_sample(self, location_ids, values):
+        """Add a sample. location_ids are ordered from the leaf frame up."""
+        self.samples.append(
+            _packed_field(1, location_ids) +
+            _packed_field(2, values))
+
+    def serialize(self):
+        """Return the encoded (uncompressed) Profile message."""
+        parts = []
+        for type_id, unit_id in self.sample_types:
+            parts.append(_bytes_field(
+                1, _int_field(1, type_id) + _int_field(2, unit_id)))
+        parts.extend(_bytes_field(2, sample) for sample in self.samples)
+        parts.extend(_bytes_field(4, location) for location in self.locations)
+        parts.extend(_bytes_field(5, function) for function in self.functions)
+        parts.extend(_bytes_field(6, s) for s in self.strings)
+        parts.append(_int_field(10, self.duration_nanos))
+        return "".join(parts)
+
+    def gzipped(self):
+        """Return the gzipped Profile message, as pprof expects to read it."""
+        output = StringIO.StringIO()
+        f = gzip.GzipFile(fileobj=output, mode="wb")
+        try:
+            f.write(self.serialize())
+        finally:
+            f.close()
+        return output.getvalue()
@@ -7,8 +7,8 @@ import time
 import logging
 import os
 import re
+import urllib
 import urlparse
-import base64
 
 try:
     import threading
@@ -21,7 +21,6 @@ try:
 except ImportError:
     import simplejson as json
 
-import StringIO
 from types import GeneratorType
 import zlib
 
@@ -33,11 +32,16 @@ from google.appengine.ext.webapp import RequestHandler
 import cookies
 import pickle
 import config
+import policy
 import util
 
 # Use a somewhat smaller size to avoid any chance of off-by-one errors.
 _MEMCACHE_CHUNKSIZE = memcache.MAX_VALUE_SIZE - 1024
 
+# Most log records, and bytes of log messages, kept for each request.
+MAX_LOG_RECORDS = 1000
+MAX_LOG_BYTES = 256 * 1024
+
 
 class CurrentRequestId(object):
     """A per-request identifier accessed by other pieces of mini profiler.
@@ -66,6 +70,79 @@ class CurrentRequestId(object):
             CurrentRequestId._local.request_id = request_id
 
 
+class AppstatsLock(object):
+    """Lets profiled requests skip appstats' memcache lock.
+
+    As a simple form of rate-limiting, appstats protects all its work with a
+    memcache lock to ensure that only one appstats request ever runs at a
+    time, across all appengine instances.  (GvR confirmed this is the purpose
+    of the lock.)  So our attempt to profile would fail if appstats is running
+    on another instance.  We just turn off the lock-checking for us, which
+    means we don't rate-limit quite as much with the mini-profiler as we would
+    do without.
+
+    Rather than patching memcache.add and memcache.delete themselves, which
+    every memcache call would then go through, and which overlapping requests
+    could leave patched for good, appstats' recording module is given its own
+    stand-in for the memcache module, once. The stand-in only skips the lock
+    on threads that are serving a profiled request.
+    """
+
+    # Idents of the threads serving profiled requests, so each request skips
+    # the lock only for itself. (Not a threading.local() because the
+    # devserver resets those on Thread.start.)
+    _skipped_threads = set()
+
+    _install_lock = threading.Lock()
+    _installed = False
+
+    @staticmethod
+    def install():
+        """Give appstats the stand-in memcache module, if it hasn't got it
+        already."""
+        if AppstatsLock._installed:
+            return
+        with AppstatsLock._install_lock:
+            if not AppstatsLock._installed:
+                if getattr(recording, "memcache", None) is memcache:
+                    recording.memcache = _AppstatsMemcache(memcache)
+                AppstatsLock._installed = True
+
+    @staticmethod
+    def set_skipped(skipped):
+        """Set whether appstats skips its lock on the current thread."""
+        ident = threading.current_thread().ident
+        if skipped:
+            AppstatsLock._skipped_threads.add(ident)
+        else:
+            AppstatsLock._skipped_threads.discard(ident)
+
+    @staticmethod
+    def is_skipped():
+        return threading.current_thread().ident in AppstatsLock._skipped_threads
+
+
+class _AppstatsMemcache(object):
+    """The memcache module as appstats sees it, with the appstats lock always
+    free on threads where AppstatsLock is skipped."""
+
+    def __init__(self, memcache_module):
+        self._memcache = memcache_module
+
+    def __getattr__(self, name):
+        return getattr(self._memcache, name)
+
+    def add(self, key, *args, **kwargs):
+        if AppstatsLock.is_skipped() and key == recording.lock_key():
+            return True
+        return self._memcache.add(key, *args, **kwargs)
+
+    def delete(self, key, *args, **kwargs):
+        if AppstatsLock.is_skipped() and key == recording.lock_key():
+            return True
+        return self._memcache.delete(key, *args, **kwargs)
+
+
 class Mode(object):
     """Possible profiler modes.
 
@@ -81,15 +158,21 @@ class Mode(object):
 
     SIMPLE = "simple"  # Simple start/end timing for the request as a whole
     CPU_INSTRUMENTED = "instrumented"  # Profile all function calls
+    CPU_INSTRUMENTED_FILTERED = "instrumented_filtered"  # Profile all calls,
+                                                         # show selected modules
     CPU_SAMPLING = "sampling"  # Sample call stacks
     CPU_MEMORY_SAMPLING = "memory_sampling"  # Sample call stacks and memory
     CPU_LINEBYLINE = "linebyline" # Line-by-line profiling on a subset of functions
+    CPU_TRACING = "tracing"  # Timeline of calls to selected modules
     RPC_ONLY = "rpc"  # Profile all RPC calls
     RPC_AND_CPU_INSTRUMENTED = "rpc_instrumented" # RPCs and all fxn calls
+    RPC_AND_CPU_INSTRUMENTED_FILTERED = "rpc_instrumented_filtered" # RPCs and
+                                                    # all calls, show selected modules
     RPC_AND_CPU_SAMPLING = "rpc_sampling" # RPCs and sample call stacks
     RPC_AND_CPU_MEMORY_SAMPLING = "rpc_memory_sampling" # RPCs and sample call
                                                         # stacks and memory
     RPC_AND_CPU_LINEBYLINE = "rpc_linebyline" # RPCs and line-by-line profiling
+    RPC_AND_CPU_TRACING = "rpc_tracing" # RPCs and a timeline of calls
 
     @staticmethod
     def get_mode(environ):
@@ -103,14 +186,18 @@ class Mode(object):
         if (mode not in [
                 Mode.SIMPLE,
                 Mode.CPU_INSTRUMENTED,
+                Mode.CPU_INSTRUMENTED_FILTERED,
                 Mode.CPU_SAMPLING,
                 Mode.CPU_MEMORY_SAMPLING,
                 Mode.CPU_LINEBYLINE,
+                Mode.CPU_TRACING,
                 Mode.RPC_ONLY,
                 Mode.RPC_AND_CPU_INSTRUMENTED,
+                Mode.RPC_AND_CPU_INSTRUMENTED_FILTERED,
                 Mode.RPC_AND_CPU_SAMPLING,
                 Mode.RPC_AND_CPU_MEMORY_SAMPLING,
-                Mode.RPC_AND_CPU_LINEBYLINE]):
+                Mode.RPC_AND_CPU_LINEBYLINE,
+                Mode.RPC_AND_CPU_TRACING]):
             mode = Mode.RPC_ONLY
 
         return mode
@@ -120,8 +207,10 @@ class Mode(object):
         return mode in [
                 Mode.RPC_ONLY,
                 Mode.RPC_AND_CPU_INSTRUMENTED,
+                Mode.RPC_AND_CPU_INSTRUMENTED_FILTERED,
                 Mode.RPC_AND_CPU_SAMPLING,
-                Mode.RPC_AND_CPU_MEMORY_SAMPLING]
+                Mode.RPC_AND_CPU_MEMORY_SAMPLING,
+                Mode.RPC_AND_CPU_TRACING]
 
     @staticmethod
     def is_sampling_enabled(mode):
@@ -141,7 +230,15 @@ class Mode(object):
     def is_instrumented_enabled(mode):
         return mode in [
                 Mode.CPU_INSTRUMENTED,
-                Mode.RPC_AND_CPU_INSTRUMENTED]
+                Mode.CPU_INSTRUMENTED_FILTERED,
+                Mode.RPC_AND_CPU_INSTRUMENTED,
+                Mode.RPC_AND_CPU_INSTRUMENTED_FILTERED]
+
+    @staticmethod
+    def is_filtered_instrumented_enabled(mode):
+        return mode in [
+                Mode.CPU_INSTRUMENTED_FILTERED,
+                Mode.RPC_AND_CPU_INSTRUMENTED_FILTERED]
 
     @staticmethod
     def is_linebyline_enabled(mode):
@@ -149,6 +246,28 @@ class Mode(object):
                 Mode.CPU_LINEBYLINE,
                 Mode.RPC_AND_CPU_LINEBYLINE]
 
+    @staticmethod
+    def is_tracing_enabled(mode):
+        return mode in [
+                Mode.CPU_TRACING,
+                Mode.RPC_AND_CPU_TRACING]
+
+def get_line_targets(environ):
+    """Get the functions named for line-by-line profiling by the current
+    request's headers & cookies.
+
+    Targets are comma-separated "module.path:Class.method" names, e.g.
+    "models:User.put,api.util:slugify".
+    """
+    if "HTTP_G_M_P_LINE_TARGETS" in environ:
+        targets = environ["HTTP_G_M_P_LINE_TARGETS"]
+    else:
+        # The frontend URI-encodes the cookie.
+        targets = urllib.unquote(
+            cookies.get_cookie_value("g-m-p-line-targets") or "")
+
+    return [target.strip() for target in targets.split(",") if target.strip()]
+
 class RawSharedStatsHandler(RequestHandler):
     def get(self):
         request_id = self.request.get("request_id")
@@ -158,15 +277,236 @@ class RawSharedStatsHandler(RequestHandler):
             self.response.out.write("Profiler stats no longer exist for this request.")
             return
 
-        if not 'raw_stats' in request_stats.profiler_results:
+        if not request_stats.raw_stats:
             self.response.out.write("No raw states available for this profile")
             return
 
         self.response.headers['Content-Disposition'] = (
                 'attachment; filename="g-m-p-%s.profile"' % str(request_id))
         self.response.headers['Content-type'] = "application/octet-stream"
-        self.response.out.write(
-                base64.b64decode(request_stats.profiler_results['raw_stats']))
+        self.response.out.write(request_stats.raw_stats)
+
+
+class RawStatsExportHandler(RequestHandler):
+    """Base handler for downloading an instrumented profile's raw stats
+    converted to some other tool's format.
+
+    Subclasses set filename_format and content_type and implement export().
+    """
+    filename_format = None
+    content_type = "application/octet-stream"
+
+    def export(self, raw_stats):
+        raise NotImplementedError()
+
+    def get(self):
+        request_id = self.request.get("request_id")
+        request_stats = RequestStats.get(request_id)
+
+        if not request_stats:
+            self.response.out.write("Profiler stats no longer exist for this request.")
+            return
+
+        if not request_stats.raw_stats:
+            self.response.out.write("No raw stats available for this profile")
+            return
+
+        self.response.headers['Content-Disposition'] = (
+                'attachment; filename="%s"' % (self.filename_format % str(request_id)))
+        self.response.headers['Content-type'] = self.content_type
+        self.response.out.write(self.export(request_stats.raw_stats))
+
+
+class CallgrindStatsHandler(RawStatsExportHandler):
+    """Handler for retrieving the instrumented profile in callgrind format.
+
+    This can be opened with KCachegrind or QCachegrind.
+    """
+    # (K|Q)Cachegrind recognize files by their callgrind.out prefix.
+    filename_format = "callgrind.out.g-m-p-%s"
+
+    def export(self, raw_stats):
+        from . import instrumented_profiler
+        return instrumented_profiler.callgrind_results(raw_stats)
+
+
+class PprofStatsHandler(RawStatsExportHandler):
+    """Handler for retrieving the instrumented profile in pprof's format."""
+    filename_format = "g-m-p-%s.pb.gz"
+
+    def export(self, raw_stats):
+        from . import instrumented_profiler
+        return instrumented_profiler.pprof_results(raw_stats)
+
+
+class RpcDetailsHandler(RequestHandler):
+    """Handler for retrieving readable versions of a request's RPCs.
+
+    Profiles only keep appstats' raw summaries of each RPC's request and
+    response, since parsing them is slow, so they're prettified when a user
+    first looks at the RPCs. This returns the appstats_profiler.prettify()
+    results for each RPC, in order, the number of memcache misses by
+    service, and memcache gets' hits and misses rolled up by key prefix (see
+    cleanup.memcache_key_prefix()), most used prefixes first.
+    """
+    def get(self):
+        self.response.headers["Content-Type"] = "application/json"
+
+        request_stats = RequestStats.get(self.request.get("request_id"))
+        if not request_stats:
+            self.response.out.write(json.dumps(None))
+            return
+
+        from . import appstats_profiler
+        calls = []
+        service_misses = {}
+        memcache_prefixes = {}
+        for call in request_stats.appstats_results["calls"]:
+            prettified = appstats_profiler.prettify(call["request"],
+                                                    call["response"],
+                                                    call["service"])
+            prefix = appstats_profiler.service_prefix(call["service"])
+            service_misses[prefix] = (service_misses.get(prefix, 0) +
+                                      prettified["miss"])
+            for key_prefix, (hits, misses) in (
+                    prettified["memcache_prefixes"].iteritems()):
+                totals = memcache_prefixes.setdefault(key_prefix, [0, 0])
+                totals[0] += hits
+                totals[1] += misses
+            calls.append(prettified)
+
+        memcache_prefix_totals = []
+        for key_prefix, (hits, misses) in memcache_prefixes.iteritems():
+            memcache_prefix_totals.append({
+                "prefix": key_prefix,
+                "keys": hits + misses,
+                "hits": hits,
+                "misses": misses,
+                "hit_percent": "%.0f" % (100.0 * hits / (hits + misses)),
+            })
+        memcache_prefix_totals.sort(key=lambda totals: totals["keys"],
+                                    reverse=True)
+
+        self.response.out.write(json.dumps({
+            "calls": calls,
+            "service_misses": service_misses,
+            "memcache_prefixes": memcache_prefix_totals,
+        }))
+
+
+class CallGraphHandler(RequestHandler):
+    """Handler for retrieving the callers and callees of a single function.
+
+    Instrumented profiles only carry the most expensive functions, without
+    their callers, so the call graph of a function is looked up from the raw
+    stats when a user asks for it.
+    """
+    def get(self):
+        self.response.headers["Content-Type"] = "application/json"
+
+        request_stats = RequestStats.get(self.request.get("request_id"))
+        if not request_stats or not request_stats.raw_stats:
+            self.response.out.write(json.dumps(None))
+            return
+
+        # Note that we don't import instrumented_profiler at the top of this
+        # file so we don't bring in a lot of imports for users who don't have
+        # the profiler enabled.
+        from . import instrumented_profiler
+        self.response.out.write(json.dumps(instrumented_profiler.call_graph(
+                request_stats.raw_stats, self.request.get("func_desc"))))
+
+
+class TraceEventsHandler(RequestHandler):
+    """Handler for retrieving the tracing profiler's timeline in trace event
+    format.
+
+    This can be opened with https://ui.perfetto.dev or chrome://tracing.
+    """
+    def get(self):
+        request_id = self.request.get("request_id")
+        request_stats = RequestStats.get(request_id)
+
+        if not request_stats:
+            self.response.out.write("Profiler stats no longer exist for this request.")
+            return
+
+        if not request_stats.trace_events:
+            self.response.out.write("No trace available for this profile")
+            return
+
+        self.response.headers['Content-Disposition'] = (
+                'attachment; filename="g-m-p-%s.trace.json"' % str(request_id))
+        self.response.headers['Content-type'] = "application/octet-stream"
+        self.response.out.write(request_stats.trace_events)
+
+
+class LineProfileSessionHandler(RequestHandler):
+    """Handler for line-by-line profiling sessions, which accumulate line
+    timings across many requests.
+
+    GET returns the current session's aggregated line report as JSON. POST
+    starts a new session, replacing any current one, with these parameters:
+
+        path_prefix: only requests whose path starts with this are added
+        requests: the number of requests to add
+        minutes: how long the session lasts at most
+        targets: comma-separated functions to profile, as for the
+            g-m-p-line-targets cookie
+
+    or stops the current session if action=stop.
+    """
+    def get(self):
+        self.response.headers["Content-Type"] = "application/json"
+
+        # The report includes the app's source, and unlike other profiles
+        # isn't looked up by an unguessable request id.
+        if not config.should_profile():
+            self.error(403)
+            return
+
+        # Note that we don't import linebyline_profiler at the top of this
+        # file so we don't bring in a lot of imports for users who don't have
+        # the profiler enabled.
+        from . import linebyline_profiler
+        session = linebyline_profiler.Session.get()
+        self.response.out.write(json.dumps(session and session.results()))
+
+    def post(self):
+        self.response.headers["Content-Type"] = "application/json"
+
+        # Only those who'd be profiled get to choose what's profiled.
+        if not config.should_profile():
+            self.error(403)
+            return
+
+        from . import linebyline_profiler
+        if self.request.get("action") == "stop":
+            session = linebyline_profiler.Session.get()
+            if session:
+                session.stopped = True
+                session.store()
+        else:
+            try:
+                max_requests = int(self.request.get("requests", 100))
+                minutes = int(self.request.get("minutes", 60))
+            except ValueError:
+                max_requests = minutes = 0
+            if max_requests <= 0 or minutes <= 0:
+                self.error(400)
+                self.response.out.write(json.dumps(
+                    "requests and minutes must be positive integers"))
+                return
+
+            session = linebyline_profiler.Session(
+                path_prefix=self.request.get("path_prefix", "/"),
+                max_requests=max_requests,
+                duration_seconds=60 * minutes,
+                targets=get_line_targets({
+                    "HTTP_G_M_P_LINE_TARGETS": self.request.get("targets")}))
+            session.store()
+
+        self.response.out.write(json.dumps(session and session.summary()))
 
 
 class SharedStatsHandler(RequestHandler):
@@ -315,7 +655,7 @@ class RequestStats(object):
     
     serialized_properties = ["request_id", "url",
                              "profiler_results", "appstats_results", "mode",
-                             "temporary_redirect", "logs",
+                             "temporary_redirect", "logs", "logs_truncated_count",
                              "logging_request_id", "stackdriver_trace_id"]
 
     def __init__(self, profiler, environ):
@@ -342,15 +682,27 @@ class RequestStats(object):
         self.start_dt = datetime.datetime.now()
 
         self.profiler_results = profiler.profiler_results()
-        self.appstats_results = profiler.appstats_results()
+        # Raw cProfile stats are kept out of profiler_results so they're
+        # stored once, in binary, instead of being sent with every profile.
+        self.raw_stats = profiler.raw_stats()
+        # The same goes for the tracing profiler's timeline.
+        self.trace_events = profiler.trace_events()
+        self.appstats_results = profiler.appstats_results(
+            environ.get("PATH_INFO", ""))
         self.logs = profiler.logs
+        self.logs_truncated_count = profiler.logs_truncated_count
 
         self.temporary_redirect = profiler.temporary_redirect
         self.disabled = False
 
+    # Profiles stored before raw_stats was split out don't have it.
+    raw_stats = None
+    trace_events = None
+    logs_truncated_count = 0
+
     def store(self):
         # Store compressed results to minimize number of chunks.
-        pickled = pickle.dumps(self)
+        pickled = pickle.dumps(self, pickle.HIGHEST_PROTOCOL)
         compressed_pickled = zlib.compress(pickled)
         setmap = {}
 
@@ -391,15 +743,130 @@ class RequestStats(object):
         return "__gae_mini_profiler_request_%s_%s" % (request_id, index)
 
 
-class ThreadFilter(logging.Filter):
-    "A logging filter that only allows records from the creating thread."""
+class LogDispatcher(logging.Handler):
+    """The one logging handler the profiler adds to the root logger.
 
-    def __init__(self, *args, **kwargs):
-        super(ThreadFilter, self).__init__(*args, **kwargs)
-        self.currentThreadIdent = threading.current_thread().ident
+    Rather than each profiled request adding a handler of its own, filtered
+    to its thread, which every log call would then run through, and which
+    would change the root logger's handlers under the logging lock as each
+    request starts and ends, this handler is added once. It hands each
+    record to the LogCapture of the thread that logged it, if that thread is
+    serving a profiled request, with a single dict lookup.
+    """
+
+    # Thread ident -> LogCapture of the profiled request it's serving. (Keyed
+    # by thread ident rather than kept in a threading.local() because the
+    # devserver resets those on Thread.start.)
+    _captures = {}
+
+    _install_lock = threading.Lock()
+    _installed = False
+
+    @staticmethod
+    def install():
+        """Add the dispatcher to the root logger, if it hasn't been already."""
+        if LogDispatcher._installed:
+            return
+        with LogDispatcher._install_lock:
+            if not LogDispatcher._installed:
+                logging.getLogger().addHandler(LogDispatcher())
+                LogDispatcher._installed = True
+
+    @staticmethod
+    def set_capture(capture):
+        """Send the current thread's log records to capture, or nowhere if
+        it's None."""
+        ident = threading.current_thread().ident
+        if capture is None:
+            LogDispatcher._captures.pop(ident, None)
+        else:
+            LogDispatcher._captures[ident] = capture
+
+    def handle(self, record):
+        # Each capture is only added to by its own thread, so this skips the
+        # handler lock that Handler.handle() takes.
+        capture = LogDispatcher._captures.get(record.thread)
+        if capture is None:
+            return False
+        capture.add(record)
+        return True
+
+    def emit(self, record):
+        self.handle(record)
+
+
+class LogCapture(object):
+    """Keeps a request's log records, sent by LogDispatcher, as compact
+    tuples.
+
+    Each record is kept as (level, ms since start, function, file, line,
+    message). Messages and tracebacks are formatted as they're logged, so
+    later changes to their arguments don't show and the arguments aren't kept
+    alive. Past max_records records, or max_bytes bytes of messages, records
+    are dropped or cut short, and counted in truncated_count.
+    """
+
+    def __init__(self, start, max_records=MAX_LOG_RECORDS,
+                 max_bytes=MAX_LOG_BYTES):
+        self.start = start
+        self.max_records = max_records
+        self.max_bytes = max_bytes
+        self.records = []
+        self.truncated_count = 0
+        self.bytes_left = max_bytes
+
+    # Only used for formatting exceptions
+    _formatter = logging.Formatter()
+
+    def add(self, record):
+        if len(self.records) >= self.max_records:
+            self.truncated_count += 1
+            return
 
-    def filter(self, _):
-        return self.currentThreadIdent == threading.current_thread().ident
+        if not self.bytes_left:
+            # Past the byte budget there's no point formatting anything.
+            message = "..."
+            self.truncated_count += 1
+        else:
+            message = self.format_message(record)
+            if len(message) > self.bytes_left:
+                message = message[:self.bytes_left] + "..."
+                self.truncated_count += 1
+            self.bytes_left = max(0, self.bytes_left - len(message))
+
+        self.records.append((record.levelno,
+                             (record.created - self.start) * 1000,
+                             record.funcName, record.filename, record.lineno,
+                             message))
+
+    def format_message(self, record):
+        """Return a record's message, followed by its traceback if any."""
+        try:
+            message = record.msg % record.args if record.args else record.msg
+            if not isinstance(message, basestring):
+                message = str(message)
+        except Exception:
+            message = str(record.msg)
+        if record.exc_info:
+            # Tracebacks are formatted right away, before their frames move
+            # on.
+            exc_text = self._formatter.formatException(record.exc_info)
+            message = "%s\n%s" % (message, exc_text) if message else exc_text
+        return message
+
+    def logs(self):
+        """Return the records as [level, ms since start, function, file,
+        line, message] lists."""
+        return [[str(levelno), "%.1f" % ms, func_name, filename, str(lineno),
+                 message]
+                for levelno, ms, func_name, filename, lineno, message
+                    in self.records]
+
+    def timeline(self):
+        """Return the records as (timestamp, level name, message) tuples."""
+        return [(self.start + ms / 1000, logging.getLevelName(levelno),
+                 message)
+                for levelno, ms, _, _, _, message in self.records]
 
 
 class RequestProfiler(object):
@@ -411,9 +878,12 @@ class RequestProfiler(object):
         self.instrumented_prof = None
         self.sampling_prof = None
         self.linebyline_prof = None
+        self.tracing_prof = None
         self.appstats_prof = None
         self.temporary_redirect = False
+        self.log_capture = None
         self.logs = None
+        self.logs_truncated_count = 0
         self.logging_request_id = self.get_logging_request_id()
         self.start = None
         self.end = None
@@ -435,14 +905,35 @@ class RequestProfiler(object):
             results["cpuprofile"] = self.sampling_prof.cpuprofile_results()
         elif self.linebyline_prof:
             results.update(self.linebyline_prof.results())
+        elif self.tracing_prof:
+            results.update(self.tracing_prof.results())
 
         return results
 
-    def appstats_results(self):
+    def raw_stats(self):
+        """Return the marshaled cProfile stats for this request, if any."""
+        if self.instrumented_prof:
+            return self.instrumented_prof.raw_stats()
+        return None
+
+    def trace_events(self):
+        """Return the tracing profiler's timeline for this request, with any
+        RPCs merged in, as trace event JSON, if any."""
+        if self.tracing_prof:
+            recorder = self.appstats_prof and self.appstats_prof.recorder
+            return self.tracing_prof.trace_events(
+                recorder, self.log_capture.timeline())
+        return None
+
+    def appstats_results(self, path=None):
         """Return the RPC profiler (appstats) results for this request, if any.
 
         This will return a dictionary containing results from appstats or an
-        empty result set if appstats profiling is disabled."""
+        empty result set if appstats profiling is disabled.
+
+        If path is given, the request's datastore ledger is added to the
+        running totals for requests to path and compared with the earlier
+        ones."""
 
         results = {
                 "calls": [],
@@ -450,7 +941,21 @@ class RequestProfiler(object):
                 }
 
         if self.appstats_prof:
-            results.update(self.appstats_prof.results())
+            wall_time_ms = (self.end - self.start) * 1000
+            results.update(self.appstats_prof.results(
+                wall_time_ms=wall_time_ms))
+
+            ledger = results.get("datastore_ledger")
+            if ledger and path is not None:
+                from . import appstats_profiler
+                route_totals = appstats_profiler.add_to_route_ledger(
+                    path, ledger, wall_time_ms)
+                results["route"] = util.route(path)
+                results["route_request_count"] = (
+                    route_totals["request_count"] if route_totals else 0)
+                results["datastore_ledger_rows"] = (
+                    appstats_profiler.datastore_ledger_rows(
+                        ledger, wall_time_ms, route_totals))
 
         return results
 
@@ -477,64 +982,96 @@ class RequestProfiler(object):
 
         if self.mode == Mode.SIMPLE:
 
-            # Detailed recording is disabled.
+            # Detailed recording is disabled, so the app's response is handed
+            # back as is and the request is timed until the app returns it.
             result = app(environ, start_response)
-            for value in result:
-                yield value
-
-        else:
-
-            # Add logging handler
-            handler = RequestProfiler.create_handler()
-            logging.getLogger().addHandler(handler)
-
-            if Mode.is_rpc_enabled(self.mode):
-                # Turn on AppStats monitoring for this request
-                # Note that we don't import appstats_profiler at the top of
-                # this file so we don't bring in a lot of imports for users who
-                # don't have the profiler enabled.
+            self.end = time.time()
+            RequestStats(self, environ).store()
+            return result
+
+        return self.profile_response(app, environ, start_response)
+
+    def profile_response(self, app, environ, start_response):
+        """Yield the response of a request profiled in the detailed modes,
+        recording the stats once it's done."""
+
+        # Capture this thread's log records
+        self.log_capture = LogCapture(self.start)
+        LogDispatcher.install()
+        LogDispatcher.set_capture(self.log_capture)
+
+        if Mode.is_rpc_enabled(self.mode):
+            # Turn on AppStats monitoring for this request, or record RPCs
+            # with API proxy hooks if that's configured instead.
+            # Note that we don't import appstats_profiler at the top of
+            # this file so we don't bring in a lot of imports for users who
+            # don't have the profiler enabled.
+            rpc_capture_options = config.rpc_capture_options()
+            if config.rpc_profiler() == "hooks":
+                from . import rpc_hook_profiler
+                self.appstats_prof = rpc_hook_profiler.Profile(
+                    **rpc_capture_options)
+            else:
                 from . import appstats_profiler
-                self.appstats_prof = appstats_profiler.Profile()
-                app = self.appstats_prof.wrap(app)
-
-            # By default, we create a placeholder wrapper function that
-            # simply calls whatever function it is passed as its first
-            # argument.
-            result_fxn_wrapper = lambda fxn: fxn()
-
-            # TODO(kamens): both sampling_profiler and instrumented_profiler
-            # could subclass the same class. Then they'd both be guaranteed to
-            # implement run(), and the following if/else could be simplified.
-            if Mode.is_sampling_enabled(self.mode):
-                # Turn on sampling profiling for this request.
-                # Note that we don't import sampling_profiler at the top of
-                # this file so we don't bring in a lot of imports for users who
-                # don't have the profiler enabled.
-                from . import sampling_profiler
-                if Mode.is_memory_sampling_enabled(self.mode):
-                    self.sampling_prof = sampling_profiler.Profile(
-                        memory_sample_rate=25)
-                else:
-                    self.sampling_prof = sampling_profiler.Profile()
-                result_fxn_wrapper = self.sampling_prof.run
-
-            elif Mode.is_linebyline_enabled(self.mode):
-                from . import linebyline_profiler
-                self.linebyline_prof = linebyline_profiler.Profile()
-                result_fxn_wrapper = self.linebyline_prof.run
-
-            elif Mode.is_instrumented_enabled(self.mode):
-                # Turn on cProfile instrumented profiling for this request
-                # Note that we don't import instrumented_profiler at the top of
-                # this file so we don't bring in a lot of imports for users who
-                # don't have the profiler enabled.
-                from . import instrumented_profiler
+                self.appstats_prof = appstats_profiler.Profile(
+                    **rpc_capture_options)
+            app = self.appstats_prof.wrap(app)
+
+        # By default, we create a placeholder wrapper function that
+        # simply calls whatever function it is passed as its first
+        # argument.
+        result_fxn_wrapper = lambda fxn: fxn()
+
+        # TODO(kamens): both sampling_profiler and instrumented_profiler
+        # could subclass the same class. Then they'd both be guaranteed to
+        # implement run(), and the following if/else could be simplified.
+        if Mode.is_sampling_enabled(self.mode):
+            # Turn on sampling profiling for this request.
+            # Note that we don't import sampling_profiler at the top of
+            # this file so we don't bring in a lot of imports for users who
+            # don't have the profiler enabled.
+            from . import sampling_profiler
+            folding_rules = config.frame_folding_rules()
+            if Mode.is_memory_sampling_enabled(self.mode):
+                self.sampling_prof = sampling_profiler.Profile(
+                    memory_sample_rate=25,
+                    frame_folding_rules=folding_rules)
+            else:
+                self.sampling_prof = sampling_profiler.Profile(
+                    frame_folding_rules=folding_rules)
+            result_fxn_wrapper = self.sampling_prof.run
+
+        elif Mode.is_linebyline_enabled(self.mode):
+            from . import linebyline_profiler
+            self.linebyline_prof = linebyline_profiler.Profile(
+                targets=get_line_targets(environ),
+                path=environ.get("PATH_INFO", ""))
+            result_fxn_wrapper = self.linebyline_prof.run
+
+        elif Mode.is_tracing_enabled(self.mode):
+            from . import tracing_profiler
+            self.tracing_prof = tracing_profiler.Profile(
+                util.module_filter(config.traced_module_prefixes()))
+            result_fxn_wrapper = self.tracing_prof.run
+
+        elif Mode.is_instrumented_enabled(self.mode):
+            # Turn on cProfile instrumented profiling for this request
+            # Note that we don't import instrumented_profiler at the top of
+            # this file so we don't bring in a lot of imports for users who
+            # don't have the profiler enabled.
+            from . import instrumented_profiler
+            if Mode.is_filtered_instrumented_enabled(self.mode):
+                self.instrumented_prof = instrumented_profiler.Profile(
+                    should_track=util.module_filter(
+                        config.instrumented_module_prefixes()))
+            else:
                 self.instrumented_prof = instrumented_profiler.Profile()
-                result_fxn_wrapper = self.instrumented_prof.run
+            result_fxn_wrapper = self.instrumented_prof.run
 
-            # Get wsgi result
-            result = result_fxn_wrapper(lambda: app(environ, start_response))
+        # Get wsgi result
+        result = result_fxn_wrapper(lambda: app(environ, start_response))
 
+        try:
             # If we're dealing w/ a generator, profile all of the .next calls as well
             if type(result) == GeneratorType:
 
@@ -547,16 +1084,39 @@ class RequestProfiler(object):
             else:
                 for value in result:
                     yield value
+        finally:
+            # Close the app's response as a WSGI server would.
+            if hasattr(result, "close"):
+                result.close()
 
-            logging.getLogger().removeHandler(handler)
-            self.logs = self.get_logs(handler)
-            handler.stream.close()
+        LogDispatcher.set_capture(None)
+        self.logs = self.log_capture.logs()
+        self.logs_truncated_count = self.log_capture.truncated_count
 
         self.end = time.time()
 
+        # These write to memcache, so they come after the request's end.
+        if self.linebyline_prof:
+            self.linebyline_prof.add_to_session()
+        elif self.sampling_prof:
+            self.nominate_hotspots(environ.get("PATH_INFO", ""))
+
         # Store stats for later access
         RequestStats(self, environ).store()
 
+    def nominate_hotspots(self, path):
+        """Add the time the sampling profiler found was spent in each app
+        function to the totals for path's route, whose hottest functions are
+        profiled line-by-line on later requests to it.
+
+        The app's functions are those the filtered instrumented mode tracks,
+        as set by config.instrumented_module_prefixes()."""
+        from . import linebyline_profiler
+        code_times = self.sampling_prof.tracked_times(
+            util.module_filter(
+                config.instrumented_module_prefixes()))
+        linebyline_profiler.nominate_hotspots(path, code_times)
+
     def get_logging_request_id(self):
         """Return the identifier for this request used by GAE's logservice.
 
@@ -566,40 +1126,6 @@ class RequestProfiler(object):
         """
         return os.environ.get("REQUEST_LOG_ID", None)
 
-    @staticmethod
-    def create_handler():
-        handler = logging.StreamHandler(StringIO.StringIO())
-        handler.setLevel(logging.DEBUG)
-        formatter = logging.Formatter("\t".join([
-            '%(levelno)s',
-            '%(asctime)s%(msecs)d',
-            '%(funcName)s',
-            '%(filename)s',
-            '%(lineno)d',
-            '%(message)s',
-        ]), '%M:%S.')
-        handler.setFormatter(formatter)
-        handler.addFilter(ThreadFilter())
-        return handler
-
-    @staticmethod
-    def get_logs(handler):
-        raw_lines = [l for l in handler.stream.getvalue().split("\n") if l]
-
-        lines = []
-        for line in raw_lines:
-            if "\t" in line:
-                fields = line.split("\t")
-                lines.append(fields)
-            else: # line is part of a multiline log message (prob a traceback)
-                prevline = lines[-1][-1]
-                if prevline: # ignore leading blank lines in the message
-                    prevline += "\n"
-                prevline += line
-                lines[-1][-1] = prevline
-
-        return lines
-
 class ProfilerWSGIMiddleware(object):
 
     def __init__(self, app):
@@ -610,64 +1136,81 @@ class ProfilerWSGIMiddleware(object):
         CurrentRequestId.set(None)
 
         # Never profile calls to the profiler itself to avoid endless recursion.
-        if (not config.should_profile() or
-            environ.get("PATH_INFO", "").startswith("/gae_mini_profiler/")):
-            result = self.app(environ, start_response)
-            for value in result:
-                yield value
-        else:
-            # Set a random ID for this request so we can look up stats later
-            import base64
-            CurrentRequestId.set(base64.urlsafe_b64encode(os.urandom(5)))
-
-            # Send request id in headers so jQuery ajax calls can pick
-            # up profiles.
-            def profiled_start_response(status, headers, exc_info = None):
-
-                if status.startswith("302 "):
-                    # Temporary redirect. Add request identifier to redirect location
-                    # so next rendered page can show this request's profile.
-                    headers = ProfilerWSGIMiddleware.headers_with_modified_redirect(environ, headers)
-                    # Access the profiler in closure scope
-                    profiler.temporary_redirect = True
-
-                # Append headers used when displaying profiler results from ajax requests
-                headers.append(("X-MiniProfiler-Id", CurrentRequestId.get()))
-                headers.append(("X-MiniProfiler-QS", environ.get("QUERY_STRING")))
-
-                return start_response(status, headers, exc_info)
-
-            # As a simple form of rate-limiting, appstats protects all
-            # its work with a memcache lock to ensure that only one
-            # appstats request ever runs at a time, across all
-            # appengine instances.  (GvR confirmed this is the purpose
-            # of the lock).  So our attempt to profile will fail if
-            # appstats is running on another instance.  Boo-urns!  We
-            # just turn off the lock-checking for us, which means we
-            # don't rate-limit quite as much with the mini-profiler as
-            # we would do without.
-            old_memcache_add = memcache.add
-            old_memcache_delete = memcache.delete
-            memcache.add = (lambda key, *args, **kwargs:
-                                (True if key == recording.lock_key()
-                                 else old_memcache_add(key, *args, **kwargs)))
-            memcache.delete = (lambda key, *args, **kwargs:
-                                   (True if key == recording.lock_key()
-                                    else old_memcache_delete(key, *args, **kwargs)))
-
+        admission = None
+        path = environ.get("PATH_INFO", "")
+        if (config.should_profile() and
+                not path.startswith("/gae_mini_profiler/")):
+            admission = policy.get().admit(path)
+
+        if not admission:
+            # Hand back the app's own response, so unprofiled requests keep
+            # its close() and wsgi.file_wrapper and cost nothing per chunk.
+            return self.app(environ, start_response)
+
+        # Set a random ID for this request so we can look up stats later
+        import base64
+        profiler = RequestProfiler(base64.urlsafe_b64encode(os.urandom(5)),
+                                   admission.mode or Mode.get_mode(environ))
+
+        # Send request id in headers so jQuery ajax calls can pick
+        # up profiles.
+        def profiled_start_response(status, headers, exc_info = None):
+
+            if status.startswith("302 "):
+                # Temporary redirect. Add request identifier to redirect location
+                # so next rendered page can show this request's profile.
+                headers = ProfilerWSGIMiddleware.headers_with_modified_redirect(
+                    environ, headers, profiler.request_id)
+                profiler.temporary_redirect = True
+
+            # Append headers used when displaying profiler results from ajax requests
+            headers.append(("X-MiniProfiler-Id", profiler.request_id))
+            headers.append(("X-MiniProfiler-QS", environ.get("QUERY_STRING")))
+
+            return start_response(status, headers, exc_info)
+
+        if profiler.mode == Mode.SIMPLE:
+            # Only the request as a whole is timed, so there's nothing to
+            # do while the response is iterated, but the request isn't over
+            # until the server closes it.
+            ProfilerWSGIMiddleware.start_request(profiler)
             try:
-                profiler = RequestProfiler(CurrentRequestId.get(),
-                                           Mode.get_mode(environ))
-                result = profiler.profile_start_response(self.app, environ, profiled_start_response)
-                for value in result:
-                    yield value
-            finally:
-                CurrentRequestId.set(None)
-                memcache.add = old_memcache_add
-                memcache.delete = old_memcache_delete
+                result = profiler.profile_start_response(
+                    self.app, environ, profiled_start_response)
+            except:
+                ProfilerWSGIMiddleware.end_request(admission)
+                raise
+            return SimpleResponse(result, admission)
+
+        return ProfiledResponse(self.app, profiler, environ,
+                                profiled_start_response, admission)
+
+    @staticmethod
+    def start_request(profiler):
+        """Set up this thread's profiling state for a request profiled by
+        profiler."""
+        CurrentRequestId.set(profiler.request_id)
+
+        # Appstats would refuse to record this request while it's
+        # recording one anywhere else.  (RPCs recorded with API proxy
+        # hooks don't go through appstats, so there's no lock to skip, and
+        # neither is there in modes that don't record RPCs.)
+        if (Mode.is_rpc_enabled(profiler.mode) and
+                config.rpc_profiler() != "hooks"):
+            AppstatsLock.install()
+            AppstatsLock.set_skipped(True)
 
     @staticmethod
-    def headers_with_modified_redirect(environ, headers):
+    def end_request(admission):
+        """Reset this thread's profiling state once a profiled request is
+        done."""
+        CurrentRequestId.set(None)
+        AppstatsLock.set_skipped(False)
+        LogDispatcher.set_capture(None)
+        admission.release()
+
+    @staticmethod
+    def headers_with_modified_redirect(environ, headers, request_id):
         """Return headers with redirects modified to include miniprofiler id.
 
         If this response is a redirect, we want the URL that's redirected *to*
@@ -693,7 +1236,7 @@ class ProfilerWSGIMiddleware(object):
                 reg = re.compile("mp-r-id=([^&]+)")
 
                 # Keep any chain of redirects around
-                request_id_chain = CurrentRequestId.get()
+                request_id_chain = request_id
                 match = reg.search(environ.get("QUERY_STRING"))
                 if match:
                     request_id_chain = ",".join([match.groups()[0], request_id_chain])
@@ -715,3 +1258,76 @@ class ProfilerWSGIMiddleware(object):
                 headers_modified.append(header)
 
         return headers_modified
+
+
+class SimpleResponse(object):
+    """The response of a request profiled in the simple mode: the app's
+    response, which ends the request and releases its admission when it's
+    closed."""
+
+    def __init__(self, result, admission):
+        self.result = result
+        self.admission = admission
+
+    def __iter__(self):
+        return iter(self.result)
+
+    def close(self):
+        try:
+            if hasattr(self.result, "close"):
+                self.result.close()
+        finally:
+            admission, self.admission = self.admission, None
+            if admission is not None:
+                ProfilerWSGIMiddleware.end_request(admission)
+
+
+class ProfiledResponse(object):
+    """The response of a request profiled in the detailed modes.
+
+    The request is only set up to be profiled once the response is iterated,
+    and closing the response, which WSGI servers do even if they never
+    iterate it, ends the request and releases its admission.
+    """
+
+    def __init__(self, app, profiler, environ, start_response, admission):
+        self.app = app
+        self.profiler = profiler
+        self.environ = environ
+        self.start_response = start_response
+        self.admission = admission
+        self.iterator = None
+
+    def __iter__(self):
+        if self.iterator is None:
+            self.iterator = self.profiled_response()
+        return self.iterator
+
+    def profiled_response(self):
+        """Yield the response, profiled by self.profiler."""
+        result = None
+        try:
+            ProfilerWSGIMiddleware.start_request(self.profiler)
+            result = self.profiler.profile_start_response(
+                self.app, self.environ, self.start_response)
+            for value in result:
+                yield value
+        finally:
+            try:
+                if hasattr(result, "close"):
+                    result.close()
+            finally:
+                self.end_request()
+
+    def close(self):
+        if self.iterator is not None:
+            # Stops the app's response and the profilers part way, if the
+            # server stops early.
+            self.iterator.close()
+        self.end_request()
+
+    def end_request(self):
+        """End the request the first time this is called."""
+        admission, self.admission = self.admission, None
+        if admission is not None:
+            ProfilerWSGIMiddleware.end_request(admission)
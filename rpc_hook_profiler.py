@@ -0,0 +1,364 @@
+# TODO(colin): fix these lint errors (http://pep8.readthedocs.io/en/release-1.7.x/intro.html#error-codes)
+# pep8-disable:E302,E501
+"""RPC profiler that times RPCs with API proxy hooks instead of appstats.
+
+The appstats profiler (appstats_profiler.py) runs each request through
+appstats' WSGI middleware, which records a full stack trace and a formatted
+copy of the request and response of every RPC while it's being made, and
+guards all of its work with a memcache lock shared across instances, which
+ProfilerWSGIMiddleware has to patch around.
+
+This profiler adds its own hooks to the API proxy instead. For each RPC, they
+record the service and method, start and end times, the request and response,
+and the innermost few frames of the code that made the call. The byte sizes
+of the request and response are only worked out, and they're only formatted
+as far as needed for a summary, once the request is done. Datastore RPCs'
+operations are counted for the request's datastore ledger as they finish. The results have the same shape as
+the appstats profiler's, so everything that reads them works the same way.
+
+PRO: much less overhead per RPC, no shared lock, and no appstats record to
+save at the end of the request.
+
+CON: there's no appstats page to cross-reference.
+
+How much of each RPC is captured is set by config.rpc_capture_options(), as
+for the appstats profiler. Past the first detailed_calls_per_site RPCs from a
+call stack, only the byte sizes of the request and response are kept.
+"""
+
+import os
+import sys
+import threading
+import time
+
+from google.appengine.api import apiproxy_stub_map
+
+import appstats_profiler
+
+# Request and response summaries are cut off at this many characters by
+# default, which matches what appstats_profiler asks appstats for.
+MAX_REPR = 750
+
+# Formatting stops this many objects deep into a request or response.
+MAX_FORMAT_DEPTH = 10
+
+# Protocol buffer attributes that aren't part of the message.
+_SKIPPED_ATTRIBUTES = frozenset(["lazy_init_lock_"])
+
+# Thread ident -> Recorder of the profiled request that thread is serving.
+# (Keyed by thread ident rather than kept in a threading.local() because the
+# devserver resets those on Thread.start.)
+_recorders = {}
+
+# The API proxy our hooks were added to. Tests can replace the API proxy, so
+# the hooks are added again whenever it changes.
+_hooked_apiproxy = None
+
+_HOOK_KEY = "gae_mini_profiler"
+
+_profiler_dir = os.path.dirname(os.path.abspath(__file__))
+
+# skipped_frame_paths -> filename -> whether frames in that file are left out
+# of call stacks
+_skipped_files = {}
+
+def _is_skipped_file(filename, skipped_frame_paths):
+    """Return whether frames in filename are left out of call stacks, which
+    they always are if they're in the profiler itself."""
+    skipped_files = _skipped_files.setdefault(skipped_frame_paths, {})
+    skipped = skipped_files.get(filename)
+    if skipped is None:
+        path = os.path.abspath(filename)
+        skipped = skipped_files[filename] = (
+            path.startswith(_profiler_dir + os.sep) or
+            appstats_profiler.is_skipped_frame(path, skipped_frame_paths))
+    return skipped
+
+
+class StackFrame(object):
+    """One frame of the code that made an RPC, with the accessors of an
+    appstats stack frame."""
+    __slots__ = ["filename", "lineno", "func_name"]
+
+    def __init__(self, filename, lineno, func_name):
+        self.filename = filename
+        self.lineno = lineno
+        self.func_name = func_name
+
+    def class_or_file_name(self):
+        return self.filename
+
+    def line_number(self):
+        return self.lineno
+
+    def function_name(self):
+        return self.func_name
+
+
+class Trace(object):
+    """One RPC, with the accessors of an appstats trace that
+    appstats_profiler.Profile.results() uses."""
+
+    def __init__(self, recorder, service, call, request, stack, detailed):
+        self.recorder = recorder
+        self.service = service
+        self.call = call
+        # Whether the request and response are kept after the RPC finishes
+        self.detailed = detailed
+        self.request = request
+        self.response = None
+        # Byte sizes of the request and response, if they aren't kept
+        self.request_bytes = None
+        self.response_bytes = None
+        self.error = None
+        # cleanup.DATASTORE_LEDGER_FIELDS -> counts, for datastore RPCs
+        self.datastore_ops = None
+        # (code, line number) of each frame
+        self.stack = stack
+        self.start = time.time()
+        self.end = None
+
+    def finish(self, response, error):
+        self.end = time.time()
+        self.error = error
+        if self.service == "datastore_v3":
+            # Counted now, since the request isn't always kept.
+            self.datastore_ops = appstats_profiler.message_datastore_operations(
+                self.call, self.request, response if error is None else None)
+        if self.detailed:
+            self.response = response
+        else:
+            # Only the sizes of RPCs past their call site's quota are kept.
+            self.request_bytes = appstats_profiler.byte_size(self.request)
+            if error is None:
+                self.response_bytes = appstats_profiler.byte_size(response)
+            self.request = None
+
+    def request_size_bytes(self):
+        if not self.detailed:
+            return self.request_bytes
+        return appstats_profiler.byte_size(self.request)
+
+    def response_size_bytes(self):
+        if not self.detailed:
+            return self.response_bytes
+        if self.error is not None or self.response is None:
+            return None
+        return appstats_profiler.byte_size(self.response)
+
+    def datastore_operations(self):
+        if self.service != "datastore_v3":
+            return {}
+        return self.datastore_ops
+
+    def service_call_name(self):
+        return "%s.%s" % (self.service, self.call)
+
+    def start_offset_milliseconds(self):
+        return (self.start - self.recorder.start_timestamp) * 1000
+
+    def duration_milliseconds(self):
+        return ((self.end or self.recorder.end_timestamp or time.time()) -
+                self.start) * 1000
+
+    def call_stack_list(self):
+        return [StackFrame(code.co_filename, lineno, code.co_name)
+                for code, lineno in self.stack]
+
+    def request_data_summary(self):
+        if not self.detailed:
+            return ""
+        return format_value(self.request, self.recorder.repr_limit)
+
+    def response_data_summary(self):
+        if self.error is not None:
+            return "%s: %s" % (type(self.error).__name__, self.error)
+        if not self.detailed:
+            return ""
+        return format_value(self.response, self.recorder.repr_limit)
+
+
+class Recorder(object):
+    """The RPCs made while serving a request, with the attributes of an
+    appstats recorder that the profilers use."""
+
+    def __init__(self, stack_depth=None, skipped_frame_paths=(),
+                 repr_limit=MAX_REPR, detailed_calls_per_site=None):
+        self.stack_depth = stack_depth
+        self.skipped_frame_paths = tuple(skipped_frame_paths)
+        self.repr_limit = repr_limit
+        self.detailed_calls_per_site = detailed_calls_per_site
+        self.start_timestamp = time.time()
+        self.end_timestamp = None
+        self.traces = []
+
+        # (service, call, call stack) -> number of RPCs made from there
+        self.site_call_counts = {}
+
+        # id of an RPC (or of its request, for RPCs made without one) ->
+        # its Trace, until it finishes
+        self.pending = {}
+
+    def call_stack(self, frame):
+        """Return (code, line number) pairs for the innermost frames of
+        frame's stack that aren't skipped, innermost first.
+
+        This runs for every RPC, so it avoids function calls per frame.
+        """
+        stack = []
+        skipped_files = _skipped_files.get(self.skipped_frame_paths, {})
+        stack_depth = self.stack_depth
+        while frame is not None and len(stack) != stack_depth:
+            code = frame.f_code
+            skipped = skipped_files.get(code.co_filename)
+            if skipped is None:
+                skipped = _is_skipped_file(code.co_filename,
+                                           self.skipped_frame_paths)
+            if not skipped:
+                stack.append((code, frame.f_lineno))
+            frame = frame.f_back
+        return stack
+
+    def is_detailed(self, service, call, stack):
+        """Count an RPC made from stack, and return whether it's within the
+        call site's quota of RPCs to keep in full."""
+        if self.detailed_calls_per_site is None:
+            return True
+        site = (service, call, tuple(stack))
+        count = self.site_call_counts[site] = self.site_call_counts.get(site, 0) + 1
+        return count <= self.detailed_calls_per_site
+
+
+def _pre_call_hook(service, call, request, response, rpc):
+    recorder = _recorders.get(threading.current_thread().ident)
+    if recorder is None:
+        return
+    stack = recorder.call_stack(sys._getframe(1))
+    trace = Trace(recorder, service, call, request, stack,
+                  recorder.is_detailed(service, call, stack))
+    recorder.pending[id(rpc if rpc is not None else request)] = trace
+    recorder.traces.append(trace)
+
+def _post_call_hook(service, call, request, response, rpc, error):
+    recorder = _recorders.get(threading.current_thread().ident)
+    if recorder is None:
+        return
+    trace = recorder.pending.pop(id(rpc if rpc is not None else request), None)
+    if trace is not None:
+        trace.finish(response, error)
+
+def _add_hooks():
+    """Add the profiler's hooks to the API proxy, unless they're already
+    there."""
+    global _hooked_apiproxy
+    apiproxy = apiproxy_stub_map.apiproxy
+    if apiproxy is not _hooked_apiproxy:
+        # Append ignores hooks whose key was already added, so adding them
+        # from two threads at once is harmless.
+        apiproxy.GetPreCallHooks().Append(_HOOK_KEY, _pre_call_hook)
+        apiproxy.GetPostCallHooks().Append(_HOOK_KEY, _post_call_hook)
+        _hooked_apiproxy = apiproxy
+
+
+def format_value(value, limit=MAX_REPR, depth=MAX_FORMAT_DEPTH):
+    """Return a summary of an RPC's request or response in the format
+    appstats uses, e.g. MemcacheGetRequest<key_=['a', 'b']>, which
+    unformatter can parse, cut off at limit characters."""
+    parts = []
+    _format_value(value, depth, parts, [limit])
+    text = "".join(parts)
+    if len(text) > limit:
+        text = text[:limit - 3] + "..."
+    return text
+
+def _format_value(value, depth, parts, budget):
+    """Append the parts of the summary of value to parts, until the budget,
+    a list holding the number of characters left, runs out."""
+    if budget[0] <= 0 or depth <= 0:
+        parts.append("...")
+        budget[0] -= 3
+        return
+
+    if isinstance(value, (list, tuple)):
+        parts.append("[")
+        budget[0] -= 1
+        for i, item in enumerate(value):
+            if i:
+                parts.append(", ")
+                budget[0] -= 2
+            _format_value(item, depth - 1, parts, budget)
+            if budget[0] <= 0:
+                break
+        parts.append("]")
+        budget[0] -= 1
+
+    elif hasattr(value, "__dict__") and not isinstance(value, type):
+        parts.append("%s<" % type(value).__name__)
+        budget[0] -= len(parts[-1])
+        first = True
+        for name, item in sorted(value.__dict__.iteritems()):
+            if name in _SKIPPED_ATTRIBUTES:
+                continue
+            parts.append("%s=" % name if first else ", %s=" % name)
+            budget[0] -= len(parts[-1])
+            first = False
+            _format_value(item, depth - 1, parts, budget)
+            if budget[0] <= 0:
+                break
+        parts.append(">")
+        budget[0] -= 1
+
+    else:
+        if isinstance(value, basestring) and len(value) > budget[0]:
+            # Don't escape more of a long string than can be shown.
+            value = value[:budget[0]]
+        text = repr(value)
+        if len(text) > budget[0]:
+            text = text[:max(budget[0], 0)] + "..."
+        parts.append(text)
+        budget[0] -= len(text)
+
+
+class Profile(appstats_profiler.Profile):
+    """Profiler that records RPCs with API proxy hooks, and reports them like
+    appstats_profiler.Profile does."""
+    def __init__(self, stack_depth=None, skipped_frame_paths=(),
+                 repr_limit=MAX_REPR, detailed_calls_per_site=None):
+        super(Profile, self).__init__(stack_depth, skipped_frame_paths,
+                                      repr_limit, detailed_calls_per_site)
+
+    def results(self, wall_time_ms=None):
+        """Return the RPC results in a dictionary for template context."""
+        results = super(Profile, self).results(wall_time_ms)
+        # There's no appstats record of this request.
+        results["appstats_key"] = None
+        return results
+
+    def wrap(self, app):
+        """Wrap and return a WSGI application with RPC recording enabled.
+
+        Args:
+            app: existing WSGI application to be wrapped
+        Returns:
+            new WSGI application that will run the original app with RPCs
+                recorded.
+        """
+        def wrapped_rpc_hook_app(environ, start_response):
+            _add_hooks()
+            ident = threading.current_thread().ident
+            self.recorder = _recorders[ident] = Recorder(
+                self.stack_depth, self.skipped_frame_paths, self.repr_limit,
+                self.detailed_calls_per_site)
+            try:
+                result = app(environ, start_response)
+                try:
+                    for value in result:
+                        yield value
+                finally:
+                    if hasattr(result, "close"):
+                        result.close()
+            finally:
+                _recorders.pop(ident, None)
+                self.recorder.end_timestamp = time.time()
+
+        return wrapped_rpc_hook_app
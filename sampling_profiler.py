@@ -108,6 +108,82 @@ class InspectingThread(threading.Thread):
         self.profile.take_sample(sample_number, force_memory=True)
 
 
+# Stand-in for a code object, used for the synthetic frame that a run of
+# collapsed frames is replaced with.
+FoldedCode = collections.namedtuple(
+    "FoldedCode", ["co_filename", "co_name", "co_firstlineno"])
+
+
+class FrameFolder(object):
+    """Decides which sampled frames to keep, drop, or collapse.
+
+    "rules" is a list of (matcher, action) pairs as described in
+    config.frame_folding_rules(). Since the same code objects show up in
+    nearly every sample, the action for each code object is cached after it's
+    first computed.
+    """
+    DROP = "drop"
+    COLLAPSE = "collapse"
+
+    def __init__(self, rules):
+        self.rules = []
+        for matcher, action in rules:
+            if action not in (FrameFolder.DROP, FrameFolder.COLLAPSE):
+                raise ValueError("Unknown frame folding action: %r" % action)
+            if hasattr(matcher, "match"):
+                label = matcher.pattern
+            else:
+                label = matcher
+            folded_code = FoldedCode(label, "[folded]", 0)
+            self.rules.append((matcher, action, folded_code))
+
+        # code object -> (action, folded code), or None to keep the frame.
+        self._decisions = {}
+
+    def decision(self, frame):
+        """Return (action, folded code) for frame, or None to keep it."""
+        code = frame.f_code
+        try:
+            return self._decisions[code]
+        except KeyError:
+            pass
+
+        module_name = frame.f_globals.get("__name__") or ""
+        decision = None
+        for matcher, action, folded_code in self.rules:
+            if hasattr(matcher, "match"):
+                matched = matcher.match(module_name)
+            else:
+                matched = module_name.startswith(matcher)
+            if matched:
+                decision = (action, folded_code)
+                break
+
+        self._decisions[code] = decision
+        return decision
+
+
+# Rules tuple -> FrameFolder, so decisions stay cached across requests.
+# config.frame_folding_rules() may build new rules for every request, so this
+# is cleared once it holds _MAX_FRAME_FOLDERS of them.
+_frame_folders = {}
+
+_MAX_FRAME_FOLDERS = 1000
+
+
+def get_frame_folder(rules):
+    """Return a (shared) FrameFolder for the given folding rules."""
+    key = tuple(rules)
+    # Only read _frame_folders once, since another thread may clear it.
+    frame_folder = _frame_folders.get(key)
+    if frame_folder is None:
+        frame_folder = FrameFolder(rules)
+        if len(_frame_folders) >= _MAX_FRAME_FOLDERS:
+            _frame_folders.clear()
+        _frame_folders[key] = frame_folder
+    return frame_folder
+
+
 class ProfileSample(object):
     """Single stack trace sample gathered during a periodic inspection."""
     def __init__(self, stack_trace, timestamp_ms):
@@ -117,19 +193,36 @@ class ProfileSample(object):
         self.timestamp_ms = timestamp_ms
 
     @staticmethod
-    def from_frame_and_timestamp(active_frame, timestamp_ms):
+    def from_frame_and_timestamp(active_frame, timestamp_ms,
+                                 frame_folder=None):
         """Creates a profile from the current frame of a particular thread.
 
         The "active_frame" parameter should be the current frame from some
         thread, as returned by sys._current_frames(). Note that we must walk
         the stack trace up-front at sampling time, since it will change out
-        from under us if we wait to access it."""
+        from under us if we wait to access it.
+
+        If "frame_folder" is given, frames it matches are dropped or collapsed
+        into a single synthetic frame as we walk the stack."""
         stack_trace = []
         frame = active_frame
-        while frame is not None:
-            code = frame.f_code
-            stack_trace.append((code, frame.f_lineno))
-            frame = frame.f_back
+        if frame_folder is None:
+            while frame is not None:
+                code = frame.f_code
+                stack_trace.append((code, frame.f_lineno))
+                frame = frame.f_back
+        else:
+            while frame is not None:
+                decision = frame_folder.decision(frame)
+                if decision is None:
+                    stack_trace.append((frame.f_code, frame.f_lineno))
+                else:
+                    action, folded_code = decision
+                    if action == FrameFolder.COLLAPSE and not (
+                            stack_trace and
+                            stack_trace[-1][0] is folded_code):
+                        stack_trace.append((folded_code, 0))
+                frame = frame.f_back
 
         return ProfileSample(stack_trace, timestamp_ms)
 
@@ -150,9 +243,12 @@ class Profile(object):
     If time_fxn is provided, it will be used instead of time.time(); similarly,
     sleep_fxn will be used instead of time.sleep().  This is useful, for
     example, if they have been mocked out in tests.
+
+    If frame_folding_rules is provided, sampled stacks are folded according to
+    those rules (see config.frame_folding_rules()) as they are taken.
     """
     def __init__(self, memory_sample_rate=0, time_fxn=time.time,
-                 sleep_fxn=time.sleep):
+                 sleep_fxn=time.sleep, frame_folding_rules=None):
         # Every self.memory_sample_every'th sample will also record memory.  We
         # want this to be such that this will add up to memory_sample_rate
         # samples per second (approximately).
@@ -174,6 +270,12 @@ class Profile(object):
         # Thread that constantly waits, inspects, waits, inspect, ...
         self.inspecting_thread = None
 
+        # Shared FrameFolder for frame_folding_rules, if any
+        if frame_folding_rules:
+            self.frame_folder = get_frame_folder(frame_folding_rules)
+        else:
+            self.frame_folder = None
+
         self.time_fxn = time_fxn
         self.start_time = time_fxn()
         self.sleep_fxn = sleep_fxn
@@ -214,6 +316,7 @@ class Profile(object):
                     util.short_method_fmt(frame) for frame in frames],
                 "samples": samples,
                 "total_samples": total_samples,
+                "line_hotspots": self.line_results(),
             }
 
         if self.memory_sample_every and self.memory_samples:
@@ -225,6 +328,126 @@ class Profile(object):
 
         return results
 
+    def line_results(self, max_functions=10):
+        """Aggregate sampled time per source line for the hottest functions.
+
+        Every sample's frames carry the line that was executing when the
+        sample was taken, so we can build a statistical line-by-line profile
+        without the _line_profiler C extension.  Each line is credited with
+        inclusive time (any sample in which it was on the stack) and self time
+        (samples in which it was the innermost frame).  Functions are ranked
+        by self time and only the top max_functions are returned.
+
+        The result has the same shape as linebyline_profiler's output, with
+        "self_time_ms" and "self_time_ms_s" added to each timing.
+        """
+        if not self.samples:
+            return []
+
+        # (code, lineno) -> [sample count, inclusive ms, self ms]
+        line_totals = collections.defaultdict(lambda: [0, 0.0, 0.0])
+        # code -> self ms
+        function_self_ms = collections.defaultdict(float)
+
+        for sample, dt in zip(self.samples,
+                               Profile._sample_durations(self.samples)):
+            # Recursive calls show up more than once per stack; only credit
+            # each line once per sample for inclusive time.
+            seen = set()
+            for frame in sample.stack_trace:
+                if frame not in seen:
+                    seen.add(frame)
+                    totals = line_totals[frame]
+                    totals[0] += 1
+                    totals[1] += dt
+            if sample.stack_trace:
+                code, lineno = sample.stack_trace[0]
+                line_totals[(code, lineno)][2] += dt
+                function_self_ms[code] += dt
+
+        hottest = sorted(function_self_ms, key=function_self_ms.get,
+                         reverse=True)[:max_functions]
+
+        # Key by the same (filename, start_lineno, func_name) triple that
+        # line_profiler uses, so the linebyline formatting can be reused.
+        timings = {}
+        self_ms = {}
+        for code in hottest:
+            if isinstance(code, FoldedCode):
+                # Folded frames have no source lines to show.
+                continue
+            key = (code.co_filename, code.co_firstlineno, code.co_name)
+            timings[key] = []
+        for (code, lineno), (hits, inclusive_ms, line_self_ms) in (
+                line_totals.iteritems()):
+            key = (code.co_filename, code.co_firstlineno, code.co_name)
+            if key in timings:
+                timings[key].append((lineno, hits, inclusive_ms))
+                self_ms[(key, lineno)] = line_self_ms
+
+        # Imported here rather than at the top of the file so that the
+        # sampling profiler doesn't pull in line_profiler unless it's used.
+        from . import linebyline_profiler
+        line_results = linebyline_profiler._process_line_stats(
+            linebyline_profiler.LineStats(timings=timings, unit=1e-3))
+
+        for result in line_results:
+            key = (result['filename'], result['start_lineno'],
+                   result['func_name'])
+            for timing in result['timings']:
+                line_self_ms = self_ms.get((key, timing['lineno']), 0.0)
+                timing['self_time_ms'] = line_self_ms
+                timing['self_time_ms_s'] = "%.2f" % line_self_ms
+
+        return line_results
+
+    def tracked_times(self, should_track):
+        """Return a dict of the code objects of the tracked functions that
+        samples were taken in to the sampled time spent in each, in ms.
+
+        should_track is a function of a pstats-style function key (filename,
+        line number, function name), such as util.module_filter
+        returns. Each sample's time goes to its innermost
+        tracked frame, so a tracked function is credited with the time spent
+        in the untracked code it called, e.g. library and RPC calls.
+        """
+        # code -> ms spent with it as the innermost tracked frame
+        tracked_ms = collections.defaultdict(float)
+        # code -> whether it's tracked
+        decisions = {}
+
+        for sample, dt in zip(self.samples,
+                               Profile._sample_durations(self.samples)):
+            for code, _ in sample.stack_trace:
+                if code not in decisions:
+                    decisions[code] = (
+                        not isinstance(code, FoldedCode) and
+                        should_track((code.co_filename, code.co_firstlineno,
+                                      code.co_name)))
+                if decisions[code]:
+                    tracked_ms[code] += dt
+                    break
+
+        return dict(tracked_ms)
+
+    @staticmethod
+    def _sample_durations(samples):
+        """Return the amount of time, in ms, that each sample stands for."""
+        durations = []
+        last_sample_ms = None
+        for sample in samples:
+            if last_sample_ms is None:
+                # Make something up for the first sample, because Chrome thinks
+                # of samples as taking time, and we think of them as points in
+                # time.
+                # TODO(benkraft): do something smarter here.
+                dt = 1000.0 / InspectingThread.SAMPLES_PER_SECOND
+            else:
+                dt = sample.timestamp_ms - last_sample_ms
+            durations.append(dt)
+            last_sample_ms = sample.timestamp_ms
+        return durations
+
     def cpuprofile_results(self):
         """Outputs profiling data in a format suitable for display in Chrome.
 
@@ -295,9 +518,8 @@ class Profile(object):
             "id": 1,
         }
         next_id = 2
-        last_sample_ms = None
         sample_ids = []
-        for sample in samples:
+        for sample, dt in zip(samples, Profile._sample_durations(samples)):
             frame_to_add_to = root
             for frame in reversed(sample.stack_trace):
                 if frame not in frame_to_add_to["children"]:
@@ -311,16 +533,7 @@ class Profile(object):
                 frame_to_add_to = frame_to_add_to["children"][frame]
             # Now frame_to_add_to is the top frame of our stack, so account for
             # the time spent in this frame in it.
-            if last_sample_ms is None:
-                # Make something up for the first sample, because Chrome thinks
-                # of samples as taking time, and we think of them as points in
-                # time.
-                # TODO(benkraft): do something smarter here.
-                dt = 1000.0 / InspectingThread.SAMPLES_PER_SECOND
-            else:
-                dt = sample.timestamp_ms - last_sample_ms
             frame_to_add_to["total_time"] += dt
-            last_sample_ms = sample.timestamp_ms
             sample_ids.append(frame_to_add_to["id"])
 
         return root, sample_ids
@@ -392,7 +605,7 @@ class Profile(object):
             if thread_id == self.current_request_thread_id:
                 # Grab a sample of this thread's current stack
                 self.samples.append(ProfileSample.from_frame_and_timestamp(
-                        active_frame, timestamp_ms))
+                        active_frame, timestamp_ms, self.frame_folder))
         if self.memory_sample_every:
             if force_memory or sample_number % self.memory_sample_every == 0:
                 self.memory_samples[timestamp_ms] = get_memory()
@@ -12,14 +12,18 @@ window.GaeMiniProfiler = {
     modes: {
                SIMPLE: "simple",
                CPU_INSTRUMENTED: "instrumented",
+               CPU_INSTRUMENTED_FILTERED: "instrumented_filtered",
                CPU_SAMPLING: "sampling",
                CPU_MEMORY_SAMPLING: "memory_sampling",
                CPU_LINEBYLINE: "linebyline",
+               CPU_TRACING: "tracing",
                RPC_ONLY: "rpc",
                RPC_AND_CPU_INSTRUMENTED: "rpc_instrumented",
+               RPC_AND_CPU_INSTRUMENTED_FILTERED: "rpc_instrumented_filtered",
                RPC_AND_CPU_SAMPLING: "rpc_sampling",
                RPC_AND_CPU_MEMORY_SAMPLING: "rpc_memory_sampling",
-               RPC_AND_CPU_LINEBYLINE: "rpc_linebyline"
+               RPC_AND_CPU_LINEBYLINE: "rpc_linebyline",
+               RPC_AND_CPU_TRACING: "rpc_tracing"
     },
 
     init: function(requestId, fShowImmediately) {
@@ -97,6 +101,12 @@ window.GaeMiniProfiler = {
 
         // Set mode cookie for profiler to detect on next request
         $.cookiePlugin("g-m-p-mode", mode, {path: '/', expires: 365});
+
+        // Functions to profile line-by-line, in addition to those marked in
+        // code.
+        $.cookiePlugin("g-m-p-line-targets",
+                       $.trim(jel.find(".line-targets").val()) || null,
+                       {path: '/', expires: 365});
     },
 
     /**
@@ -105,8 +115,10 @@ window.GaeMiniProfiler = {
     isRpcEnabled: function(mode) {
         return (mode == this.modes.RPC_ONLY ||
                 mode == this.modes.RPC_AND_CPU_INSTRUMENTED ||
+                mode == this.modes.RPC_AND_CPU_INSTRUMENTED_FILTERED ||
                 mode == this.modes.RPC_AND_CPU_SAMPLING ||
-                mode == this.modes.RPC_AND_CPU_MEMORY_SAMPLING);
+                mode == this.modes.RPC_AND_CPU_MEMORY_SAMPLING ||
+                mode == this.modes.RPC_AND_CPU_TRACING);
     },
 
     /**
@@ -114,7 +126,18 @@ window.GaeMiniProfiler = {
      */
     isInstrumentedEnabled: function(mode) {
         return (mode == this.modes.CPU_INSTRUMENTED ||
-                mode == this.modes.RPC_AND_CPU_INSTRUMENTED);
+                mode == this.modes.CPU_INSTRUMENTED_FILTERED ||
+                mode == this.modes.RPC_AND_CPU_INSTRUMENTED ||
+                mode == this.modes.RPC_AND_CPU_INSTRUMENTED_FILTERED);
+    },
+
+    /**
+     * True if profiler mode has enabled CPU instrumentation of selected
+     * modules only
+     */
+    isFilteredInstrumentedEnabled: function(mode) {
+        return (mode == this.modes.CPU_INSTRUMENTED_FILTERED ||
+                mode == this.modes.RPC_AND_CPU_INSTRUMENTED_FILTERED);
     },
 
     /**
@@ -143,13 +166,22 @@ window.GaeMiniProfiler = {
                 mode == this.modes.RPC_AND_CPU_LINEBYLINE);
     },
 
+    /**
+     * True if profiler mode has enabled a timeline of function calls
+     */
+    isTracingEnabled: function(mode) {
+        return (mode == this.modes.CPU_TRACING ||
+                mode == this.modes.RPC_AND_CPU_TRACING);
+    },
+
     /**
      * True if either CPU instrumentation or CPU sampling is enabled
      */
     isCpuEnabled: function(mode) {
         return (GaeMiniProfiler.isInstrumentedEnabled(mode) ||
                 GaeMiniProfiler.isSamplingEnabled(mode) ||
-                GaeMiniProfiler.isLineByLineEnabled(mode));
+                GaeMiniProfiler.isLineByLineEnabled(mode) ||
+                GaeMiniProfiler.isTracingEnabled(mode));
     },
 
     appendRedirectIds: function(requestId, queryString) {
@@ -307,11 +339,17 @@ window.GaeMiniProfiler = {
             .find(".profile-link")
                 .click(function() { GaeMiniProfiler.toggleSection(this, ".profiler-details"); return false; }).end()
             .find(".rpc-link")
-                .click(function() { GaeMiniProfiler.toggleSection(this, ".rpc-details"); return false; }).end()
+                .click(function() {
+                    GaeMiniProfiler.toggleSection(this, ".rpc-details");
+                    GaeMiniProfiler.prettifyRpcs(this, data);
+                    return false;
+                }).end()
             .find(".logs-link")
                 .click(function() { GaeMiniProfiler.toggleSection(this, ".logs-details"); return false; }).end()
             .find(".callers-link")
                 .click(function() { $(this).parents("td").find(".callers").slideToggle("fast"); return false; }).end()
+            .find(".call-graph-link")
+                .click(function() { GaeMiniProfiler.toggleCallGraph(this, data); return false; }).end()
             .find(".request-log-link")
                 .click(function() { GaeMiniProfiler.showRequestLog(this); return false; }).end()
             .find(".settings-link")
@@ -351,6 +389,100 @@ window.GaeMiniProfiler = {
     },
 
 
+    /**
+     * Show or hide the callers and callees of a function in an instrumented
+     * profile. These aren't sent with the profile, so the first time they're
+     * shown they are fetched from the server.
+     */
+    toggleCallGraph: function(elLink, data) {
+        var jCallers = $(elLink).parents("td").find(".callers");
+
+        if (jCallers.data("loaded")) {
+            jCallers.slideToggle("fast");
+            return;
+        }
+
+        jCallers.slideDown("fast");
+        $.get(
+                "/gae_mini_profiler/shared/callgraph",
+                {
+                    "request_id": data.request_id,
+                    "func_desc": $(elLink).attr("data-func-desc")
+                },
+                function(callGraph) {
+                    jCallers
+                        .data("loaded", true)
+                        .find(".callers-content")
+                            .empty()
+                            .append($("#profilerCallGraphTemplate").tmplPlugin(
+                                callGraph || {callers: [], callees: []}));
+                },
+                "json"
+        );
+    },
+
+    /**
+     * Replace the raw RPC request and response summaries with readable
+     * versions, which are only worked out when they're first looked at.
+     */
+    prettifyRpcs: function(elLink, data) {
+        if (data.rpcsPrettified) {
+            return;
+        }
+        data.rpcsPrettified = true;
+
+        var jDetails = $(elLink).closest(".g-m-p").find(".rpc-details");
+        $.get(
+                "/gae_mini_profiler/shared/rpc",
+                {"request_id": data.request_id},
+                function(rpcDetails) {
+                    if (!rpcDetails) {
+                        return;
+                    }
+                    jDetails.find(".rpc-call").each(function() {
+                        var call = rpcDetails.calls[+$(this).attr("data-rpc-index")];
+                        if (!call) {
+                            return;
+                        }
+                        $(this)
+                            .find(".rpc-request")
+                                .text(call.request_short)
+                                .attr("title", call.request)
+                                .end()
+                            .find(".rpc-response")
+                                .text(call.response_short)
+                                .attr("title", call.response)
+                                .end()
+                            .find(".rpc-counts")
+                                .text(call.counts_desc);
+                    });
+                    jDetails.find(".rpc-misses").each(function() {
+                        var prefix = $(this).attr("data-service-prefix");
+                        $(this).text(rpcDetails.service_misses[prefix] || 0);
+                    });
+
+                    if (rpcDetails.memcache_prefixes.length) {
+                        var jPrefixes = jDetails.find(".rpc-memcache-prefixes");
+                        var jBody = jPrefixes.find("tbody");
+                        $.each(rpcDetails.memcache_prefixes, function(i, totals) {
+                            $("<tr>")
+                                .append($("<td>").text(totals.prefix))
+                                .append($("<td class='right'>").text(totals.keys))
+                                .append($("<td class='right'>").text(totals.hits))
+                                .append($("<td class='right'>").text(totals.misses))
+                                .append($("<td class='right'>").text(totals.hit_percent + "%"))
+                                .appendTo(jBody);
+                        });
+                        jPrefixes.show();
+                    }
+
+                    // Let the tables sort by the new contents.
+                    jDetails.find("table").trigger("update");
+                },
+                "json"
+        );
+    },
+
     toggleLogRows: function(element) {
         var sliderValue = $(element).val();
         // round the slider's value to the nearest 10, to match our log levels.
@@ -388,7 +520,9 @@ window.GaeMiniProfiler = {
         var mode = this.getCookieMode();
 
         var cpuSelector = "#cpu_disabled";
-        if (this.isInstrumentedEnabled(mode)) {
+        if (this.isFilteredInstrumentedEnabled(mode)) {
+            cpuSelector = "#cpu_instrumented_filtered";
+        } else if (this.isInstrumentedEnabled(mode)) {
             cpuSelector = "#cpu_instrumented";
         } else if (this.isMemorySamplingEnabled(mode)) {
             cpuSelector = "#cpu_memory_sampling";
@@ -396,6 +530,8 @@ window.GaeMiniProfiler = {
             cpuSelector = "#cpu_sampling";
         } else if (this.isLineByLineEnabled(mode)) {
             cpuSelector = "#cpu_linebyline";
+        } else if (this.isTracingEnabled(mode)) {
+            cpuSelector = "#cpu_tracing";
         }
 
         var rpcSelector = "#rpc_disabled";
@@ -410,6 +546,9 @@ window.GaeMiniProfiler = {
             .find(rpcSelector)
                 .attr("checked", "checked")
                 .end()
+            .find(".line-targets")
+                .val($.cookiePlugin("g-m-p-line-targets") || "")
+                .end()
         .slideToggle("fast");
     },
 
@@ -0,0 +1,249 @@
+# TODO(colin): fix these lint errors (http://pep8.readthedocs.io/en/release-1.7.x/intro.html#error-codes)
+# pep8-disable:E302,E501
+"""CPU profiler that records a timeline of function calls (uses sys.setprofile).
+
+This profiler records when each call into selected modules started and ended,
+in order, so you can see what ran when during a request. Appstats RPCs and
+log records are merged onto the same timeline, and the whole thing is exported
+in the trace event format read by https://ui.perfetto.dev and
+chrome://tracing. See
+https://docs.google.com/document/d/1CvAClvFfyA5R-PhYUmn5OOQtYMH4h6I0nSsKchNAySU
+for the format.
+
+PRO: unlike the instrumented and sampling profilers, which aggregate, every
+call into the traced code keeps its own start and end time, nested inside its
+callers, alongside the RPCs it was waiting on.
+
+CON: the profile hook is written in Python and runs for every function call,
+not just the traced ones, so this adds more overhead per call than the
+instrumented profiler. Events are kept in a fixed-size ring buffer, so only
+the most recent events of a long request are kept; the number of events
+dropped is reported.
+"""
+
+import collections
+import json
+import os
+import sys
+import time
+
+import util
+
+# How many function call and return events to keep for each request. Each
+# event takes three slots in preallocated lists, so this caps memory use.
+MAX_EVENTS = 100000
+
+# How many of the longest function calls to include in the results shown in
+# the profiler popup. All calls are in the exported trace.
+TOP_N = 30
+
+# Trace event thread ids for the timeline's tracks. RPCs may overlap, so each
+# RPC track gets its own thread id starting at _RPC_TID.
+_PYTHON_TID = 1
+_RPC_TID = 2
+
+Span = collections.namedtuple("Span", ["code", "start", "end", "depth"])
+
+def _code_desc(code):
+    return "%s:%s(%s)" % (code.co_filename, code.co_firstlineno, code.co_name)
+
+def _code_desc_short(code):
+    return "%s:%s(%s)" % (os.path.basename(code.co_filename),
+                          code.co_firstlineno, code.co_name)
+
+def _microseconds(seconds):
+    return int(round(seconds * 1000000))
+
+
+class Profile(object):
+    """Profiler that records a timeline of calls into selected code.
+
+    should_trace is a function of a pstats-style function key, (filename,
+    line number, function name), such as util.module_filter returns. Calls
+    to functions it rejects aren't recorded, but still take time on the
+    timeline of the traced function that made them.
+    """
+    def __init__(self, should_trace, max_events=MAX_EVENTS):
+        self.should_trace = should_trace
+        self.max_events = max_events
+
+        # Ring buffer of call and return events, preallocated so that
+        # recording an event never allocates.
+        self.timestamps = [0.0] * max_events
+        self.codes = [None] * max_events
+        self.is_calls = [False] * max_events
+        self.event_count = 0
+
+        # code object -> whether to trace it
+        self.decisions = {}
+
+        self.start = None
+        self.end = None
+
+    def dropped_event_count(self):
+        return max(0, self.event_count - self.max_events)
+
+    def trace(self, frame, event, arg):
+        """sys.setprofile hook that records calls and returns of traced
+        functions."""
+        if event != "call" and event != "return":
+            return
+
+        code = frame.f_code
+        traced = self.decisions.get(code)
+        if traced is None:
+            traced = self.decisions[code] = self.should_trace(
+                (code.co_filename, code.co_firstlineno, code.co_name))
+
+        if traced:
+            i = self.event_count % self.max_events
+            self.timestamps[i] = time.time()
+            self.codes[i] = code
+            self.is_calls[i] = event == "call"
+            self.event_count += 1
+
+    def run(self, fxn):
+        """Run function with tracing enabled."""
+        if self.start is None:
+            self.start = time.time()
+
+        sys.setprofile(self.trace)
+        try:
+            return fxn()
+        finally:
+            sys.setprofile(None)
+            self.end = time.time()
+
+    def events(self):
+        """Return the recorded (timestamp, code, is_call) events, oldest
+        first."""
+        count = min(self.event_count, self.max_events)
+        first = self.event_count - count
+        for n in xrange(first, self.event_count):
+            i = n % self.max_events
+            yield self.timestamps[i], self.codes[i], self.is_calls[i]
+
+    def spans(self):
+        """Return a Span for each recorded call, ordered by start time.
+
+        Returns whose calls were dropped from the ring buffer are ignored, and
+        calls that hadn't returned when tracing stopped end at self.end.
+        """
+        spans = []
+        stack = []
+        for timestamp, code, is_call in self.events():
+            if is_call:
+                stack.append((code, timestamp, len(spans)))
+                spans.append(None)
+                continue
+
+            # Close any calls that were still open inside this one, e.g.
+            # because a generator was suspended.
+            for depth in xrange(len(stack) - 1, -1, -1):
+                if stack[depth][0] is code:
+                    while len(stack) > depth:
+                        open_code, start, index = stack.pop()
+                        spans[index] = Span(open_code, start, timestamp,
+                                            len(stack))
+                    break
+
+        while stack:
+            open_code, start, index = stack.pop()
+            spans[index] = Span(open_code, start, self.end, len(stack))
+
+        return spans
+
+    def trace_events(self, recorder=None, log_records=()):
+        """Return the timeline as trace event format JSON.
+
+        recorder is the request's appstats recorder, if RPCs were recorded;
+        each RPC is added to the timeline as a span on an RPC track.
+        log_records are the request's (timestamp, level name, message) log
+        records, which are added as instant events.
+        """
+        events = [
+            {"ph": "M", "name": "process_name", "pid": 1, "tid": _PYTHON_TID,
+             "args": {"name": "gae_mini_profiler"}},
+            {"ph": "M", "name": "thread_name", "pid": 1, "tid": _PYTHON_TID,
+             "args": {"name": "Python"}},
+        ]
+
+        for span in self.spans():
+            code = span.code
+            events.append({
+                "ph": "X", "cat": "python", "pid": 1, "tid": _PYTHON_TID,
+                "name": code.co_name,
+                "ts": _microseconds(span.start),
+                "dur": _microseconds(span.end - span.start),
+                "args": {"func_desc": _code_desc(code)},
+            })
+
+        for created, level_name, message in log_records:
+            events.append({
+                "ph": "i", "s": "t", "cat": "log", "pid": 1,
+                "tid": _PYTHON_TID,
+                "name": "%s: %s" % (level_name, message.split("\n", 1)[0][:100]),
+                "ts": _microseconds(created),
+                "args": {"message": message},
+            })
+
+        if recorder:
+            # Give overlapping (asynchronous) RPCs tracks of their own so
+            # their spans don't have to nest.
+            track_ends = []
+            for trace in recorder.traces:
+                start_ms = (recorder.start_timestamp * 1000 +
+                            trace.start_offset_milliseconds())
+                end_ms = start_ms + trace.duration_milliseconds()
+                for track, track_end_ms in enumerate(track_ends):
+                    if track_end_ms <= start_ms:
+                        break
+                else:
+                    track = len(track_ends)
+                    track_ends.append(None)
+                    events.append({
+                        "ph": "M", "name": "thread_name", "pid": 1,
+                        "tid": _RPC_TID + track,
+                        "args": {"name": "RPCs" if not track else
+                                 "RPCs (%s)" % (track + 1)}})
+                track_ends[track] = end_ms
+
+                events.append({
+                    "ph": "X", "cat": "rpc", "pid": 1,
+                    "tid": _RPC_TID + track,
+                    "name": trace.service_call_name(),
+                    "ts": _microseconds(start_ms / 1000.0),
+                    "dur": _microseconds(trace.duration_milliseconds() / 1000.0),
+                })
+
+        return json.dumps({
+            "traceEvents": events,
+            "displayTimeUnit": "ms",
+            "otherData": {
+                "event_count": self.event_count,
+                "dropped_event_count": self.dropped_event_count(),
+                "max_events": self.max_events,
+            },
+        }, separators=(",", ":"))
+
+    def results(self):
+        """Return a summary of the timeline for the profiler popup."""
+        spans = self.spans()
+        longest = sorted(spans, key=lambda span: span.end - span.start,
+                         reverse=True)[:TOP_N]
+        start = self.start or 0.0
+
+        return {
+            "total_event_count": self.event_count,
+            "dropped_event_count": self.dropped_event_count(),
+            "max_events": self.max_events,
+            "total_span_count": len(spans),
+            "traced_function_count": len(set(span.code for span in spans)),
+            "spans": [{
+                "func_desc": _code_desc(span.code),
+                "func_desc_short": _code_desc_short(span.code),
+                "start_offset": util.seconds_fmt(span.start - start, 2),
+                "duration": util.seconds_fmt(span.end - span.start, 2),
+                "depth": span.depth,
+            } for span in sorted(longest, key=lambda span: span.start)],
+        }
@@ -1,102 +1,148 @@
 # TODO(colin): fix these lint errors (http://pep8.readthedocs.io/en/release-1.7.x/intro.html#error-codes)
-# pep8-disable:E101,E201,E202,E501,W191
+# pep8-disable:E201,E202,E501
+"""Parse the reprs of protocol buffers that appstats records back into
+Python objects.
+
+The parser scans the text by position, so it never copies what's left of the
+input, and keeps the containers it's inside of on an explicit stack rather
+than recursing, so deeply nested protos don't hit the recursion limit.
+"""
 import pprint
 import re
 
 
-_STRING = re.compile(r"^\s*(['\"])")
-_NUMBER = re.compile(r"^\s*(\d+L?)\s*")
-_BOOLEAN = re.compile(r"^\s*(True|False)\s*")
-_DETAILS_OMMITTED = re.compile(r"^\s*\.\.\.\s*")
-_LIST = re.compile(r"^\s*\[")
-_LIST_SEPARATOR = re.compile(r"^\s*,\s*")
-_LIST_END = re.compile(r"^\s*]\s*")
-_DICT = re.compile(r"^\s*([\w-]+)<")
-_DICT_FIELD = re.compile(r"^\s*([\w-]+)\s*=\s*")
+# These are only ever matched at a position, with pattern.match(text, pos),
+# which anchors them there.
+#
+# A value is a string, number, boolean, omitted details, list or dict. The
+# alternatives are tried in that order, and which group matched says which
+# kind of value it is.
+_VALUE = re.compile(r"""\s*(?:
+    (['"])          # opening quote of a string
+    |(-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?L?)\s*  # number, e.g. 5, 5L or 5.0
+    |(True|False)\s*
+    |(\.\.\.)\s*    # details omitted
+    |(\[)           # start of a list
+    |([\w-]+)<      # start of a dict, e.g. MemcacheGetRequest<
+    )""", re.VERBOSE)
+_STRING, _NUMBER, _BOOLEAN, _DETAILS_OMMITTED, _LIST, _DICT = range(1, 7)
+_LIST_SEPARATOR = re.compile(r"\s*,\s*")
+_LIST_END = re.compile(r"\s*]\s*")
+_DICT_FIELD = re.compile(r"\s*([\w-]+)\s*=\s*")
 _DICT_SEPARATOR = _LIST_SEPARATOR
-_DICT_END = re.compile(r"^\s*>\s*")
+_DICT_END = re.compile(r"\s*>\s*")
 
 
-def _consume_re(re, text):
-    m = re.match(text)
-    if not m:
-        return None, text
-    return m, text[m.end(0):]
+def _parse_string(text, start, quote_char):
+    """Parse the string starting at start, just after its opening quote.
 
+    Returns the string and the position just after its closing quote.
+    """
+    end = text.index(quote_char, start)
+    # (For an empty string, this looks at the last character of the text
+    # rather than the opening quote, just like the original slicing parser.)
+    while text[end - 1 if end > start else -1] == "\\":
+        end = text.index(quote_char, end + 1)
+    return text[start:end].decode('string_escape', 'ignore'), end + 1
 
-def _parse_string(text, quote_char):
-    end = text.index(quote_char)
-    while text[end-1] == "\\":
-        end = text.index(quote_char, end+1)
-    return text[:end].decode('string_escape', 'ignore'), text[end+1:]
 
+def _dict_value(name, args, kwargs):
+    if args and kwargs:
+        obj = { 'args': args }
+        obj.update(kwargs)
+    elif args:
+        obj = args if len(args) > 1 else args[0]
+    elif kwargs:
+        obj = kwargs
+    else:
+        obj = None
+    return {name: obj}
 
-def _parse_list(text):
-    result = []
-    while True:
-        m, text = _consume_re(_LIST_END, text)
-	if m:
-	    return result, text
-	element, text = _parse(text)
-	result.append(element)
-	_, text = _consume_re(_LIST_SEPARATOR, text)
 
+def unformat(text):
+    # The lists and dicts we're inside of, innermost last. A list is
+    # [elements] and a dict is [name, args, kwargs, name of the field whose
+    # value is being parsed, or None].
+    stack = []
+    # The innermost container is a list, or the stack is empty.
+    in_list = True
+    pos = 0
 
-def _parse_dict(text, name):
-    args = []
-    kwargs = {}
     while True:
-        m, text = _consume_re(_DICT_END, text)
-	if m:
-	    if args and kwargs:
-	        obj = { 'args': args }
-		obj.update(kwargs)
-	    elif args:
-	        obj = args if len(args) > 1 else args[0]
-	    elif kwargs:
-	        obj = kwargs
-	    else:
-	        obj = None
-	    return {name: obj}, text
-	m, text = _consume_re(_DICT_SEPARATOR, text)
-	if m:
-	    continue
-	m, text = _consume_re(_DICT_FIELD, text)
-	if m:
-	    element, text = _parse(text)
-	    kwargs[ m.group(1).strip("_") ] = element
-	    continue
-	element, text = _parse(text)
-	args.append(element)
-
-
-def _parse(text):
-    m, text = _consume_re(_STRING, text)
-    if m:
-        return _parse_string(text, m.group(1))
-    m, text = _consume_re(_NUMBER, text)
-    if m:
-        value = long(m.group(1)[:-1]) if m.group(1).endswith("L") else int(m.group(1))
-	return value, text
-    m, text = _consume_re(_BOOLEAN, text)
-    if m:
-        return m.group(1) == "True", text
-    m, text = _consume_re(_DETAILS_OMMITTED, text)
-    if m:
-        return "...", text
-    m, text = _consume_re(_LIST, text)
-    if m:
-        return _parse_list(text)
-    m, text = _consume_re(_DICT, text)
-    if m:
-        return _parse_dict(text, m.group(1))
-    raise ValueError(text)
-
-
-def unformat(text):
-    result, remainder = _parse(text)
-    assert remainder == ""
-    return result
+        # Parse the value at pos, or open the list or dict that starts there.
+        m = _VALUE.match(text, pos)
+        if not m:
+            raise ValueError(text[pos:])
+        kind = m.lastindex
+        pos = m.end()
+        if kind == _STRING:
+            value, pos = _parse_string(text, pos, m.group(_STRING))
+        elif kind == _NUMBER:
+            number = m.group(_NUMBER)
+            if number.endswith("L"):
+                value = long(number[:-1])
+            elif "." in number or "e" in number or "E" in number:
+                value = float(number)
+            else:
+                value = int(number)
+        elif kind == _BOOLEAN:
+            value = m.group(_BOOLEAN) == "True"
+        elif kind == _DETAILS_OMMITTED:
+            value = "..."
+        else:
+            if kind == _LIST:
+                container = [[]]
+            else:
+                container = [m.group(_DICT), [], {}, None]
+            stack.append(container)
+            in_list = kind == _LIST
+
+        # Unless we just opened a container, add the value to the one it's in.
+        # Then find the container's next element or its end, and if it ended,
+        # add it to the container it's in, and so on.
+        opened = kind >= _LIST
+        while stack:
+            container = stack[-1]
+            if in_list:
+                if not opened:
+                    container[0].append(value)
+                    m = _LIST_SEPARATOR.match(text, pos)
+                    if m:
+                        pos = m.end()
+                m = _LIST_END.match(text, pos)
+                if not m:
+                    break
+                value = container[0]
+            else:
+                if not opened:
+                    if container[3] is None:
+                        container[1].append(value)
+                    else:
+                        container[2][container[3]] = value
+                        container[3] = None
+                while True:
+                    m = _DICT_SEPARATOR.match(text, pos)
+                    if m:
+                        pos = m.end()
+                        continue
+                    break
+                m = _DICT_END.match(text, pos)
+                if not m:
+                    m = _DICT_FIELD.match(text, pos)
+                    if m:
+                        container[3] = m.group(1).strip("_")
+                        pos = m.end()
+                    break
+                value = _dict_value(*container[:3])
+
+            pos = m.end()
+            opened = False
+            stack.pop()
+            in_list = not stack or len(stack[-1]) == 1
+        else:
+            if not opened:
+                assert pos == len(text)
+                return value
 
 
 def main():
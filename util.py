@@ -1,6 +1,8 @@
 # TODO(colin): fix these lint errors (http://pep8.readthedocs.io/en/release-1.7.x/intro.html#error-codes)
 # pep8-disable:E302
 import os
+import re
+import sys
 
 # Assume if SERVER_SOFTWARE is not present in the environment at import time
 # that we are in some kind of testing or development environment.
@@ -12,6 +14,9 @@ def seconds_fmt(f, n=0):
 def milliseconds_fmt(f, n=0):
     return decimal_fmt(f, n)
 
+def kilobytes_fmt(byte_count, n=1):
+    return decimal_fmt(byte_count / 1024.0, n)
+
 def decimal_fmt(f, n=0):
     format = "%." + str(n) + "f"
     return format % f
@@ -23,3 +28,82 @@ def short_rpc_file_fmt(s):
     if not s:
         return ""
     return s[s.find("/"):]
+
+# Absolute source path, without extension -> name of the module loaded from it
+_module_names = {}
+
+def module_name(filename):
+    """Return the name of the module loaded from filename, or "" if none."""
+    path = os.path.splitext(os.path.abspath(filename))[0]
+    if path not in _module_names:
+        for name, module in sys.modules.items():
+            module_file = getattr(module, "__file__", None)
+            if module_file:
+                _module_names[os.path.splitext(
+                    os.path.abspath(module_file))[0]] = name
+        # Don't search again for code that doesn't belong to a module.
+        _module_names.setdefault(path, "")
+    return _module_names[path]
+
+# module prefixes -> should_track function, so that the decision for each
+# function is only made once per process.
+_module_filters = {}
+
+def module_filter(module_prefixes):
+    """Return a should_track function for instrumented_profiler's
+    FilteredProfiler, and for the other profilers that only track some code.
+
+    Functions are tracked if their module's name starts with one of
+    module_prefixes. If module_prefixes is None, the application's own code is
+    tracked: that is, any code in the app's directory outside of
+    gae_mini_profiler itself. The app's directory is the working directory,
+    which App Engine sets to the app's root, as long as gae_mini_profiler is
+    somewhere inside it.
+    """
+    if module_prefixes is not None:
+        module_prefixes = tuple(module_prefixes)
+    if module_prefixes in _module_filters:
+        return _module_filters[module_prefixes]
+
+    if module_prefixes is None:
+        profiler_dir = os.path.dirname(os.path.abspath(__file__))
+        app_dir = os.path.abspath(os.getcwd())
+        if not profiler_dir.startswith(app_dir + os.sep):
+            app_dir = os.path.dirname(profiler_dir)
+
+        def decide(filename):
+            path = os.path.abspath(filename)
+            return (path.startswith(app_dir + os.sep) and
+                    not path.startswith(profiler_dir + os.sep))
+    else:
+        def decide(filename):
+            return module_name(filename).startswith(module_prefixes)
+
+    # Built-in functions show up with a filename of "~".
+    decisions = {"~": False}
+
+    def should_track(func_name):
+        filename = func_name[0]
+        if filename not in decisions:
+            decisions[filename] = decide(filename)
+        return decisions[filename]
+
+    _module_filters[module_prefixes] = should_track
+    return should_track
+
+# Path segments that are most likely IDs: numbers, and long tokens with a
+# digit in them, like keys, UUIDs and hashes.
+_ID_SEGMENT_RE = re.compile(r"^(?:\d+|(?=[^/]*\d)[\w.~%-]{16,})$")
+
+# Memcache keys can't be longer than 250 bytes.
+_MAX_ROUTE_LENGTH = 200
+
+def route(path):
+    """Return the route a request to path is counted under in running totals
+    kept across requests: path with the segments that look like IDs replaced
+    by "*", e.g. "/user/*/posts" for "/user/123/posts"."""
+    segments = path.split("/")
+    for i, segment in enumerate(segments):
+        if _ID_SEGMENT_RE.match(segment):
+            segments[i] = "*"
+    return "/".join(segments)[:_MAX_ROUTE_LENGTH]